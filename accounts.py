@@ -0,0 +1,197 @@
+import argparse
+import json
+import os.path
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from actions import ActionAccumulator
+from batch_fetch import BatchFetcher
+from fetch import fetch_options, sync_mailbox
+from gmail_service import GmailSession
+from gmailops import load_rule_collections, process_emails
+from labels import LabelCatalog, resolve_labels
+from ledger import RuleLedger
+from metrics import METRICS, configure_logging
+from rule_sql import candidate_condition
+from scheduler import USER_QUOTA_PER_SECOND, QuotaBudget, RequestScheduler, RetryQueue
+from storage import EmailStore
+
+REGISTRY = 'accounts.json'
+ACCOUNTS_DIR = 'accounts'
+
+# Backlog reported for mailboxes without a usable database yet, so they go first
+UNKNOWN_BACKLOG = sys.maxsize
+
+
+class Account:
+    """One mailbox: its OAuth token, its own database and the rules applied to it.
+
+    Paths default to a directory per account under `base_dir`, so accounts
+    never share a token or a database.
+    """
+
+    def __init__(self, name: str, token_file: Optional[str] = None, db_path: Optional[str] = None,
+                 rules: Optional[List[str]] = None, label_ids: Optional[List[str]] = None,
+                 quota_per_second: float = USER_QUOTA_PER_SECOND, credentials_file: str = 'credentials.json',
+                 base_dir: str = ACCOUNTS_DIR, create_labels: bool = False):
+        self.name = name
+        self.directory = os.path.join(base_dir, name)
+        self.token_file = token_file or os.path.join(self.directory, 'token.json')
+        self.db_path = db_path or os.path.join(self.directory, 'email_database.db')
+        self.rules = rules or ['./rules']
+        self.label_ids = label_ids if label_ids is not None else ['INBOX']
+        self.quota_per_second = quota_per_second
+        self.credentials_file = credentials_file
+        # Create the labels move actions name that do not exist, instead of skipping those actions
+        self.create_labels = create_labels
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], defaults: Optional[Dict[str, Any]] = None) -> 'Account':
+        options = dict(defaults or {}, **data)
+        return cls(options.pop('name'), **{key: value for key, value in options.items()
+                                           if key in ('token_file', 'db_path', 'rules', 'label_ids',
+                                                      'quota_per_second', 'credentials_file', 'base_dir',
+                                                      'create_labels')})
+
+    def session(self) -> GmailSession:
+        return GmailSession(self.token_file, self.credentials_file)
+
+    def backlog(self) -> int:
+        """Local work waiting for this account: emails the next run would evaluate plus queued retries.
+
+        Only candidates of the account's rules count, exactly the rows
+        process_emails would select; emails the SQL filter already rules out
+        are never evaluated, so they are never work.
+        """
+        if not os.path.exists(self.db_path):
+            return UNKNOWN_BACKLOG
+        conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+        try:
+            rules = load_rule_collections(self.rules)
+            where, params = candidate_condition(conn, rules, ledger=RuleLedger(conn, rules))
+            unevaluated = conn.execute(f'SELECT COUNT(*) FROM emails WHERE {where}', params).fetchone()[0]
+            queued = conn.execute('SELECT COUNT(*) FROM retry_queue').fetchone()[0]
+        except sqlite3.Error:
+            # Created by an older version; the first run migrates it
+            return UNKNOWN_BACKLOG
+        finally:
+            conn.close()
+        return unevaluated + queued
+
+
+def load_accounts(path: str = REGISTRY) -> List[Account]:
+    """Read the account registry: {"defaults": {...}, "accounts": [{"name": ...}, ...]}."""
+    with open(path) as f:
+        registry = json.load(f)
+    defaults = registry.get('defaults', {})
+    accounts = [Account.from_dict(data, defaults) for data in registry.get('accounts', [])]
+    names = [account.name for account in accounts]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f'Duplicate account names in {path}: {", ".join(duplicates)}')
+    return accounts
+
+
+def by_priority(accounts: List[Account]) -> List[Account]:
+    return sorted(accounts, key=lambda account: account.backlog(), reverse=True)
+
+
+def process_account(account: Account, full: bool = False) -> Dict[str, Any]:
+    """Sync one mailbox and apply its rules; runs in a worker process.
+
+    Every account gets its own quota budget, because Gmail's per-user quota
+    is tracked per mailbox.
+    """
+    started = time.monotonic()
+    # Worker processes are reused, so metrics start over for every account
+    METRICS.reset()
+    summary: Dict[str, Any] = {'account': account.name, 'stored': 0, 'matched': 0, 'error': None}
+    if not os.path.exists(account.token_file):
+        summary['error'] = f'no token at {account.token_file}; run: python accounts.py authorize {account.name}'
+        return summary
+    try:
+        os.makedirs(os.path.dirname(account.db_path) or '.', exist_ok=True)
+        session = account.session()
+        scheduler = RequestScheduler(QuotaBudget(account.quota_per_second))
+        rules = load_rule_collections(account.rules)
+        fetcher = BatchFetcher(session.service, scheduler=scheduler, **fetch_options(rules))
+        with EmailStore(account.db_path) as store:
+            summary['stored'] = sync_mailbox(account.label_ids, fetcher=fetcher, full=full, store=store)
+            resolve_labels(rules, LabelCatalog(store.conn, session.service(), scheduler), create=account.create_labels)
+            accumulator = ActionAccumulator(session.service(), scheduler=scheduler,
+                                            retry_queue=RetryQueue(store.conn))
+            summary['matched'] = process_emails(store.conn, rules, accumulator)
+    except Exception as error:
+        # One broken mailbox must not stop the others
+        summary['error'] = f'{type(error).__name__}: {error}'
+    summary['seconds'] = round(time.monotonic() - started, 3)
+    summary['metrics'] = METRICS.summary()
+    return summary
+
+
+def run_accounts(accounts: List[Account], workers: int = 0, full: bool = False,
+                 process: Callable[..., Dict[str, Any]] = process_account) -> Iterator[Dict[str, Any]]:
+    """Process accounts, largest backlog first, and yield each summary as it finishes.
+
+    With `workers=0` accounts run one after another in this process.
+    """
+    ordered = by_priority(accounts)
+    if not workers:
+        for account in ordered:
+            yield process(account, full)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # The pool starts tasks in submission order, so priority is preserved
+        futures = [executor.submit(process, account, full) for account in ordered]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync and apply rules for many mailboxes.")
+    parser.add_argument("--registry", default=REGISTRY, help=f"Account registry file (default: {REGISTRY})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Process accounts across a pool of worker processes")
+    run_parser.add_argument("names", nargs="*", help="Only process these accounts")
+    # A sync mostly waits on the network, so there are several workers per core
+    run_parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) * 4),
+                            help="Worker processes (default: 4 per CPU up to 32, 0 runs in-process)")
+    run_parser.add_argument("--full", action="store_true", help="Resync every mailbox from scratch")
+
+    authorize_parser = subparsers.add_parser("authorize", help="Create the OAuth token of an account")
+    authorize_parser.add_argument("name")
+
+    subparsers.add_parser("list", help="Show accounts in processing order")
+    parser.add_argument("--log-level", default="WARNING", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging verbosity (default: WARNING)")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    accounts = load_accounts(args.registry)
+    if args.command == "list":
+        for account in by_priority(accounts):
+            print(f"{account.name:<30} backlog {account.backlog():>12}  {account.db_path}")
+    elif args.command == "authorize":
+        account = next((account for account in accounts if account.name == args.name), None)
+        if account is None:
+            parser.error(f"unknown account {args.name}")
+        os.makedirs(os.path.dirname(account.token_file) or '.', exist_ok=True)
+        account.session().credentials()
+        print(f"Saved token for {account.name} to {account.token_file}")
+    else:
+        if args.names:
+            accounts = [account for account in accounts if account.name in args.names]
+        failed = 0
+        for summary in run_accounts(accounts, args.workers, args.full):
+            if summary['error']:
+                failed += 1
+            print(json.dumps(summary))
+        print(f"{len(accounts) - failed} of {len(accounts)} accounts processed.")
+
+
+if __name__ == '__main__':
+    main()
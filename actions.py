@@ -0,0 +1,116 @@
+import logging
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from googleapiclient.errors import HttpError
+
+from metrics import METRICS
+from scheduler import RequestScheduler, RetryQueue, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# Gmail accepts at most 1000 message IDs per users().messages().batchModify() call
+BATCH_MODIFY_LIMIT = 1000
+
+LabelDelta = Tuple[FrozenSet[str], FrozenSet[str]]
+
+
+class ActionAccumulator:
+    """Collects label changes for matched emails and applies them with batchModify.
+
+    Changes for the same message coming from several actions or rules are merged
+    into one net delta, and messages sharing the same delta are sent together.
+    With a `retry_queue`, calls that still fail with a retryable error after
+    the scheduler's retries are queued for the next flush instead of being lost.
+    """
+
+    def __init__(self, service=None, user_id: str = 'me', chunk_size: int = BATCH_MODIFY_LIMIT,
+                 scheduler: Optional[RequestScheduler] = None, retry_queue: Optional[RetryQueue] = None):
+        self._service = service
+        self.user_id = user_id
+        self.chunk_size = max(1, min(chunk_size, BATCH_MODIFY_LIMIT))
+        self.scheduler = scheduler or RequestScheduler()
+        self.retry_queue = retry_queue
+        self._pending: Dict[str, Tuple[Set[str], Set[str]]] = {}
+        self._built_service = False
+        # Messages whose changes Gmail rejected, so callers do not record them as applied
+        self.rejected: Set[str] = set()
+
+    @property
+    def service(self):
+        if self._service is None:
+            from gmail_service import get_service
+            self._service = get_service()
+            self._built_service = True
+        return self._service
+
+    @property
+    def shared_service(self):
+        """The service this accumulator was given, for worker processes; None when they should build their own."""
+        return None if self._built_service else self._service
+
+    def add(self, message_id: str, add_label_ids: Iterable[str] = (),
+            remove_label_ids: Iterable[str] = ()) -> None:
+        adds, removes = self._pending.setdefault(message_id, (set(), set()))
+        # A later change wins over an earlier opposite change to the same label
+        for label_id in add_label_ids:
+            removes.discard(label_id)
+            adds.add(label_id)
+        for label_id in remove_label_ids:
+            adds.discard(label_id)
+            removes.add(label_id)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def groups(self) -> Dict[LabelDelta, List[str]]:
+        grouped: Dict[LabelDelta, List[str]] = {}
+        for message_id, (adds, removes) in self._pending.items():
+            if not adds and not removes:
+                continue
+            grouped.setdefault((frozenset(adds), frozenset(removes)), []).append(message_id)
+        return grouped
+
+    def _batch_modify(self, body: Dict[str, Any]) -> None:
+        self.scheduler.execute(
+            self.service.users().messages().batchModify(userId=self.user_id, body=body), 'messages.batchModify')
+
+    def flush(self, drain: bool = True) -> int:
+        """Send every pending change and return the number of batchModify calls made.
+
+        With `drain`, changes queued by earlier runs are replayed first.
+        Messages whose changes Gmail rejects are added to `rejected`.
+        """
+        calls = 0
+        if self.retry_queue is not None and drain:
+            # Changes that failed in an earlier run go out before the new ones
+            calls += self.retry_queue.drain('batchModify', self._batch_modify)
+        # Changes leave _pending only once they were sent or queued, so an unexpected
+        # error (a dropped connection, say) keeps the rest for the next flush
+        for (adds, removes), message_ids in self.groups().items():
+            modified = 0
+            for start in range(0, len(message_ids), self.chunk_size):
+                body = {'ids': message_ids[start:start + self.chunk_size],
+                        'addLabelIds': sorted(adds),
+                        'removeLabelIds': sorted(removes)}
+                try:
+                    self._batch_modify(body)
+                except HttpError as error:
+                    if self.retry_queue is None:
+                        raise
+                    if not is_retryable(error):
+                        # Replaying a rejected request (an unknown label, say) would only fail again
+                        logger.error("Dropped %d label changes Gmail rejected: %s", len(body['ids']), error)
+                        self.rejected.update(body['ids'])
+                    else:
+                        self.retry_queue.push('batchModify', body, error)
+                        logger.warning("Queued %d label changes for the next run: %s", len(body['ids']), error)
+                else:
+                    calls += 1
+                    modified += len(body['ids'])
+                for message_id in body['ids']:
+                    del self._pending[message_id]
+            METRICS.increment('emails_modified', modified)
+            logger.info("Modified %d emails: added %s, removed %s", modified, sorted(adds), sorted(removes))
+        # What is left are changes that cancelled out
+        self._pending.clear()
+        return calls
@@ -0,0 +1,423 @@
+import asyncio
+import concurrent.futures
+import gzip
+import json
+import logging
+import ssl
+import threading
+import time
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from batch_fetch import AdaptiveBackoff, FetchStats
+from metrics import METRICS
+from scheduler import QUOTA_UNITS, USER_QUOTA_PER_SECOND, QuotaBudget, RequestScheduler, is_retryable, retry_after
+
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/'
+# Seconds to connect, or to receive a whole response once a request was sent
+REQUEST_TIMEOUT = 60.0
+# Seconds a blocking caller waits for a call, including its wait for quota and a free connection
+CALL_TIMEOUT = 300.0
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaLimiter:
+    """Token bucket that spends Gmail quota units; callers wait until enough have refilled."""
+
+    def __init__(self, units_per_second: float = USER_QUOTA_PER_SECOND, burst: Optional[float] = None):
+        self.rate = units_per_second
+        self.capacity = burst if burst is not None else units_per_second
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.spent = 0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, units: float) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # The lock keeps callers in arrival order so a big batchModify is not starved
+        async with self._lock:
+            units = min(units, self.capacity)
+            self._refill()
+            while self.tokens < units:
+                await asyncio.sleep((units - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= units
+            self.spent += units
+
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to a single host, at most `size` open at a time.
+
+    Connecting and each response are bounded by `timeout`; a request that
+    runs out of time raises TimeoutError and its connection is closed.
+    """
+
+    def __init__(self, base_url: str, size: int = 10, timeout: float = REQUEST_TIMEOUT):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.secure = url.scheme == 'https'
+        self.port = url.port or (443 if self.secure else 80)
+        self.host_header = url.netloc
+        self.size = size
+        self.timeout = timeout
+        self.opened = 0
+        self._idle: List[_Connection] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._ssl_context = ssl.create_default_context() if self.secure else None
+
+    async def _open(self) -> _Connection:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            self.host, self.port, ssl=self._ssl_context,
+            server_hostname=self.host if self.secure else None), self.timeout)
+        self.opened += 1
+        return _Connection(reader, writer)
+
+    async def request(self, method: str, target: str, headers: Dict[str, str],
+                      body: Optional[bytes] = None) -> Tuple[int, Dict[str, str], bytes]:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            reused = connection is not None
+            if connection is None:
+                connection = await self._open()
+            try:
+                status, response_headers, content = await self._exchange(connection, method, target, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection; retry once on a fresh one
+                connection = await self._open()
+                status, response_headers, content = await self._exchange(connection, method, target, headers, body)
+            if response_headers.get('connection', '').lower() == 'close' or connection.reader.at_eof():
+                connection.close()
+            else:
+                self._idle.append(connection)
+            return status, response_headers, content
+
+    async def _exchange(self, connection: _Connection, method: str, target: str, headers: Dict[str, str],
+                        body: Optional[bytes]) -> Tuple[int, Dict[str, str], bytes]:
+        try:
+            return await asyncio.wait_for(self._send(connection, method, target, headers, body), self.timeout)
+        except BaseException:
+            # A connection left in the middle of a request can never be reused
+            connection.close()
+            raise
+
+    async def _send(self, connection: _Connection, method: str, target: str, headers: Dict[str, str],
+                    body: Optional[bytes]) -> Tuple[int, Dict[str, str], bytes]:
+        lines = [f'{method} {target} HTTP/1.1', f'Host: {self.host_header}', 'Connection: keep-alive',
+                 f'Content-Length: {len(body or b"")}']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        connection.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await connection.writer.drain()
+
+        status_line = await connection.reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        response_headers: Dict[str, str] = {}
+        while True:
+            line = await connection.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int((await connection.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    await connection.reader.readuntil(b'\r\n')
+                    break
+                parts.append(await connection.reader.readexactly(size))
+                await connection.reader.readexactly(2)
+            content = b''.join(parts)
+        elif 'content-length' in response_headers:
+            content = await connection.reader.readexactly(int(response_headers['content-length']))
+        elif status in (204, 304) or status < 200 or method == 'HEAD':
+            content = b''
+        else:
+            # Without a length the body runs until the server closes the connection
+            content = await connection.reader.read()
+        if response_headers.get('content-encoding') == 'gzip':
+            content = gzip.decompress(content)
+        return status, response_headers, content
+
+    def close(self) -> None:
+        for connection in self._idle:
+            connection.close()
+        self._idle = []
+
+
+class AsyncGmailClient:
+    """Calls the Gmail REST API from asyncio over a pool of keep-alive connections.
+
+    Every call first spends its quota units from `limiter`, and at most
+    `max_connections` requests are in flight. Errors are raised as
+    googleapiclient HttpErrors so the existing retry checks apply unchanged.
+    """
+
+    def __init__(self, session=None, credentials=None, base_url: str = GMAIL_API_URL,
+                 max_connections: int = 10, limiter: Optional[QuotaLimiter] = None, user_id: str = 'me',
+                 timeout: float = REQUEST_TIMEOUT):
+        self.session = session
+        self._credentials = credentials
+        self.base_path = urlsplit(base_url).path.rstrip('/') + '/'
+        self.pool = ConnectionPool(base_url, max_connections, timeout)
+        self.limiter = limiter or QuotaLimiter()
+        self.user_id = user_id
+
+    async def _authorization(self) -> str:
+        creds = self._credentials
+        if creds is None or not creds.valid:
+            if self.session is None:
+                from gmail_service import default_session
+                self.session = default_session()
+            # Loading or refreshing credentials blocks, so it runs off the event loop
+            creds = self._credentials = await asyncio.get_running_loop().run_in_executor(
+                None, self.session.credentials)
+        return f'Bearer {creds.token}'
+
+    async def call(self, method: str, http_method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                   body: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        await self.limiter.acquire(QUOTA_UNITS.get(method, 1))
+        query = urlencode({key: value for key, value in (params or {}).items() if value is not None}, doseq=True)
+        target = self.base_path + quote(self.user_id) + path + ('?' + query if query else '')
+        headers = {'Authorization': await self._authorization(), 'Accept-Encoding': 'gzip'}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        started = time.perf_counter()
+        status, response_headers, content = await self.pool.request(http_method, target, headers, data)
+        METRICS.observe('api_call', time.perf_counter() - started, method=method)
+        if status >= 300:
+            METRICS.increment('api_errors', method=method, status=status)
+            raise HttpError(httplib2.Response(dict(response_headers, status=str(status))), content, uri=target)
+        return json.loads(content) if content else {}
+
+    async def get_message(self, message_id: str, **params) -> Dict[str, Any]:
+        return await self.call('messages.get', 'GET', f'/messages/{quote(message_id)}', params)
+
+    async def list_messages(self, **params) -> Dict[str, Any]:
+        return await self.call('messages.list', 'GET', '/messages', params)
+
+    async def modify(self, message_id: str, add_label_ids: Iterable[str] = (),
+                     remove_label_ids: Iterable[str] = ()) -> Dict[str, Any]:
+        return await self.call('messages.modify', 'POST', f'/messages/{quote(message_id)}/modify', body={
+            'addLabelIds': list(add_label_ids), 'removeLabelIds': list(remove_label_ids)})
+
+    async def batch_modify(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.call('messages.batchModify', 'POST', '/messages/batchModify', body=body)
+
+    async def list_history(self, **params) -> Dict[str, Any]:
+        return await self.call('history.list', 'GET', '/history', params)
+
+    async def get_profile(self) -> Dict[str, Any]:
+        return await self.call('getProfile', 'GET', '/profile')
+
+    async def watch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.call('watch', 'POST', '/watch', body=body)
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class EventLoopThread:
+    """An asyncio event loop running in a background thread, for use from blocking code.
+
+    run() gives up after `timeout` seconds, cancelling the coroutine, and
+    raises TimeoutError.
+    """
+
+    def __init__(self, timeout: Optional[float] = CALL_TIMEOUT):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine) -> Any:
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f'Call did not finish within {self.timeout} seconds') from None
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class _Call:
+    def __init__(self, runner: EventLoopThread, coroutine_function: Callable, *args, **kwargs):
+        self.runner = runner
+        self.coroutine_function = coroutine_function
+        self.args = args
+        self.kwargs = kwargs
+
+    def execute(self) -> Dict[str, Any]:
+        return self.runner.run(self.coroutine_function(*self.args, **self.kwargs))
+
+
+class GmailServiceAdapter:
+    """Blocking, googleapiclient-shaped view of an AsyncGmailClient.
+
+    Supports the calls fetch.py, the daemon and ActionAccumulator make, so the
+    existing sync and action code runs over the async transport unchanged.
+    """
+
+    def __init__(self, client: AsyncGmailClient, runner: EventLoopThread):
+        self.client = client
+        self.runner = runner
+
+    def users(self) -> 'GmailServiceAdapter':
+        return self
+
+    def messages(self) -> '_MessagesAdapter':
+        return _MessagesAdapter(self)
+
+    def history(self) -> '_HistoryAdapter':
+        return _HistoryAdapter(self)
+
+    def getProfile(self, userId: str = 'me') -> _Call:
+        return _Call(self.runner, self.client.get_profile)
+
+    def watch(self, userId: str = 'me', body: Optional[Dict[str, Any]] = None) -> _Call:
+        return _Call(self.runner, self.client.watch, body or {})
+
+    def close(self) -> None:
+        # Connections belong to the runner's loop, so they are closed there
+        self.runner.loop.call_soon_threadsafe(self.client.close)
+        self.runner.close()
+
+
+class _MessagesAdapter:
+    def __init__(self, service: GmailServiceAdapter):
+        self.service = service
+
+    def list(self, userId: str = 'me', **params) -> _Call:
+        return _Call(self.service.runner, self.service.client.list_messages, **params)
+
+    def get(self, userId: str = 'me', id: str = '', **params) -> _Call:
+        return _Call(self.service.runner, self.service.client.get_message, id, **params)
+
+    def modify(self, userId: str = 'me', id: str = '', body: Optional[Dict[str, Any]] = None) -> _Call:
+        body = body or {}
+        return _Call(self.service.runner, self.service.client.modify, id,
+                     body.get('addLabelIds', ()), body.get('removeLabelIds', ()))
+
+    def batchModify(self, userId: str = 'me', body: Optional[Dict[str, Any]] = None) -> _Call:
+        return _Call(self.service.runner, self.service.client.batch_modify, body or {})
+
+
+class _HistoryAdapter:
+    def __init__(self, service: GmailServiceAdapter):
+        self.service = service
+
+    def list(self, userId: str = 'me', **params) -> _Call:
+        return _Call(self.service.runner, self.service.client.list_history, **params)
+
+
+class AsyncFetcher:
+    """Drop-in replacement for BatchFetcher that fetches messages concurrently over asyncio.
+
+    Up to `max_concurrency` messages().get calls are in flight, throttled by
+    the client's quota limiter; throttled calls are retried with backoff.
+    The client's limiter already paces every call, so the scheduler used for
+    the blocking calls only retries and counts.
+    """
+
+    def __init__(self, client: Optional[AsyncGmailClient] = None, max_concurrency: int = 50,
+                 max_retries: int = 5, backoff: Optional[AdaptiveBackoff] = None, **get_kwargs):
+        self.client = client or AsyncGmailClient()
+        self.runner = EventLoopThread()
+        self.service = GmailServiceAdapter(self.client, self.runner)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff or AdaptiveBackoff()
+        self.get_kwargs = get_kwargs
+        self.scheduler = RequestScheduler(QuotaBudget(units_per_second=None))
+        self.stats = FetchStats()
+        self.failed_ids: List[str] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def service_factory(self) -> GmailServiceAdapter:
+        return self.service
+
+    async def _get(self, message_id: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        for attempt in range(self.max_retries + 1):
+            if self.backoff.delay:
+                await asyncio.sleep(self.backoff.delay)
+            try:
+                message = await self.client.get_message(message_id, **self.get_kwargs)
+            except HttpError as error:
+                if not is_retryable(error) or attempt == self.max_retries:
+                    logger.warning("An error occurred while fetching email %s: %s", message_id, error)
+                    # Only throttling and server errors are worth a retry; a 404 means the message was deleted
+                    if is_retryable(error):
+                        self.failed_ids.append(message_id)
+                    return None, attempt
+                self.backoff.failure(retry_after(error))
+                continue
+            self.backoff.success()
+            return message, attempt
+        return None, self.max_retries
+
+    async def _fetch_chunk(self, message_ids: List[str]) -> List[Dict[str, Any]]:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded(message_id):
+            async with self._slots:
+                return await self._get(message_id)
+
+        outcomes = await asyncio.gather(*(bounded(message_id) for message_id in message_ids))
+        messages = [message for message, retries in outcomes if message is not None]
+        self.stats.record_batch(len(messages), len(outcomes) - len(messages),
+                                sum(retries for message, retries in outcomes))
+        return messages
+
+    def fetch(self, message_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """Yield message resources chunk by chunk as they arrive.
+
+        IDs are pulled on the calling thread, because listing them may itself
+        go through the event loop; the next chunk is listed while the previous
+        one is being fetched.
+        """
+        ids = iter(message_ids)
+        in_flight = None
+        while True:
+            chunk = list(islice(ids, self.max_concurrency * 4))
+            submitted = asyncio.run_coroutine_threadsafe(self._fetch_chunk(chunk), self.runner.loop) \
+                if chunk else None
+            if in_flight is not None:
+                yield from in_flight.result()
+            if submitted is None:
+                break
+            in_flight = submitted
+
+    def close(self) -> None:
+        self.service.close()
+
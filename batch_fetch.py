@@ -0,0 +1,188 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from googleapiclient.errors import HttpError
+
+from metrics import METRICS
+from scheduler import RequestScheduler, is_retryable, retry_after
+
+logger = logging.getLogger(__name__)
+
+# Gmail recommends keeping batch requests at or below 50 calls
+DEFAULT_BATCH_SIZE = 50
+
+
+class AdaptiveBackoff:
+    """Delay shared by all workers that grows on throttling and decays on success."""
+
+    def __init__(self, initial_delay: float = 0.5, max_delay: float = 32.0, decay: float = 0.5):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.decay = decay
+        self.delay = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        delay = self.delay
+        if delay:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def failure(self, requested: Optional[float] = None) -> None:
+        # A Retry-After from the server takes precedence over the doubled delay
+        with self._lock:
+            self.delay = min(self.max_delay, max(self.initial_delay, self.delay * 2, requested or 0))
+
+    def success(self) -> None:
+        with self._lock:
+            self.delay = self.delay * self.decay if self.delay > self.initial_delay / 8 else 0.0
+
+
+class FetchStats:
+    def __init__(self):
+        self.messages = 0
+        self.failed = 0
+        self.batches = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record_batch(self, fetched: int, failed: int, retries: int) -> None:
+        with self._lock:
+            self.messages += fetched
+            self.failed += failed
+            self.retries += retries
+            self.batches += 1
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def messages_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.messages / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"Fetched {self.messages} emails in {self.elapsed:.1f}s "
+                f"({self.messages_per_second:.1f} msg/s, {self.batches} batches, "
+                f"{self.retries} retries, {self.failed} failed)")
+
+
+class BatchFetcher:
+    """Fetches messages with Gmail HTTP batch requests, several batches at a time.
+
+    `service_factory` must return a Gmail client that is safe to use from the
+    calling thread, such as `gmail_service.get_service`. Every batch spends its
+    quota units from the scheduler's budget, and IDs that could not be fetched
+    (other than deleted messages) are collected in `failed_ids`.
+    """
+
+    def __init__(self, service_factory: Optional[Callable[[], Any]] = None,
+                 batch_size: int = DEFAULT_BATCH_SIZE, max_workers: int = 4,
+                 max_retries: int = 5, user_id: str = 'me', backoff: Optional[AdaptiveBackoff] = None,
+                 scheduler: Optional[RequestScheduler] = None, **get_kwargs):
+        if service_factory is None:
+            from gmail_service import get_service
+            service_factory = get_service
+        self.service_factory = service_factory
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.user_id = user_id
+        self.backoff = backoff or AdaptiveBackoff()
+        self.scheduler = scheduler or RequestScheduler()
+        self.get_kwargs = get_kwargs
+        self.stats = FetchStats()
+        self.failed_ids: List[str] = []
+        self._failed_lock = threading.Lock()
+
+    def _failed(self, message_ids: List[str], error: Optional[Exception] = None) -> None:
+        # Only throttling and server errors are worth a retry; a 404 means the message was deleted meanwhile
+        if error is not None and not is_retryable(error):
+            return
+        with self._failed_lock:
+            self.failed_ids.extend(message_ids)
+
+    def fetch(self, message_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """Yield full message resources as their batches complete (in no particular order)."""
+        ids = iter(message_ids)
+        max_in_flight = self.max_workers * 2
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = set()
+            while True:
+                # Keep a bounded number of batches queued so huge ID streams stay lazy
+                while len(in_flight) < max_in_flight:
+                    chunk = list(islice(ids, self.batch_size))
+                    if not chunk:
+                        break
+                    in_flight.add(executor.submit(self._fetch_batch, chunk))
+                if not in_flight:
+                    break
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+
+    def _fetch_batch(self, message_ids: List[str]) -> List[Dict[str, Any]]:
+        service = self.service_factory()
+        results: List[Dict[str, Any]] = []
+        pending = message_ids
+        retries = 0
+        failed_for_good = 0
+
+        while pending:
+            self.backoff.wait()
+            self.scheduler.budget.spend('messages.get', len(pending))
+            retry: List[str] = []
+            requested = None
+
+            def callback(request_id, response, exception):
+                nonlocal failed_for_good, requested
+                if exception is None:
+                    results.append(response)
+                    return
+                METRICS.increment('api_errors', method='messages.get',
+                                  status=getattr(getattr(exception, 'resp', None), 'status', 'unknown'))
+                if is_retryable(exception):
+                    retry.append(request_id)
+                    requested = max(requested or 0, retry_after(exception) or 0) or None
+                else:
+                    failed_for_good += 1
+                    self._failed([request_id], exception)
+                    logger.warning("An error occurred while fetching email %s: %s", request_id, exception)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(service.users().messages().get(
+                    userId=self.user_id, id=message_id, **self.get_kwargs), request_id=message_id)
+            started = time.perf_counter()
+            try:
+                batch.execute()
+            except HttpError as error:
+                if not is_retryable(error):
+                    raise
+                retry = list(pending)
+                requested = retry_after(error)
+            finally:
+                # One batch carries many messages().get calls; the timer counts each of them
+                METRICS.observe('api_call', time.perf_counter() - started, count=len(pending),
+                                method='messages.get')
+
+            if not retry:
+                self.backoff.success()
+                break
+            self.backoff.failure(requested)
+            retries += 1
+            if retries > self.max_retries:
+                failed_for_good += len(retry)
+                self._failed(retry)
+                logger.warning("Giving up on %d emails after %d retries", len(retry), self.max_retries)
+                break
+            pending = retry
+
+        self.stats.record_batch(len(results), failed_for_good, retries)
+        return results
@@ -0,0 +1,108 @@
+"""Benchmark body extraction over a corpus of generated sample payloads.
+
+Usage:
+    python benchmarks/bench_mime.py [--messages 2000] [--workers 4]
+"""
+import argparse
+import base64
+import os.path
+import random
+import sys
+import time
+from email.message import EmailMessage
+
+# Make the modules in the repository root importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fetch import parse_email  # noqa: E402
+from mime import BodyDecoder, to_gmail_payload  # noqa: E402
+
+WORDS = ("job interview offer happy fox newsletter unsubscribe update weekly digest "
+         "congratulations selected meeting invoice café résumé").split()
+
+
+def sample_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def sample_message(rng, kind):
+    message = EmailMessage()
+    message["From"] = f"sender{rng.randrange(100)}@example.com"
+    message["Subject"] = sample_text(rng, 6)
+    message["Date"] = "Thu, 01 Jan 1970 00:00:00 +0000"
+    if kind == "plain":
+        message.set_content(sample_text(rng, 200))
+    elif kind == "latin-1":
+        message.set_content(sample_text(rng, 200), charset="latin-1")
+    elif kind == "html":
+        message.set_content("<html><body>" + "".join(
+            f"<p>{sample_text(rng, 30)}</p>" for _ in range(10)) + "</body></html>", subtype="html")
+    elif kind == "newsletter":
+        # Large multipart/alternative inside multipart/mixed, with an attachment
+        message.set_content(sample_text(rng, 3000))
+        message.add_alternative("<html><body><table>" + "".join(
+            f"<tr><td>{sample_text(rng, 50)}</td></tr>" for _ in range(200)) + "</table></body></html>",
+            subtype="html")
+        message.make_mixed()
+        message.add_attachment(rng.randbytes(20000), maintype="application", subtype="pdf", filename="a.pdf")
+    return message
+
+
+def build_corpus(count, raw=False, seed=1):
+    rng = random.Random(seed)
+    kinds = ["plain", "latin-1", "html", "newsletter"]
+    corpus = []
+    for i in range(count):
+        message = sample_message(rng, kinds[i % len(kinds)])
+        if raw:
+            corpus.append({"id": str(i), "raw": base64.urlsafe_b64encode(message.as_bytes()).decode()})
+        else:
+            corpus.append({"id": str(i), "payload": to_gmail_payload(message)})
+    return corpus
+
+
+def legacy_parse(email_details):
+    # The extraction fetch.py used before the MIME walk: first part only, UTF-8 only
+    payload = email_details.get("payload")
+    try:
+        payload = payload["parts"][0]
+    except (KeyError, IndexError, TypeError):
+        pass
+    data = payload.get("body", {}).get("data") if payload else None
+    if not data:
+        return None
+    try:
+        return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def run(name, corpus, function):
+    started = time.perf_counter()
+    results = function(corpus)
+    elapsed = time.perf_counter() - started
+    found = sum(1 for result in results if result)
+    print(f"{name:<28} {len(corpus) / elapsed:10.0f} msg/s   bodies found: {found}/{len(corpus)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MIME body extraction.")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages)
+    raw_corpus = build_corpus(args.messages, raw=True)
+
+    run("legacy parts[0]", corpus, lambda c: [legacy_parse(d) for d in c])
+    run("MIME walk (in-process)", corpus, lambda c: [parse_email(d)["message"] for d in c])
+    run("format=raw (in-process)", raw_corpus, lambda c: [parse_email(d)["message"] for d in c])
+    with BodyDecoder(parse_email, args.workers) as decoder:
+        decoder.submit(corpus[:args.workers]).result()  # start the worker processes
+        run(f"MIME walk ({args.workers} processes)", corpus,
+            lambda c: [email["message"] for email in decoder.submit(c).result()])
+        run(f"format=raw ({args.workers} processes)", raw_corpus,
+            lambda c: [email["message"] for email in decoder.submit(c).result()])
+
+
+if __name__ == "__main__":
+    main()
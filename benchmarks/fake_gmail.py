@@ -0,0 +1,195 @@
+"""In-process fake of the Gmail API client for benchmarks.
+
+Implements the googleapiclient call shapes the project uses (messages list,
+get, modify, batchModify, history.list, getProfile, watch and HTTP batches)
+over an in-memory mailbox, with injectable round-trip latency and a rate of
+429 responses.
+"""
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+class _Request:
+    def __init__(self, gmail: 'FakeGmail', handler: Callable[[], Any], throttled: bool = True):
+        self.gmail = gmail
+        self.handler = handler
+        self.throttled = throttled
+
+    def execute(self, in_batch: bool = False):
+        if not in_batch:
+            self.gmail.round_trip()
+        if self.throttled:
+            self.gmail.maybe_throttle()
+        return self.handler()
+
+
+class _Batch:
+    def __init__(self, gmail: 'FakeGmail', callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        # One HTTP round trip carries the whole batch
+        self.gmail.round_trip()
+        with self.gmail.lock:
+            self.gmail.calls['batch'] = self.gmail.calls.get('batch', 0) + 1
+        for request_id, request in self.requests:
+            try:
+                response, exception = request.execute(in_batch=True), None
+            except HttpError as error:
+                response, exception = None, error
+            self.callback(request_id, response, exception)
+
+
+class FakeGmail:
+    """A mailbox that behaves like users() of a Gmail API client.
+
+    `latency` seconds are spent on every HTTP round trip (a batch counts as
+    one) and `throttle_rate` is the fraction of calls answered with a 429.
+    """
+
+    def __init__(self, messages: List[Dict[str, Any]], latency: float = 0.0, throttle_rate: float = 0.0,
+                 retry_after: Optional[float] = None, seed: int = 1):
+        self.mailbox = {message['id']: message for message in messages}
+        self.order = [message['id'] for message in messages]
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.history_id = 1000
+        self.changes: List[Dict[str, Any]] = []
+        self.calls: Dict[str, int] = {}
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def round_trip(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def maybe_throttle(self) -> None:
+        if not self.throttle_rate:
+            return
+        with self.lock:
+            throttle = self.rng.random() < self.throttle_rate
+            if throttle:
+                self.throttled += 1
+        if throttle:
+            headers = {'status': '429'}
+            if self.retry_after is not None:
+                headers['retry-after'] = str(self.retry_after)
+            raise HttpError(httplib2.Response(headers), b'{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}')
+
+    def _request(self, method: str, handler: Callable[[], Any]) -> _Request:
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        return _Request(self, handler)
+
+    # Resource accessors, as on a googleapiclient service
+    def users(self) -> 'FakeGmail':
+        return self
+
+    def messages(self) -> '_Messages':
+        return _Messages(self)
+
+    def history(self) -> '_History':
+        return _History(self)
+
+    def getProfile(self, userId: str = 'me') -> _Request:
+        return self._request('getProfile', lambda: {'historyId': str(self.history_id),
+                                                    'messagesTotal': len(self.mailbox)})
+
+    def watch(self, userId: str = 'me', body: Optional[Dict[str, Any]] = None) -> _Request:
+        return self._request('watch', lambda: {'historyId': str(self.history_id),
+                                               'expiration': str(int((time.time() + 7 * 86400) * 1000))})
+
+    def new_batch_http_request(self, callback=None) -> _Batch:
+        return _Batch(self, callback)
+
+    # Mailbox changes, recorded in the history like Gmail does
+    def _record(self, kind: str, message: Dict[str, Any]) -> None:
+        self.history_id += 1
+        self.changes.append({'id': str(self.history_id), kind: [
+            {'message': {'id': message['id'], 'labelIds': list(message.get('labelIds', []))}}]})
+
+    def deliver(self, messages: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            for message in messages:
+                self.mailbox[message['id']] = message
+                self.order.append(message['id'])
+                self._record('messagesAdded', message)
+
+    def apply_labels(self, message_ids: List[str], add: List[str], remove: List[str]) -> None:
+        with self.lock:
+            for message_id in message_ids:
+                message = self.mailbox.get(message_id)
+                if message is None:
+                    continue
+                labels = [label for label in message.get('labelIds', []) if label not in remove]
+                message['labelIds'] = labels + [label for label in add if label not in labels]
+                if add:
+                    self._record('labelsAdded', message)
+                if remove:
+                    self._record('labelsRemoved', message)
+
+
+class _Messages:
+    def __init__(self, gmail: FakeGmail):
+        self.gmail = gmail
+
+    def list(self, userId: str = 'me', labelIds=None, q=None, maxResults: int = 100, pageToken=None, **kwargs):
+        def handler():
+            with self.gmail.lock:
+                ids = [message_id for message_id in self.gmail.order
+                       if not labelIds or set(labelIds) & set(self.gmail.mailbox[message_id].get('labelIds', []))]
+            start = int(pageToken or 0)
+            page = {'messages': [{'id': message_id} for message_id in ids[start:start + maxResults]],
+                    'resultSizeEstimate': len(ids)}
+            if start + maxResults < len(ids):
+                page['nextPageToken'] = str(start + maxResults)
+            return page
+        return self.gmail._request('messages.list', handler)
+
+    def get(self, userId: str = 'me', id: str = '', format: str = 'full', **kwargs):
+        def handler():
+            message = self.gmail.mailbox.get(id)
+            if message is None:
+                raise HttpError(httplib2.Response({'status': '404'}), b'notFound')
+            if format == 'metadata':
+                return dict(message, payload={'headers': message['payload']['headers']})
+            return message
+        return self.gmail._request('messages.get', handler)
+
+    def modify(self, userId: str = 'me', id: str = '', body: Optional[Dict[str, Any]] = None):
+        body = body or {}
+        return self.gmail._request('messages.modify', lambda: self.gmail.apply_labels(
+            [id], body.get('addLabelIds', []), body.get('removeLabelIds', [])) or {'id': id})
+
+    def batchModify(self, userId: str = 'me', body: Optional[Dict[str, Any]] = None):
+        body = body or {}
+        return self.gmail._request('messages.batchModify', lambda: self.gmail.apply_labels(
+            body.get('ids', []), body.get('addLabelIds', []), body.get('removeLabelIds', [])) or {})
+
+
+class _History:
+    def __init__(self, gmail: FakeGmail):
+        self.gmail = gmail
+
+    def list(self, userId: str = 'me', startHistoryId=None, pageToken=None, maxResults: int = 500, **kwargs):
+        def handler():
+            with self.gmail.lock:
+                records = [record for record in self.gmail.changes if int(record['id']) > int(startHistoryId)]
+            start = int(pageToken or 0)
+            page = {'history': records[start:start + maxResults], 'historyId': str(self.gmail.history_id)}
+            if start + maxResults < len(records):
+                page['nextPageToken'] = str(start + maxResults)
+            return page
+        return self.gmail._request('history.list', handler)
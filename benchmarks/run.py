@@ -0,0 +1,248 @@
+"""Benchmark scenarios against a synthetic mailbox and the in-process fake Gmail.
+
+Scenarios:
+    fetch       messages/s fetched with batch requests (round-trip latency and 429s injected)
+    ingest      emails/s parsed and written to SQLite
+    bodies      database size, SELECT * scan rate and rule evaluation rate with plain vs compressed bodies
+    rules       emails/s evaluated, for each rule-set size
+    bitmaps     predicate bitmap cache: cold build, incremental refresh and warm rule resolution
+    end_to_end  actions/s for a full sync followed by rule evaluation and batchModify
+
+Usage:
+    python benchmarks/run.py [--messages 2000] [--scenario fetch ...]
+    python benchmarks/run.py --save-baseline          # record benchmarks/baselines/default.json
+    python benchmarks/run.py --compare                # exit 1 when a rate fell below the baseline
+"""
+import argparse
+import json
+import logging
+import os.path
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+# Make the modules in the repository root importable
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+from actions import ActionAccumulator  # noqa: E402
+from batch_fetch import AdaptiveBackoff, BatchFetcher  # noqa: E402
+from fake_gmail import FakeGmail  # noqa: E402
+from fetch import fetch_options, parse_email, sync_mailbox  # noqa: E402
+from gmailops import RuleCollection, process_emails  # noqa: E402
+from metrics import METRICS  # noqa: E402
+from predicate_cache import PredicateCache  # noqa: E402
+from rule_engine import CompiledRuleSet  # noqa: E402
+from rule_sql import select_candidates  # noqa: E402
+from scheduler import QuotaBudget, RequestScheduler  # noqa: E402
+from storage import BODY_CODECS, EmailStore  # noqa: E402
+from synthetic_mailbox import MailboxSpec, generate_mailbox, generate_rules  # noqa: E402
+
+BASELINE = os.path.join(BENCHMARKS_DIR, 'baselines', 'default.json')
+SCENARIOS = ['fetch', 'ingest', 'bodies', 'rules', 'bitmaps', 'end_to_end']
+
+
+def unpaced_scheduler() -> RequestScheduler:
+    # The fake has no quota, so only the injected 429s slow requests down
+    return RequestScheduler(QuotaBudget(units_per_second=None), base_delay=0.01, max_delay=0.1)
+
+
+def make_fetcher(gmail: FakeGmail, **get_kwargs) -> BatchFetcher:
+    return BatchFetcher(lambda: gmail, scheduler=unpaced_scheduler(),
+                        backoff=AdaptiveBackoff(initial_delay=0.01, max_delay=0.1), **get_kwargs)
+
+
+def make_rules(count: int) -> List[RuleCollection]:
+    return [RuleCollection(data, source=f'benchmark/{index}.json')
+            for index, data in enumerate(generate_rules(count))]
+
+
+def timed(function: Callable[[], Any]):
+    started = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - started
+
+
+def bench_fetch(messages, args) -> Dict[str, float]:
+    gmail = FakeGmail(messages, latency=args.latency, throttle_rate=args.throttle_rate, retry_after=0)
+    fetcher = make_fetcher(gmail, **fetch_options())
+    fetched, elapsed = timed(lambda: sum(1 for _ in fetcher.fetch(list(gmail.order))))
+    return {'fetch.messages_per_second': fetched / elapsed}
+
+
+def bench_ingest(messages, args) -> Dict[str, float]:
+    emails = [parse_email(details) for details in messages]
+    with tempfile.TemporaryDirectory() as directory, EmailStore(os.path.join(directory, 'bench.db')) as store:
+        def ingest():
+            for start in range(0, len(emails), 500):
+                store.store_emails(emails[start:start + 500])
+        _, elapsed = timed(ingest)
+    return {'ingest.emails_per_second': len(emails) / elapsed}
+
+
+def bench_bodies(messages, args) -> Dict[str, float]:
+    results, sizes = {}, {}
+    emails = [parse_email(details) for details in messages]
+    rules = make_rules(10)
+    for codec in [None] + BODY_CODECS:
+        name = codec or 'plain'
+        with tempfile.TemporaryDirectory() as directory, EmailStore(os.path.join(directory, 'bench.db')) as store:
+            if codec:
+                store.set_body_compression(codec)
+            store.store_emails(emails)
+            store.conn.execute('VACUUM')
+            sizes[name] = store.conn.execute('SELECT page_count * page_size FROM pragma_page_count, '
+                                             'pragma_page_size').fetchone()[0]
+            rows, elapsed = timed(lambda: len(store.conn.execute('SELECT * FROM emails').fetchall()))
+            results[f'bodies.{name}.scan_rows_per_second'] = rows / elapsed
+            accumulator = ActionAccumulator(FakeGmail(messages), scheduler=unpaced_scheduler())
+            _, elapsed = timed(lambda: process_emails(store.conn, rules, accumulator, reprocess=True))
+            results[f'bodies.{name}.rules_emails_per_second'] = len(emails) / elapsed
+        if codec:
+            # Higher is better, like every other result: plain database size over compressed size
+            results[f'bodies.{name}.size_ratio'] = sizes['plain'] / sizes[name]
+    return results
+
+
+def bench_rules(messages, args) -> Dict[str, float]:
+    results = {}
+    gmail = FakeGmail(messages)
+    emails = [parse_email(details) for details in messages]
+    with tempfile.TemporaryDirectory() as directory, EmailStore(os.path.join(directory, 'bench.db')) as store:
+        store.store_emails(emails)
+        for size in args.rule_sets:
+            rules = make_rules(size)
+            accumulator = ActionAccumulator(gmail, scheduler=unpaced_scheduler())
+            # Reprocessing evaluates every email again instead of skipping ledger entries
+            _, elapsed = timed(lambda: process_emails(store.conn, rules, accumulator, reprocess=True,
+                                                    workers=args.eval_workers))
+            results[f'rules.{size}.emails_per_second'] = len(emails) / elapsed
+            # The compiled rule set alone, without the action and ledger row every match adds
+            candidates = list(select_candidates(store.conn, rules))
+            engine = CompiledRuleSet(rules)
+            _, elapsed = timed(lambda: [engine.match(email) for email in candidates])
+            results[f'rules.{size}.match_emails_per_second'] = len(candidates) / elapsed
+    return results
+
+
+def bench_bitmaps(messages, args) -> Dict[str, float]:
+    emails = [parse_email(details) for details in messages]
+    # One email in a hundred arrives after the cache was built
+    cut = len(emails) - max(1, len(emails) // 100)
+    rules = make_rules(max(args.rule_sets))
+    with tempfile.TemporaryDirectory() as directory, EmailStore(os.path.join(directory, 'bench.db')) as store:
+        store.store_emails(emails[:cut])
+        cache = PredicateCache(store.conn)
+        _, cold = timed(lambda: [cache.match(rule) for rule in rules])
+        store.store_emails(emails[cut:])
+        cache = PredicateCache(store.conn)
+        _, incremental = timed(lambda: [cache.match(rule) for rule in rules])
+        # Rules built from predicates the cache already knows
+        cache, new_rules = PredicateCache(store.conn), make_rules(len(rules))
+        _, warm = timed(lambda: [cache.match(rule) for rule in new_rules])
+    return {'bitmaps.cold.emails_per_second': cut / cold,
+            'bitmaps.incremental.emails_per_second': (len(emails) - cut) / incremental,
+            'bitmaps.warm.rules_per_second': len(rules) / warm}
+
+
+def bench_end_to_end(messages, args) -> Dict[str, float]:
+    gmail = FakeGmail(messages, latency=args.latency, throttle_rate=args.throttle_rate, retry_after=0)
+    rules = make_rules(10)
+    fetcher = make_fetcher(gmail, **fetch_options(rules))
+    with tempfile.TemporaryDirectory() as directory, EmailStore(os.path.join(directory, 'bench.db')) as store:
+        def run():
+            sync_mailbox(fetcher=fetcher, store=store)
+            accumulator = ActionAccumulator(gmail, scheduler=unpaced_scheduler())
+            return process_emails(store.conn, rules, accumulator)
+        actions, elapsed = timed(run)
+    return {'end_to_end.actions_per_second': actions / elapsed,
+            'end_to_end.messages_per_second': len(messages) / elapsed}
+
+
+BENCHMARKS = {'fetch': bench_fetch, 'ingest': bench_ingest, 'bodies': bench_bodies, 'rules': bench_rules,
+              'bitmaps': bench_bitmaps, 'end_to_end': bench_end_to_end}
+
+
+def run(args) -> Dict[str, Any]:
+    spec = MailboxSpec(messages=args.messages, seed=args.seed)
+    messages = generate_mailbox(spec, now=time.time())
+    results: Dict[str, float] = {}
+    for name in args.scenario or SCENARIOS:
+        # The best of several repeats is the least disturbed by other load on the machine
+        best: Dict[str, float] = {}
+        for _ in range(args.repeat):
+            METRICS.reset()
+            for metric, value in BENCHMARKS[name](messages, args).items():
+                best[metric] = max(best.get(metric, 0.0), value)
+        results.update({metric: round(value, 1) for metric, value in best.items()})
+    return {'config': {'messages': args.messages, 'seed': args.seed, 'latency': args.latency,
+                       'throttle_rate': args.throttle_rate, 'rule_sets': args.rule_sets,
+                       'eval_workers': args.eval_workers},
+            'python': platform.python_version(), 'results': results}
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Return a line per rate that dropped more than `tolerance` below the baseline."""
+    regressions = []
+    for metric, expected in baseline['results'].items():
+        actual = report['results'].get(metric)
+        if actual is None or not expected:
+            continue
+        change = actual / expected - 1
+        line = f"{metric:<40} {expected:>12.1f} -> {actual:>12.1f}  ({change:+.1%})"
+        print(line)
+        if change < -tolerance:
+            regressions.append(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark scenarios.")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="Run only this scenario (repeatable, default: all)")
+    parser.add_argument("--messages", type=int, default=2000, help="Size of the synthetic mailbox")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.005, help="Seconds per fake HTTP round trip")
+    parser.add_argument("--throttle-rate", type=float, default=0.01, help="Fraction of calls answered with a 429")
+    parser.add_argument("--rule-sets", type=int, nargs="+", default=[1, 10, 100],
+                        help="Rule-set sizes for the rules scenario")
+    parser.add_argument("--eval-workers", type=int, default=0,
+                        help="Worker processes evaluating rules in the rules scenario (default: 0, in-process)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repeats per scenario; the best one is kept")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE, default=None,
+                        help=f"Save the results as the baseline (default: {os.path.relpath(BASELINE)})")
+    parser.add_argument("--compare", nargs="?", const=BASELINE, default=None,
+                        help="Compare the results with a saved baseline and exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed drop below the baseline before it counts as a regression (default: 0.25)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    report = run(args)
+    for metric, value in report['results'].items():
+        print(f"{metric:<40} {value:>12.1f}")
+    for path in filter(None, [args.output, args.save_baseline]):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f"Results saved to {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['config'] != report['config']:
+            print(f"Warning: baseline was recorded with {baseline['config']}")
+        print(f"\nCompared with {args.compare}:")
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            print("\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Synthetic mailboxes for the benchmarks: Gmail API message resources with reproducible content."""
+import base64
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+WORDS = ("job interview offer happy fox newsletter unsubscribe update weekly digest congratulations "
+         "selected meeting invoice payment receipt order shipped delivery team project review schedule "
+         "reminder account security alert password welcome thanks report summary sale discount").split()
+
+SUBJECTS = ["Your weekly digest", "Interview schedule", "Invoice {n}", "Order {n} has shipped",
+            "Happy Fox update", "Meeting reminder", "Security alert", "Job offer", "Project review {n}"]
+
+
+class MailboxSpec:
+    """Shape of a generated mailbox.
+
+    `body_words` is the (min, max) body length in words, `sender_skew` the
+    Zipf exponent of the sender distribution (0 makes senders uniform) and
+    `days` how far back the Date headers are spread.
+    """
+
+    def __init__(self, messages: int = 10000, body_words: Tuple[int, int] = (20, 400), senders: int = 200,
+                 sender_skew: float = 1.1, days: int = 365, seed: int = 1):
+        self.messages = messages
+        self.body_words = body_words
+        self.senders = senders
+        self.sender_skew = sender_skew
+        self.days = days
+        self.seed = seed
+
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode()).decode('ascii').rstrip('=')
+
+
+def generate_mailbox(spec: MailboxSpec, now: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Return `spec.messages` full-format message resources, newest IDs last."""
+    rng = random.Random(spec.seed)
+    now = now if now is not None else time.time()
+    domains = ["example.com", "happyfox.com", "mail.example.org", "shop.example.net", "jobs.example.io"]
+    senders = [f"sender{i}@{domains[i % len(domains)]}" for i in range(spec.senders)]
+    weights = [1 / (rank + 1) ** spec.sender_skew for rank in range(spec.senders)]
+
+    messages = []
+    for i, sender in enumerate(rng.choices(senders, weights, k=spec.messages)):
+        sent = now - rng.uniform(0, spec.days * 86400)
+        subject = rng.choice(SUBJECTS).format(n=rng.randrange(100000))
+        body = " ".join(rng.choice(WORDS) for _ in range(rng.randint(*spec.body_words)))
+        messages.append({
+            "id": f"{i:016x}",
+            "threadId": f"{i // 3:016x}",
+            "labelIds": ["INBOX", "UNREAD"] if rng.random() < 0.3 else ["INBOX"],
+            "internalDate": str(int(sent * 1000)),
+            "payload": {
+                "mimeType": "text/plain",
+                "filename": "",
+                "headers": [{"name": "From", "value": sender},
+                            {"name": "Subject", "value": subject},
+                            {"name": "Date", "value": format_datetime(datetime.fromtimestamp(sent, timezone.utc))}],
+                "body": {"size": len(body), "data": _b64(body)},
+            },
+        })
+    return messages
+
+
+def generate_rules(count: int, seed: int = 1) -> List[Dict[str, Any]]:
+    """Rule files in the rules/*.json format, mixing header, body and date predicates."""
+    rng = random.Random(seed)
+    predicates = [("From", "contains"), ("Subject", "contains"), ("Message", "contains"),
+                  ("Subject", "does not contain"), ("From", "equals")]
+    rules = []
+    for i in range(count):
+        conditions = []
+        for _ in range(rng.randint(1, 3)):
+            field, predicate = rng.choice(predicates)
+            value = f"sender{rng.randrange(200)}@example.com" if predicate == "equals" else rng.choice(WORDS)
+            conditions.append({"field": field, "predicate": predicate, "value": value})
+        if rng.random() < 0.2:
+            conditions.append({"field": "Received Date/Time", "predicate": "less than",
+                               "value": f"{rng.randint(1, 90)} D"})
+        rules.append({"rule_name": f"Rule {i}", "rule_type": rng.choice(["all", "any"]), "rules": conditions,
+                      "actions": [{"action_type": "mark", "action_value": "read"}]})
+    return rules
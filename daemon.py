@@ -0,0 +1,349 @@
+import argparse
+import base64
+import json
+import logging
+import os.path
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+from actions import ActionAccumulator
+from batch_fetch import BatchFetcher
+from fetch import fetch_options, history_state_key, sync_mailbox
+from gmail_service import get_service
+from gmailops import load_rule_collections, process_emails
+from labels import LabelCatalog, resolve_labels
+from metrics import METRICS, MetricsServer, add_arguments, configure_logging, profiled
+from rule_engine import CompiledRuleSet
+from scheduler import RequestScheduler, RetryQueue, backoff_delay
+from storage import DATABASE, EmailStore
+
+logger = logging.getLogger(__name__)
+
+# Gmail stops pushing to the topic seven days after watch(); renew a day early
+WATCH_RENEW_MARGIN = 24 * 60 * 60
+# Longest wait after consecutive failed syncs or watch renewals
+FAILURE_MAX_DELAY = 300.0
+
+
+class NotificationSource:
+    """Tells the daemon when the mailbox may have changed.
+
+    `wait` blocks until a notification arrives and returns it as a dict, or
+    returns None once the source is closed. Several notifications that arrive
+    while the daemon is busy are coalesced into one.
+    """
+
+    def start(self) -> None:
+        pass
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class HistoryPollSource(NotificationSource):
+    """Reports a possible change every `interval` seconds; the sync then asks history.list."""
+
+    def __init__(self, interval: float = 60.0):
+        self.interval = interval
+        self._closed = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        if self._closed.wait(self.interval if timeout is None else min(timeout, self.interval)):
+            return None
+        return {'source': 'poll'}
+
+    def close(self) -> None:
+        self._closed.set()
+
+
+class PushSource(NotificationSource):
+    """Receives Gmail watch() notifications pushed by a Pub/Sub push subscription.
+
+    Pub/Sub POSTs a JSON envelope whose message.data is the base64 encoded
+    {"emailAddress": ..., "historyId": ...} Gmail published. When `token` is
+    set, requests must carry it as a ?token= query parameter, which is how
+    push endpoints are usually authenticated.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8080, path: str = '/gmail/push',
+                 token: Optional[str] = None):
+        self.path = path
+        self.token = token
+        self._queue: 'queue.Queue[Optional[Dict[str, Any]]]' = queue.Queue()
+        self._closed = False
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def _handler_class(self):
+        source = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != source.path:
+                    self.send_response(404)
+                elif source.token and parse_qs(url.query).get('token') != [source.token]:
+                    self.send_response(403)
+                else:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    notification = parse_push_message(self.rfile.read(length))
+                    if notification is None:
+                        self.send_response(400)
+                    else:
+                        source._queue.put(notification)
+                        # Any 2xx acknowledges the message so Pub/Sub does not redeliver it
+                        self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        try:
+            notification = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return {'source': 'timeout'}
+        # Coalesce everything that queued up; one history sync covers all of it
+        while notification is not None:
+            try:
+                newer = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if newer is None or int(newer.get('historyId') or 0) >= int(notification.get('historyId') or 0):
+                notification = newer
+        return notification
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self.server.shutdown()
+            self.server.server_close()
+            self._queue.put(None)
+
+
+def parse_push_message(body: bytes) -> Optional[Dict[str, Any]]:
+    """Decode a Pub/Sub push envelope into Gmail's notification, or None if it is malformed."""
+    try:
+        message = json.loads(body)['message']
+        data = json.loads(base64.b64decode(message['data']))
+    except (ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(data, dict) or 'historyId' not in data:
+        return None
+    return {'source': 'push', 'emailAddress': data.get('emailAddress'),
+            'historyId': str(data['historyId']), 'messageId': message.get('messageId')}
+
+
+class Daemon:
+    """Keeps the Gmail client, compiled rules and database open between syncs.
+
+    Every notification runs an incremental history sync followed by rule
+    processing of whatever changed. Rule files are reloaded when they change
+    on disk, and with a Pub/Sub `topic` the Gmail watch is renewed before it
+    expires.
+    """
+
+    def __init__(self, rule_paths: List[str], source: NotificationSource, db_path: str = DATABASE,
+                 label_ids=('INBOX',), service_factory=None, topic: Optional[str] = None,
+                 chunk_size: int = 500, accumulator: Optional[ActionAccumulator] = None,
+                 create_labels: bool = False):
+        self.rule_paths = rule_paths
+        self.source = source
+        self.label_ids = list(label_ids) if label_ids else None
+        self.service_factory = service_factory or get_service
+        self.topic = topic
+        self.chunk_size = chunk_size
+        self.create_labels = create_labels
+        # One scheduler paces and retries every call the daemon makes
+        self.scheduler = RequestScheduler()
+        self.accumulator = accumulator or ActionAccumulator(self.service_factory(), scheduler=self.scheduler)
+        self.db_path = db_path
+        self.store: Optional[EmailStore] = None
+        self.labels: Optional[LabelCatalog] = None
+        self.watch_expiration: Optional[float] = None
+        self._rule_mtimes: Dict[str, float] = {}
+        self._stopped = threading.Event()
+        self._failures = 0
+        self.load_rules()
+
+    def _rule_files(self) -> List[str]:
+        files = []
+        for path in self.rule_paths:
+            if os.path.isdir(path):
+                files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                             if name.endswith('.json'))
+            else:
+                files.append(path)
+        return files
+
+    def _current_mtimes(self) -> Dict[str, float]:
+        mtimes = {}
+        for path in self._rule_files():
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                continue
+        return mtimes
+
+    def load_rules(self) -> None:
+        self._rule_mtimes = self._current_mtimes()
+        self.rules = load_rule_collections(self.rule_paths)
+        self.engine = CompiledRuleSet(self.rules)
+        self.fetcher = BatchFetcher(self.service_factory, scheduler=self.scheduler, **fetch_options(self.rules))
+        self._labels_resolved = False
+
+    def reload_rules_if_changed(self) -> bool:
+        changed = self._current_mtimes() != self._rule_mtimes
+        if changed:
+            logger.info('Rule files changed, reloading.')
+            self.load_rules()
+        # Move targets are checked once per load of the rules, as soon as the label catalog is open,
+        # and again every cycle while some of them have no label
+        if not self._labels_resolved and self.labels is not None:
+            self._labels_resolved = not resolve_labels(self.rules, self.labels, create=self.create_labels)
+        return changed
+
+    def renew_watch(self, now: Optional[float] = None) -> None:
+        if not self.topic:
+            return
+        now = time.time() if now is None else now
+        if self.watch_expiration is not None and self.watch_expiration - now > WATCH_RENEW_MARGIN:
+            return
+        body = {'topicName': self.topic}
+        if self.label_ids:
+            body.update(labelIds=self.label_ids, labelFilterBehavior='include')
+        response = self.scheduler.execute(self.service_factory().users().watch(userId='me', body=body), 'watch')
+        self.watch_expiration = int(response['expiration']) / 1000
+        logger.info('Watching the mailbox from history ID %s.', response.get('historyId'))
+
+    def is_stale(self, notification: Dict[str, Any]) -> bool:
+        # A push for a history ID the last sync already covered needs no work
+        history_id = notification.get('historyId')
+        synced = self.store.get_sync_state(history_state_key(self.label_ids))
+        return bool(history_id and synced and int(history_id) <= int(synced))
+
+    def open(self) -> None:
+        # The connection is opened on the thread that uses it
+        self.store = EmailStore(self.db_path)
+        self.labels = LabelCatalog(self.store.conn, self.service_factory(), self.scheduler)
+        if self.accumulator.retry_queue is None:
+            self.accumulator.retry_queue = RetryQueue(self.store.conn)
+
+    def run_once(self, now: Optional[float] = None) -> int:
+        """Sync the mailbox, apply the rules to what changed and return the number of matches.
+
+        Date rules are decided against `now` (default: the current time), taken afresh every cycle.
+        """
+        now = time.time() if now is None else now
+        with METRICS.timer('stage', stage='daemon_cycle'):
+            self.reload_rules_if_changed()
+            sync_mailbox(self.label_ids, chunk_size=self.chunk_size, fetcher=self.fetcher, store=self.store)
+            return process_emails(self.store.conn, self.rules, self.accumulator, engine=self.engine, now=int(now))
+
+    def _attempt(self, step) -> bool:
+        """Run a step of the loop; failures are logged and backed off instead of stopping the daemon."""
+        try:
+            step()
+        except Exception as error:
+            logger.exception('%s failed: %s', step.__name__, error)
+            self._stopped.wait(backoff_delay(self._failures, max_delay=FAILURE_MAX_DELAY))
+            self._failures += 1
+            return False
+        self._failures = 0
+        return True
+
+    def run(self, max_wait: float = 3600.0) -> None:
+        """Process notifications until stop() is called.
+
+        Besides notifications, a sync runs at least every `max_wait` seconds so
+        a lost push only delays processing.
+        """
+        self.open()
+        self.source.start()
+        try:
+            # The first watch and sync are retried until they succeed, later ones on the next notification
+            while not self._stopped.is_set() and not (self._attempt(self.renew_watch)
+                                                      and self._attempt(self.run_once)):
+                continue
+            while not self._stopped.is_set():
+                notification = self.source.wait(timeout=max_wait)
+                if notification is None:
+                    break
+                METRICS.increment('notifications', source=notification.get('source'))
+                self._attempt(self.renew_watch)
+                if self.is_stale(notification):
+                    continue
+                self._attempt(self.run_once)
+        finally:
+            self.source.close()
+            self.store.close()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep syncing the mailbox and applying rules as changes arrive.")
+    parser.add_argument("rules", nargs="*", default=["./rules"],
+                        help="Rule files or directories (default: ./rules)")
+    parser.add_argument("--label", dest="labels", action="append",
+                        help="Only sync emails with this label ID (repeatable, default: INBOX)")
+    parser.add_argument("--all", action="store_true",
+                        help="Sync emails regardless of their labels")
+    parser.add_argument("--poll", type=float, default=60.0,
+                        help="Seconds between history polls when not using push (default: 60)")
+    parser.add_argument("--topic", default=None,
+                        help="Pub/Sub topic for Gmail watch(); enables the push endpoint")
+    parser.add_argument("--push-host", default="127.0.0.1")
+    parser.add_argument("--push-port", type=int, default=8080)
+    parser.add_argument("--push-path", default="/gmail/push")
+    parser.add_argument("--push-token", default=None,
+                        help="Shared secret the push subscription sends as ?token=")
+    parser.add_argument("--create-labels", action="store_true",
+                        help="Create the labels move actions name that do not exist yet")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this port at /metrics (and /metrics.json)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    if args.topic:
+        source = PushSource(args.push_host, args.push_port, args.push_path, args.push_token)
+    else:
+        source = HistoryPollSource(args.poll)
+    daemon = Daemon(args.rules, source, label_ids=None if args.all else (args.labels or ['INBOX']),
+                    topic=args.topic, create_labels=args.create_labels)
+    metrics_server = MetricsServer(port=args.metrics_port).start() if args.metrics_port else None
+    try:
+        with profiled(args.profile):
+            daemon.run(max_wait=args.poll if not args.topic else 3600.0)
+    except KeyboardInterrupt:
+        daemon.stop()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        if args.metrics_json:
+            METRICS.write_json(args.metrics_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Any, Optional
+
+# Tried in order when the RFC 2822 parser gives up on a Date header
+DATE_FORMATS = ["%a, %d %b %Y %H:%M:%S %z",
+                "%d %b %Y %H:%M:%S %z",
+                "%a, %d %b %Y %H:%M %z",
+                "%Y-%m-%dT%H:%M:%S%z"]
+
+# Trailing comments such as "(UTC)" or "(Pacific Standard Time)"
+_COMMENT = re.compile(r"\s*\([^)]*\)\s*$")
+
+
+@lru_cache(maxsize=65536)
+def parse_email_date(date_str: Optional[str]) -> Optional[datetime]:
+    """Parse an email Date header into an aware datetime, or None if it cannot be parsed."""
+    if not date_str:
+        return None
+    date_str = _COMMENT.sub("", date_str.strip())
+    try:
+        parsed = parsedate_to_datetime(date_str)
+    except (TypeError, ValueError, IndexError):
+        parsed = None
+        for date_format in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(date_str, date_format)
+                break
+            except ValueError:
+                continue
+    if parsed is not None and parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def email_timestamp(date_header: Optional[str], internal_date: Optional[Any] = None) -> Optional[int]:
+    """Normalize an email's Date header to epoch seconds, falling back to Gmail's internalDate."""
+    parsed = parse_email_date(date_header)
+    if parsed is not None:
+        return int(parsed.timestamp())
+    if internal_date:
+        return int(internal_date) // 1000
+    return None
+
+
+def date_window(value: str) -> Optional[int]:
+    """Length in seconds of a "<number> D" or "<number> M" rule value, or None if invalid."""
+    try:
+        num, unit = value.split()
+        num = int(num)
+    except (AttributeError, ValueError):
+        return None
+    if unit == "D":
+        days = num
+    elif unit == "M":
+        days = num * 30
+    else:
+        return None
+    return int(timedelta(days=days).total_seconds())
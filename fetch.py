@@ -1,163 +1,360 @@
 from __future__ import print_function
+import argparse
+import logging
 import sqlite3
-import os.path
+from typing import Dict, List
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import base64
-# Define the Gmail API scope so we can read emails, move emails, add or remove labels, and mark as read, unread
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
-
-def authenticate_gmail():
-    creds = None
-
-    # The file token.json stores the user's access and refresh tokens and is created
-    # automatically during the initial authorization.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-
-    return creds
-
-
-def fetch_emails_with_details():
+from async_gmail import AsyncFetcher, AsyncGmailClient
+from batch_fetch import BatchFetcher
+# Re-exported: these lived here before gmail_service.py, and scripts still import them from fetch
+from gmail_service import SCOPES, authenticate_gmail, get_service  # noqa: F401
+from gmailops import load_rule_collections
+from metrics import METRICS, add_arguments, configure_logging, profiled
+from mime import BodyDecoder, extract_body, parse_raw_message
+from scheduler import RetryQueue
+from storage import BODY_CODECS, DATABASE, EmailStore
+
+
+logger = logging.getLogger(__name__)
+
+# Headers the rules can look at; everything else in a metadata response is dropped
+METADATA_HEADERS = ['From', 'Subject', 'Date']
+MESSAGE_FIELDS = 'id,threadId,labelIds,internalDate'
+
+
+def fetch_options(rule_collections=None):
+    """Return the messages().get arguments for the smallest response the rules can work with.
+
+    Without rules, or when a rule looks at Message, full payloads are needed;
+    otherwise only the From/Subject/Date headers are requested.
+    """
+    if rule_collections is not None and not any(
+            rule.field == "Message" for rule_collection in rule_collections for rule in rule_collection.rules):
+        return {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS,
+                'fields': MESSAGE_FIELDS + ',payload/headers'}
+    return {'format': 'full', 'fields': MESSAGE_FIELDS + ',payload'}
+
+
+def parse_email(email_details):
+    # Extract desired fields
+    from_address = None
+    subject = None
+    received_datetime = None
+
+    if 'raw' in email_details:
+        # format=raw: let the stdlib email parser handle headers and MIME structure
+        headers, message_text = parse_raw_message(email_details['raw'])
+        from_address, subject, received_datetime = headers['From'], headers['Subject'], headers['Date']
+    else:
+        headers = email_details.get('payload', {}).get('headers', [])
+        for header in headers:
+            if header['name'] == 'From':
+                from_address = header['value']
+            elif header['name'] == 'Subject':
+                subject = header['value']
+            elif header['name'] == 'Date':
+                received_datetime = header['value']
+
+        # Walk the whole MIME tree for the best text part, whatever its charset
+        message_text = extract_body(email_details.get('payload'))
+
+    return {
+        'id': email_details['id'],
+        'from': from_address,
+        'subject': subject,
+        'message': message_text,
+        'received_datetime': received_datetime,
+        'labels': email_details.get('labelIds', []),
+        'thread_id': email_details.get('threadId'),
+        'internal_date': email_details.get('internalDate')
+    }
+
+
+def _execute(request, method, scheduler=None):
+    return scheduler.execute(request, method) if scheduler is not None else request.execute()
+
+
+def list_message_ids(service, label_ids=None, q=None, page_size=500, scheduler=None):
+    # Page through every matching message instead of stopping at the first page
+    page_token = None
+    while True:
+        results = _execute(service.users().messages().list(
+            userId='me', labelIds=label_ids, q=q, maxResults=page_size,
+            pageToken=page_token), 'messages.list', scheduler)
+        for message in results.get('messages', []):
+            yield message['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+
+def fetch_email_chunks(message_ids, chunk_size=500, fetcher=None, decoder=None):
+    """Fetch details for a stream of message IDs and yield parsed emails in chunks.
+
+    With a BodyDecoder backed by worker processes, each chunk is decoded in the
+    background while the next one is being fetched.
+    """
+    fetcher = fetcher or BatchFetcher()
+    decoder = decoder or BodyDecoder(parse_email)
+    bodies_fetched = fetcher.get_kwargs.get('format') != 'metadata'
+
+    def submit(chunk):
+        METRICS.increment('messages_fetched', len(chunk))
+        with METRICS.timer('stage', stage='decode'):
+            return decoder.submit(chunk)
+
+    def finish(pending):
+        with METRICS.timer('stage', stage='decode'):
+            emails = pending.result()
+        for email_info in emails:
+            email_info['body_fetched'] = bodies_fetched
+        return emails
+
+    in_progress = None
+    chunk = []
+    for email_details in METRICS.timed(fetcher.fetch(message_ids), 'stage', stage='fetch'):
+        chunk.append(email_details)
+        if len(chunk) >= chunk_size:
+            if in_progress is not None:
+                yield finish(in_progress)
+            in_progress = submit(chunk)
+            chunk = []
+    if in_progress is not None:
+        yield finish(in_progress)
+    if chunk:
+        yield finish(submit(chunk))
+    logger.info('%s', fetcher.stats)
+
+
+def fetch_emails_with_details(label_ids=('INBOX',), q=None, chunk_size=500, fetcher=None, decoder=None):
+    """Yield lists of parsed emails, at most `chunk_size` at a time.
+
+    Message IDs are listed lazily page by page and their details fetched with
+    concurrent batch requests, so memory use does not grow with the mailbox.
+    """
+    fetcher = fetcher or BatchFetcher()
+    service = fetcher.service_factory()
+    label_ids = list(label_ids) if label_ids else None
+    yield from fetch_email_chunks(list_message_ids(service, label_ids, q, scheduler=fetcher.scheduler),
+                                  chunk_size, fetcher, decoder)
+
+
+def list_history_changes(service, start_history_id, label_ids=None, scheduler=None):
+    """Return (added IDs, {relabelled ID: label IDs}, deleted IDs, latest history ID).
+
+    Added messages are limited to `label_ids`; relabelled ones are not, so the
+    caller can drop stored messages whose labels no longer include any of them.
+
+    Raises HttpError with status 404 when the start history ID is too old.
+    """
+    added, relabelled, deleted = set(), {}, set()
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        results = _execute(service.users().history().list(
+            userId='me', startHistoryId=start_history_id, pageToken=page_token,
+            historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']),
+            'history.list', scheduler)
+        for record in results.get('history', []):
+            for item in record.get('messagesDeleted', []):
+                message_id = item['message']['id']
+                deleted.add(message_id)
+                added.discard(message_id)
+                relabelled.pop(message_id, None)
+            for key in ('messagesAdded', 'labelsAdded', 'labelsRemoved'):
+                for item in record.get(key, []):
+                    message = item['message']
+                    if message['id'] in deleted:
+                        continue
+                    if key != 'messagesAdded':
+                        # Kept whatever the labels: losing the synced label is how a message leaves the sync
+                        relabelled[message['id']] = message.get('labelIds', [])
+                    elif not label_ids or set(label_ids) & set(message.get('labelIds', [])):
+                        added.add(message['id'])
+        latest_history_id = results.get('historyId', latest_history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    return added, relabelled, deleted, latest_history_id
+
+
+def history_state_key(label_ids):
+    return 'history_id:' + (','.join(sorted(label_ids)) if label_ids else '*')
+
+
+def sync_mailbox(label_ids=('INBOX',), q=None, chunk_size=500, db_path=DATABASE, fetcher=None,
+                 full=False, decoder=None, store=None):
+    """Sync the selected emails into the database and return how many were stored.
+
+    When a previous sync of the same labels saved a historyId, only messages
+    added, deleted or relabelled since then are fetched. A search query
+    cannot be applied to history records, so syncs with `q` are always full.
+    An open EmailStore can be passed in to reuse its connection.
+
+    Messages that could not be fetched are kept in the retry queue and
+    fetched first by the next sync.
+    """
+    if store is None:
+        with EmailStore(db_path) as store:
+            return sync_mailbox(label_ids, q, chunk_size, db_path, fetcher, full, decoder, store)
+
+    fetcher = fetcher or BatchFetcher()
+    service = fetcher.service_factory()
+    label_ids = list(label_ids) if label_ids else None
+    state_key = history_state_key(label_ids) if q is None else None
+    history_id = store.get_sync_state(state_key) if state_key and not full else None
+
+    # Store every chunk as soon as it arrives so a crash loses at most one chunk
+    stored = 0
+    retry_queue = RetryQueue(store.conn)
+    # Attempts already made for each message replayed from the queue
+    replayed: Dict[str, int] = {}
     try:
-        # Authenticate with Gmail API
-        creds = authenticate_gmail()
-
-        # Build the Gmail API service
-        service = build('gmail', 'v1', credentials=creds)
-
-        # Fetch a list of email messages from the inbox
-        results = service.users().messages().list(
-            userId='me', labelIds=['INBOX'], maxResults=20).execute()
-        messages = results.get('messages', [])
-
-        if not messages:
-            print('No emails found in the inbox.')
-            return []
-
-        emails_with_details = []
-
-        for message in messages:
-            # Get the full email message details
-            email_details = service.users().messages().get(
-                userId='me', id=message['id']).execute()
-
-            # Extract desired fields
-            from_address = None
-            subject = None
-            message_text = None
-            received_datetime = None
-
-            headers = email_details.get('payload', {}).get('headers', [])
-            for header in headers:
-                if header['name'] == 'From':
-                    from_address = header['value']
-                elif header['name'] == 'Subject':
-                    subject = header['value']
-                elif header['name'] == 'Date':
-                    received_datetime = header['value']
-
-            payload = email_details.get('payload')
-            # print(payload.keys())
+        queued = retry_queue.entries('fetch')
+        if queued:
+            for entry_id, message_ids, attempts in queued:
+                replayed.update((message_id, max(attempts, replayed.get(message_id, 0))) for message_id in message_ids)
+            for chunk in fetch_email_chunks(set(replayed), chunk_size, fetcher, decoder):
+                stored += store.store_emails(chunk)
+            retry_queue.remove([entry_id for entry_id, message_ids, attempts in queued])
+
+        if history_id:
             try:
-                payload = payload['parts'][0]
-            except:
-                pass
-            # print('------------------------------------------------------------------')
-            if payload:
-                message_body = payload.get('body', {})
-                # print(message_body)
-                if 'data' in message_body:
-                    message_data = message_body['data']
-                    # You may need to decode the message data from base64
-                    message_text = base64.urlsafe_b64decode(
-                        message_data).decode('utf-8')
-
-            email_info = {
-                'id': message['id'],
-                'from': from_address,
-                'subject': subject,
-                'message': message_text,
-                'received_datetime': received_datetime
-            }
-
-            emails_with_details.append(email_info)
-
-        return emails_with_details
+                added, relabelled, deleted, latest_history_id = list_history_changes(
+                    service, history_id, label_ids, fetcher.scheduler)
+            except HttpError as error:
+                if error.resp.status != 404:
+                    raise
+                logger.warning('Saved history ID has expired, falling back to a full sync.')
+                return stored + sync_mailbox(label_ids, q, chunk_size, db_path, fetcher, True, decoder, store)
+
+            # Messages that lost every synced label left the synced emails, like deleted ones
+            left = {email_id for email_id, labels in relabelled.items()
+                    if label_ids and not set(label_ids) & set(labels)}
+            added -= left
+            store.delete_emails(deleted | left)
+            # Label-only changes are applied in place; unknown messages get fetched
+            added |= store.update_labels(
+                {email_id: labels for email_id, labels in relabelled.items()
+                 if email_id not in added and email_id not in left})
+            for chunk in fetch_email_chunks(added, chunk_size, fetcher, decoder):
+                stored += store.store_emails(chunk)
+            logger.info('Incremental sync: %d fetched, %d relabelled, %d deleted.',
+                        len(added), len(relabelled) - len(left), len(deleted | left))
+        else:
+            # Take the history ID before listing so changes made during the sync are not missed
+            latest_history_id = _execute(service.users().getProfile(userId='me'), 'getProfile',
+                                         fetcher.scheduler)['historyId']
+            for chunk in fetch_emails_with_details(label_ids, q, chunk_size, fetcher, decoder):
+                stored += store.store_emails(chunk)
+            logger.info('%d emails stored in the database.', stored)
+
+        if state_key:
+            store.set_sync_state(state_key, latest_history_id)
+
+        # Bodies skipped by earlier metadata-only syncs are fetched once a rule needs them
+        if fetcher.get_kwargs.get('format') != 'metadata':
+            stored += backfill_bodies(store, chunk_size, fetcher, decoder)
     except HttpError as error:
-        print(f'An error occurred while fetching emails: {error}')
-        return []
-
-
-def store_emails_in_database(emails_with_details):
+        logger.error('An error occurred while fetching emails: %s', error)
+    except sqlite3.Error as error:
+        logger.error('An error occurred while storing emails in the database: %s', error)
+    finally:
+        if fetcher.failed_ids:
+            # Messages failing again keep counting their attempts, so they are eventually given up on
+            by_attempts: Dict[int, List[str]] = {}
+            for message_id in sorted(set(fetcher.failed_ids)):
+                by_attempts.setdefault(replayed.get(message_id, -1) + 1, []).append(message_id)
+            for attempts, message_ids in by_attempts.items():
+                retry_queue.push('fetch', message_ids, attempts=attempts)
+            logger.warning('%d emails could not be fetched and will be retried next run.',
+                           len(set(fetcher.failed_ids)))
+            fetcher.failed_ids.clear()
+
+    return stored
+
+
+def backfill_bodies(store, chunk_size=500, fetcher=None, decoder=None):
+    missing = store.missing_bodies()
+    if not missing:
+        return 0
+    fetcher = fetcher or BatchFetcher(**fetch_options())
+    backfilled = 0
+    for chunk in fetch_email_chunks(missing, chunk_size, fetcher, decoder):
+        backfilled += store.store_emails(chunk)
+    logger.info('Backfilled %d email bodies.', backfilled)
+    return backfilled
+
+
+def store_emails_in_database(emails_with_details, db_path=DATABASE):
     try:
-        conn = sqlite3.connect('email_database.db')
-        cursor = conn.cursor()
-
-        for email_info in emails_with_details:
-            # some emails might already be there, we will just modify them
-            cursor.execute('''
-                INSERT OR REPLACE INTO emails (id, from_address, subject, message, received_datetime)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (email_info['id'], email_info['from'], email_info['subject'], email_info['message'], email_info['received_datetime']))
-            # cursor.execute('''
-            #     INSERT INTO emails (id, from_address, subject, message, received_datetime)
-            #     VALUES (?, ?, ?, ?, ?)
-            # ''', (email_info['id'], email_info['from'], email_info['subject'], email_info['message'], email_info['received_datetime']))
-
-        conn.commit()
-        conn.close()
-        print('Emails stored in the database.')
+        with EmailStore(db_path) as store:
+            store.store_emails(emails_with_details)
+        logger.info('%d emails stored in the database.', len(emails_with_details))
 
     except sqlite3.Error as error:
-        print(
-            f'An error occurred while storing emails in the database: {error}')
+        logger.error('An error occurred while storing emails in the database: %s', error)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch emails from Gmail into the local SQLite database.")
+    parser.add_argument("--label", dest="labels", action="append",
+                        help="Only fetch emails with this label ID (repeatable, default: INBOX)")
+    parser.add_argument("--all", action="store_true",
+                        help="Fetch emails regardless of their labels")
+    parser.add_argument("-q", "--query", default=None,
+                        help="Gmail search query, e.g. 'newer_than:7d from:example.com'")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="Number of emails fetched and stored per chunk (default: 500)")
+    parser.add_argument("--full", action="store_true",
+                        help="Ignore the saved history ID and resync every matching email")
+    parser.add_argument("--decode-workers", type=int, default=0,
+                        help="Decode message bodies in this many worker processes (default: 0, in-process)")
+    parser.add_argument("--raw", action="store_true",
+                        help="Fetch messages with format=raw and parse them with the stdlib email parser")
+    parser.add_argument("--async-connections", type=int, default=0,
+                        help="Fetch over the asyncio transport with this many keep-alive connections "
+                             "(default: 0, HTTP batch requests)")
+    parser.add_argument("--rules", nargs="+", default=None,
+                        help="Rule files or directories; only the fields they use are fetched "
+                             "(message bodies only if some rule checks Message)")
+    parser.add_argument("--body-compression", choices=["off"] + BODY_CODECS, default=None,
+                        help="Store bodies compressed in a separate table (or back as plain text with 'off') "
+                             "and convert the bodies already stored; the choice is kept for later runs")
+    add_arguments(parser)
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    label_ids = None if args.all else (args.labels or ['INBOX'])
+
+    rule_collections = load_rule_collections(args.rules) if args.rules else None
+    get_kwargs = {'format': 'raw'} if args.raw else fetch_options(rule_collections)
+    if args.async_connections:
+        fetcher = AsyncFetcher(AsyncGmailClient(max_connections=args.async_connections),
+                               max_concurrency=args.async_connections * 4, **get_kwargs)
+    else:
+        fetcher = BatchFetcher(**get_kwargs)
+    try:
+        with EmailStore() as store, profiled(args.profile), \
+                BodyDecoder(parse_email, args.decode_workers) as decoder, METRICS.timer('stage', stage='sync'):
+            if args.body_compression:
+                converted = store.set_body_compression(None if args.body_compression == 'off'
+                                                       else args.body_compression)
+                logger.info('Body storage set to %s; %d stored bodies converted.', args.body_compression, converted)
+            sync_mailbox(label_ids, args.query, args.chunk_size, fetcher=fetcher, full=args.full, decoder=decoder,
+                         store=store)
+    finally:
+        if args.async_connections:
+            fetcher.close()
+        if args.metrics_json:
+            METRICS.write_json(args.metrics_json)
 
 
 if __name__ == '__main__':
-
-    # Connect to the SQLite database (create a new one if it doesn't exist)
-    conn = sqlite3.connect('email_database.db')
-
-    # Create a cursor to execute SQL commands
-    cursor = conn.cursor()
-
-    # Create a table to store email data
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS emails (
-            id TEXT PRIMARY KEY,
-            from_address TEXT,
-            subject TEXT,
-            message TEXT,
-            received_datetime TEXT
-        )
-    ''')
-
-    # Fetch emails with additional details
-    emails_with_details = fetch_emails_with_details()
-
-    if emails_with_details:
-        store_emails_in_database(emails_with_details)
-
-    # Close the database connection
-    conn.close()
+    main()
 
 
 # to test:
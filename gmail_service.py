@@ -0,0 +1,138 @@
+import json
+import os.path
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+from metrics import METRICS
+
+# Define the Gmail API scope so we can read emails, move emails, add or remove labels, and mark as read, unread
+SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+
+DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+DISCOVERY_CACHE_DIR = 'discovery_cache'
+
+
+class GmailSession:
+    """Owns the credentials and Gmail clients for one mailbox.
+
+    Credentials and the discovery document are loaded once per process. Each
+    thread gets its own client (and therefore its own httplib2 connection),
+    because httplib2 is not thread-safe.
+    """
+
+    def __init__(self, token_file: str = 'token.json', credentials_file: str = 'credentials.json',
+                 discovery_cache_dir: str = DISCOVERY_CACHE_DIR, credentials=None):
+        self.token_file = token_file
+        self.credentials_file = credentials_file
+        self.discovery_cache_dir = discovery_cache_dir
+        self._creds = credentials
+        self._discovery_doc: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def credentials(self):
+        with self._lock:
+            if self._creds is None:
+                with METRICS.timer('stage', stage='auth'):
+                    self._creds = self._load_credentials()
+            elif self._creds.expired and self._creds.refresh_token:
+                with METRICS.timer('stage', stage='auth'):
+                    self._refresh(self._creds)
+            return self._creds
+
+    def _load_credentials(self):
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        creds = None
+        # The token file stores the user's access and refresh tokens and is created
+        # automatically during the initial authorization.
+        if os.path.exists(self.token_file):
+            creds = Credentials.from_authorized_user_file(self.token_file, SCOPES)
+
+        if creds and creds.valid:
+            return creds
+        if creds and creds.expired and creds.refresh_token:
+            self._refresh(creds)
+            return creds
+
+        # If there are no (valid) credentials available, let the user log in.
+        flow = InstalledAppFlow.from_client_secrets_file(self.credentials_file, SCOPES)
+        creds = flow.run_local_server(port=0)
+        self._save(creds)
+        return creds
+
+    def _refresh(self, creds) -> None:
+        from google.auth.transport.requests import Request
+        creds.refresh(Request())
+        self._save(creds)
+
+    def _save(self, creds) -> None:
+        with open(self.token_file, 'w') as token:
+            token.write(creds.to_json())
+
+    def discovery_document(self) -> Dict[str, Any]:
+        with self._lock:
+            if self._discovery_doc is None:
+                self._discovery_doc = self._load_discovery_document()
+            return self._discovery_doc
+
+    def _load_discovery_document(self) -> Dict[str, Any]:
+        cache_file = os.path.join(self.discovery_cache_dir, 'gmail.v1.json')
+        if os.path.exists(cache_file):
+            with open(cache_file, 'r') as f:
+                return json.load(f)
+
+        # Prefer the copy shipped with googleapiclient and only go online without one
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc('gmail', 'v1')
+        if content is None:
+            import httplib2
+            _, content = httplib2.Http().request(DISCOVERY_URL)
+        document = json.loads(content)
+
+        os.makedirs(self.discovery_cache_dir, exist_ok=True)
+        # Several account workers may write it at once; readers only ever see a complete file
+        fd, temp_file = tempfile.mkstemp(dir=self.discovery_cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(document, f)
+            os.replace(temp_file, cache_file)
+        except BaseException:
+            os.unlink(temp_file)
+            raise
+        return document
+
+    def service(self):
+        """Return the Gmail client for the calling thread, building it on first use."""
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
+            from googleapiclient.discovery import build_from_document
+
+            http = AuthorizedHttp(self.credentials(), http=httplib2.Http())
+            service = build_from_document(self.discovery_document(), http=http)
+            self._local.service = service
+        return service
+
+
+_default_session: Optional[GmailSession] = None
+_default_session_lock = threading.Lock()
+
+
+def default_session() -> GmailSession:
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = GmailSession()
+        return _default_session
+
+
+def get_service():
+    return default_session().service()
+
+
+def authenticate_gmail():
+    return default_session().credentials()
@@ -1,17 +1,49 @@
 import argparse
-import sqlite3
+import glob
+import hashlib
 import json
-from datetime import datetime, timedelta
-import pytz
-from typing import List, Dict, Any
+import logging
+import os.path
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from actions import ActionAccumulator
+from async_gmail import AsyncGmailClient, EventLoopThread, GmailServiceAdapter
+from dates import date_window, email_timestamp
+from labels import LabelCatalog, resolve_labels
+from ledger import RuleLedger
+from metrics import METRICS, add_arguments, configure_logging, profiled
+from predicate_cache import PredicateCache, to_rowids
+from rule_engine import CompiledRuleSet
+from rule_sql import select_candidates
+from scheduler import QuotaBudget, RequestScheduler, RetryQueue
+from storage import EmailStore, connect
+
+logger = logging.getLogger(__name__)
+
+# Rowid ranges handed to each worker process by process_emails(workers=...)
+SHARDS_PER_WORKER = 4
+# Emails whose ledger rows are read with one query, and after which the
+# actions are sent and the ledger committed
+LEDGER_CHUNK = 500
 
 class Rule:
     def __init__(self, field: str, predicate: str, value: str):
         self.field = field
         self.predicate = predicate
         self.value = value
+        # Parsed once; the cutoff depends on the time of each run, so callers pass `now`
+        self.window = date_window(value) if field == "Received Date/Time" else None
 
-    def evaluate(self, email: Dict[str, Any]) -> bool:
+    def cutoff(self, now: Optional[float] = None) -> Optional[int]:
+        """Epoch seconds the date value reaches back from `now`, or None if it is not a valid window."""
+        if self.window is None:
+            return None
+        return int(now if now is not None else time.time()) - self.window
+
+    def evaluate(self, email: Dict[str, Any], now: Optional[float] = None) -> bool:
         if self.field == "From":
             field_value = email.get("From", "")
         elif self.field == "Subject":
@@ -34,146 +66,404 @@ class Rule:
                 return field_value.lower() != self.value.lower()
 
         elif self.field == "Received Date/Time":
-            date_formats = ["%a, %d %b %Y %H:%M:%S %z",
-                            "%d %b %Y %H:%M:%S %z (UTC)"]
-
-            for date_format in date_formats:
-                date_str = email.get("Received Date/Time").replace(" (UTC)", "")
-                try:
-                    email_date = datetime.strptime(date_str, date_format)
-                    break
-                except Exception as e:
-                    print(f"Error parsing date: {e}")
-                    return False
-
-            value_parts = self.value.split()
-            num = int(value_parts[0])
-            unit = value_parts[1]
+            cutoff = self.cutoff(now)
+            if cutoff is None:
+                return False  # Value is not "<number> D" or "<number> M"
 
-            if unit == "D":
-                comparison_date = datetime.now(pytz.UTC) - timedelta(days=num)
-            elif unit == "M":
-                comparison_date = datetime.now(pytz.UTC) - timedelta(days=num * 30)
+            # Rows from the database carry the timestamp normalized at ingest
+            email_ts = email.get("received_ts")
+            if email_ts is None:
+                email_ts = email_timestamp(email.get("Received Date/Time"))
+                if email_ts is None:
+                    return False
 
             if self.predicate == "less than":
-                return email_date >= comparison_date
+                return email_ts >= cutoff
             elif self.predicate == "greater than":
-                return email_date < comparison_date
+                return email_ts < cutoff
         else:
             return False  # Predicate not supported
 
 class RuleCollection:
-    def __init__(self, rule_data: Dict[str, Any]):
+    def __init__(self, rule_data: Dict[str, Any], source: str = ""):
+        self.source = source
         self.rule_name = rule_data.get("rule_name", "")
         self.rule_description = rule_data.get("rule_description", "")
         self.rule_type = rule_data.get("rule_type", "")
         self.actions = rule_data.get("actions", [])
+        # Stored in the ledger with every match
+        self.actions_json = json.dumps(self.actions)
         self.rules = [Rule(rule['field'], rule['predicate'], rule['value']) for rule in rule_data.get("rules", [])]
+        # Identifies this exact rule content in the processed-state ledger
+        self.content_hash = hashlib.sha256(
+            json.dumps(rule_data, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        # Move target -> label ID (None when there is no such label), filled by labels.resolve_labels;
+        # targets missing here are sent as written
+        self.label_ids: Dict[str, Optional[str]] = {}
+
+    @property
+    def complete(self) -> bool:
+        """False while a move target has no label, so matches cannot be fully applied yet."""
+        return all(label_id is not None for label_id in self.label_ids.values())
 
-    def evaluate(self, email: Dict[str, Any]) -> bool:
+    def matches(self, email: Dict[str, Any], now: Optional[float] = None) -> bool:
         check_func = all if self.rule_type.lower() == "all" else any
-        if check_func(rule.evaluate(email) for rule in self.rules):
-            self.execute_actions(email)
+        return check_func(rule.evaluate(email, now) for rule in self.rules)
+
+    def evaluate(self, email: Dict[str, Any], accumulator: ActionAccumulator, now: Optional[float] = None) -> bool:
+        if self.matches(email, now):
+            self.execute_actions(email, accumulator)
             return True
         return False
 
-    def execute_actions(self, email: Dict[str, Any]) -> None:
+    def execute_actions(self, email: Dict[str, Any], accumulator: ActionAccumulator) -> None:
+        # Actions are only recorded here; the accumulator applies them in bulk
+        # so "mark unread" followed by "move" becomes a single modification.
         for action in self.actions:
             action_type = action["action_type"]
             action_value = action["action_value"]
             if action_type == "mark":
-                self.mark(email, action_value)
+                self.mark(email, action_value, accumulator)
             elif action_type == "move":
-                self.move(email, action_value)
+                label_id = self.label_ids.get(action_value, action_value)
+                if label_id is not None:
+                    self.move(email, label_id, accumulator)
 
-    def mark(self, email: Dict[str, Any], action_value: str) -> None:
-        from fetch import authenticate_gmail
-        from googleapiclient.discovery import build
-        # Use the Gmail API to mark the email
-        creds = authenticate_gmail()
-        service = build('gmail', 'v1', credentials=creds)
-
-        # Retrieve the email ID from your email data
+    def mark(self, email: Dict[str, Any], action_value: str, accumulator: ActionAccumulator) -> None:
         email_id = email['ID']
 
-        # Implement your marking logic here
         if action_value == "read":
-            # Mark the email as read
-            service.users().messages().modify(userId='me', id=email_id, body={
-                'removeLabelIds': ['UNREAD'], 'addLabelIds': []}).execute()
-            print(f"Marked email with ID: {email_id} as read")
-            # print email subject
-            # print(f"Email subject: {email['Subject']}")
+            accumulator.add(email_id, remove_label_ids=['UNREAD'])
         elif action_value == "unread":
-            # Mark the email as unread
-            service.users().messages().modify(userId='me', id=email_id, body={
-                'removeLabelIds': [], 'addLabelIds': ['UNREAD']}).execute()
-            print(f"Marked email with ID: {email_id} as unread")
+            accumulator.add(email_id, add_label_ids=['UNREAD'])
         else:
-            print(f"Invalid action: {action_value}. No action taken.")
+            logger.warning("Invalid action: %s. No action taken.", action_value)
 
-    def move(self, email: Dict[str, Any], action_value: str) -> None:
-        from fetch import authenticate_gmail
-        from googleapiclient.discovery import build
-        # Use the Gmail API to mark the email
-        creds = authenticate_gmail()
-        service = build('gmail', 'v1', credentials=creds)
+    def move(self, email: Dict[str, Any], action_value: str, accumulator: ActionAccumulator) -> None:
+        # Moving an email means adding the target label to it
+        accumulator.add(email['ID'], add_label_ids=[action_value])
+
+def load_rule_collections(paths: List[str]) -> List[RuleCollection]:
+    # Directories are expanded to the rule files they contain
+    rule_collections = []
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(path, "*.json"))) if os.path.isdir(path) else [path]
+        for file_name in files:
+            try:
+                with open(file_name, "r") as json_file:
+                    rule_data = json.load(json_file)
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping rule file %s: %s", file_name, e)
+                continue
+            rule_collections.append(RuleCollection(rule_data, source=file_name))
+    return rule_collections
+
+def evaluate_candidates(conn, rules: List[RuleCollection], engine: CompiledRuleSet, ledger: RuleLedger,
+                        reprocess: bool, evaluations: List[int], hits: List[int],
+                        rowids: Optional[Tuple[int, int]] = None) -> Iterator[Tuple[str, List[int]]]:
+    """Yield (message ID, positions in `rules` whose actions should be applied) for each candidate email.
+
+    Every result is recorded in the ledger, and the evaluations and hits of
+    each rule collection are added up in the given lists.
+    """
+    # The rules are compiled to SQL so the database only returns candidate
+    # rows; the compiled rule set then decides every rule for an email at once.
+    # The ledger skips emails already evaluated against the same rule content.
+    positions = {id(rule_collection): position for position, rule_collection in enumerate(rules)}
+    complete = {id(rule_collection) for rule_collection in rules if rule_collection.complete}
+    candidates = select_candidates(conn, rules, ledger.now, ledger=None if reprocess else ledger, rowids=rowids)
+    candidates = METRICS.timed(candidates, 'stage', stage='select')
+    while True:
+        chunk = list(islice(candidates, LEDGER_CHUNK))
+        if not chunk:
+            break
+        if not reprocess:
+            ledger.load(email["ID"] for email in chunk)
+        for email in chunk:
+            METRICS.increment('emails_evaluated')
+            pending = [(rule, False) for rule in rules] if reprocess else ledger.pending(email)
+            try:
+                only = None if len(pending) == len(engine.rule_collections) else [
+                    rule_collection for rule_collection, _ in pending]
+                matched = engine.match(email, only=only, now=ledger.now)
+            except Exception:
+                matched, failed = match_each(email, pending, ledger.now)
+                pending = [(rule_collection, applied) for rule_collection, applied in pending
+                           if id(rule_collection) not in failed]
+            matched_ids = {id(rule_collection) for rule_collection in matched}
+            yield email["ID"], tally(email, pending, matched_ids, positions, complete, ledger, evaluations, hits)
+
+
+def tally(email, pending: List[Tuple[RuleCollection, bool]], matched: Set[int], positions: Dict[int, int],
+          complete: Set[int], ledger: RuleLedger, evaluations: List[int], hits: List[int]) -> List[int]:
+    """Count and record the results of one email; return the positions whose actions should be applied.
+
+    `matched` and `complete` hold ids of rule collections: those that matched,
+    and those whose move targets all have a label.
+    """
+    to_apply, results = [], []
+    for rule_collection, already_applied in pending:
+        position = positions[id(rule_collection)]
+        evaluations[position] += 1
+        is_match = id(rule_collection) in matched
+        if is_match:
+            hits[position] += 1
+            if not already_applied:
+                to_apply.append(position)
+            # A match whose move was skipped stays out of the ledger, so it is applied once the label exists
+            if id(rule_collection) not in complete:
+                continue
+        results.append((rule_collection, is_match))
+    ledger.record(email, results)
+    return to_apply
+
+
+def match_each(email, pending: List[Tuple[RuleCollection, bool]],
+               now: Optional[float] = None) -> Tuple[List[RuleCollection], Set[int]]:
+    """Decide the rule collections one at a time, for an email the compiled rule set failed on.
+
+    Returns the matched collections and the ids of those that raised; a
+    failing collection is logged and left out of the ledger so it is tried
+    again, without costing the other collections their result.
+    """
+    matched, failed = [], set()
+    for rule_collection, _ in pending:
+        try:
+            if rule_collection.matches(email, now):
+                matched.append(rule_collection)
+        except Exception as e:
+            failed.add(id(rule_collection))
+            logger.warning("Error evaluating email %s against %s: %s", email.get("ID"),
+                           rule_collection.source or rule_collection.rule_name, e)
+            logger.debug("Email: %s", email)
+    return matched, failed
 
-        # Retrieve the email ID from your email data
-        email_id = email['ID']
 
-        # Implement your moving logic here
-        # For example, you can use the 'users().messages().modify()' method to add a label to the email.
-        # Replace 'Label_ID' with the actual label you want to use.
-        label_id = action_value
-        service.users().messages().modify(userId='me', id=email_id,
-                                          body={'addLabelIds': [label_id]}).execute()
+def evaluate_bitmaps(conn, rules: List[RuleCollection], cache: PredicateCache, ledger: RuleLedger,
+                     reprocess: bool, evaluations: List[int], hits: List[int],
+                     seconds: List[float]) -> Iterator[Tuple[str, List[int]]]:
+    """Like evaluate_candidates, but decides the rules with the predicate bitmaps of `cache`.
 
-        print(f"Moved email with ID: {email_id} to folder: {action_value}")
-        # Print email subject
-        # print(f"Email subject: {email['Subject']}")
+    Only emails matching at least one rule are read from the database.
+    """
+    positions = {id(rule_collection): position for position, rule_collection in enumerate(rules)}
+    complete = {id(rule_collection) for rule_collection in rules if rule_collection.complete}
+    matched = []
+    for position, rule_collection in enumerate(rules):
+        started = time.perf_counter()
+        matched.append(set(to_rowids(cache.match(rule_collection))))
+        seconds[position] += time.perf_counter() - started
+    rowids = sorted(set().union(*matched))
+    for start in range(0, len(rowids), LEDGER_CHUNK):
+        chunk = rowids[start:start + LEDGER_CHUNK]
+        rows = conn.execute(f'SELECT rowid, id, modified_seq, received_ts FROM emails '
+                            f'WHERE rowid IN ({", ".join("?" * len(chunk))}) ORDER BY rowid', chunk).fetchall()
+        if not reprocess:
+            ledger.load(row[1] for row in rows)
+        for rowid, message_id, modified_seq, received_ts in rows:
+            METRICS.increment('emails_evaluated')
+            email = {"ID": message_id, "modified_seq": modified_seq, "received_ts": received_ts}
+            pending = [(rule, False) for rule in rules] if reprocess else ledger.pending(email)
+            matched_ids = {id(rule_collection) for rule_collection, _ in pending
+                           if rowid in matched[positions[id(rule_collection)]]}
+            yield message_id, tally(email, pending, matched_ids, positions, complete, ledger, evaluations, hits)
+
+
+def rowid_shards(conn, count: int) -> List[Tuple[int, int]]:
+    """Split the rowids of the emails table into at most `count` inclusive ranges of equal width."""
+    low, high = conn.execute('SELECT min(rowid), max(rowid) FROM emails').fetchone()
+    if low is None:
+        return []
+    width = -(-(high - low + 1) // max(1, count))
+    return [(start, min(start + width - 1, high)) for start in range(low, high + 1, width)]
+
+
+def apply_results(results: Iterator[Tuple[str, List[int]]], rules: List[RuleCollection],
+                  accumulator: ActionAccumulator, ledger: RuleLedger) -> int:
+    """Apply the actions of each (message ID, positions in `rules`) result and return the match count.
+
+    Every LEDGER_CHUNK emails the actions are sent and only then is the
+    ledger committed, so memory stays bounded however large the mailbox is.
+    """
+    matches = 0
+    drain = True
+    for evaluated, (message_id, to_apply) in enumerate(results, 1):
+        for position in to_apply:
+            rules[position].execute_actions({"ID": message_id}, accumulator)
+            matches += 1
+        if evaluated % LEDGER_CHUNK == 0:
+            _flush(accumulator, ledger, drain)
+            drain = False
+    _flush(accumulator, ledger, drain)
+    return matches
+
+
+def _flush(accumulator: ActionAccumulator, ledger: RuleLedger, drain: bool) -> None:
+    # Only remember results once their actions have been applied; the retry
+    # queue is replayed once per run, by the first flush
+    with METRICS.timer('stage', stage='actions'):
+        accumulator.flush(drain=drain)
+    ledger.commit(skip=accumulator.rejected)
+    accumulator.rejected.clear()
+
+
+def _evaluate_shard(db_path: str, rules: List[RuleCollection], reprocess: bool, now: int,
+                    rowids: Tuple[int, int], options: Dict[str, Any]):
+    # Runs in a worker process, on its own connection: the shard applies its
+    # actions and commits its ledger chunk by chunk, and only counts go back
+    METRICS.reset()
+    conn = connect(db_path)
+    try:
+        engine = CompiledRuleSet(rules)
+        ledger = RuleLedger(conn, rules, now=now)
+        accumulator = ActionAccumulator(
+            options['service'], user_id=options['user_id'], chunk_size=options['chunk_size'],
+            scheduler=RequestScheduler(QuotaBudget(options['units_per_second'])),
+            retry_queue=RetryQueue(conn) if options['retry'] else None)
+        evaluations, hits = [0] * len(rules), [0] * len(rules)
+        matches = apply_results(evaluate_candidates(conn, rules, engine, ledger, reprocess, evaluations, hits,
+                                                    rowids), rules, accumulator, ledger)
+        return matches, evaluations, hits, engine.collection_seconds, METRICS.snapshot()
+    finally:
+        conn.close()
+
+
+def _evaluate_sharded(db_path: str, rules: List[RuleCollection], accumulator: ActionAccumulator,
+                      ledger: RuleLedger, reprocess: bool, workers: int, evaluations: List[int],
+                      hits: List[int], seconds: List[float]) -> int:
+    # Several shards per worker keep every core busy when candidates cluster in some rowid ranges
+    shards = rowid_shards(ledger.conn, workers * SHARDS_PER_WORKER)
+    rate = accumulator.scheduler.budget.rate
+    # The workers split the mailbox's quota between them; the retry queue is
+    # replayed by this process, so only new failures are queued by a shard
+    options = {'service': accumulator.shared_service, 'user_id': accumulator.user_id,
+               'chunk_size': accumulator.chunk_size, 'retry': accumulator.retry_queue is not None,
+               'units_per_second': rate / workers if rate is not None else None}
+    matches = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_evaluate_shard, db_path, rules, reprocess, ledger.now, shard, options)
+                   for shard in shards]
+        for future in futures:
+            shard_matches, shard_evaluations, shard_hits, shard_seconds, snapshot = future.result()
+            matches += shard_matches
+            METRICS.merge(snapshot)
+            for position in range(len(rules)):
+                evaluations[position] += shard_evaluations[position]
+                hits[position] += shard_hits[position]
+                seconds[position] += shard_seconds[position]
+    return matches
+
+
+def database_path(conn) -> str:
+    """File of the connection's main database ('' for an in-memory database)."""
+    return conn.execute('PRAGMA database_list').fetchone()[2]
+
+
+def process_emails(conn, rules: List[RuleCollection], accumulator: ActionAccumulator,
+                   reprocess: bool = False, engine: Optional[CompiledRuleSet] = None, workers: int = 0,
+                   cache: Optional[PredicateCache] = None, now: Optional[int] = None) -> int:
+    """Evaluate the stored emails against the rules, apply the actions and return the match count.
+
+    A long-running caller can pass the CompiledRuleSet of `rules` to avoid rebuilding it.
+    With `workers`, the emails table is split into rowid ranges evaluated by
+    that many processes, each with its own connection, which apply their
+    actions and commit their ledger results themselves.
+    With a PredicateCache the rules are decided from its bitmaps instead.
+    Date rules are decided against `now` (default: the cache's time, or the current time).
+    """
+    engine = engine or CompiledRuleSet(rules)
+    evaluations, hits = [0] * len(rules), [0] * len(rules)
+    ledger = RuleLedger(conn, rules, now=now if now is not None or cache is None else cache.now)
+    db_path = database_path(conn) if workers and cache is None else ''
+    if workers and cache is None and not db_path:
+        logger.warning("An in-memory database cannot be shared with worker processes; evaluating serially.")
+
+    if cache is not None:
+        seconds = [0.0] * len(rules)
+        matches = apply_results(evaluate_bitmaps(conn, rules, cache, ledger, reprocess, evaluations, hits, seconds),
+                                rules, accumulator, ledger)
+    elif db_path:
+        seconds = [0.0] * len(rules)
+        # Changes queued by earlier runs go out before the shards start
+        _flush(accumulator, ledger, drain=True)
+        matches = _evaluate_sharded(db_path, rules, accumulator, ledger, reprocess, workers, evaluations, hits,
+                                    seconds)
+    else:
+        engine_positions = {id(rule_collection): position
+                            for position, rule_collection in enumerate(engine.rule_collections)}
+        seconds_before = list(engine.collection_seconds)
+        matches = apply_results(evaluate_candidates(conn, rules, engine, ledger, reprocess, evaluations, hits),
+                                rules, accumulator, ledger)
+
+    if cache is None and not db_path:
+        seconds = [engine.collection_seconds[engine_positions[id(rule_collection)]]
+                   - seconds_before[engine_positions[id(rule_collection)]] for rule_collection in rules]
+    for position, rule_collection in enumerate(rules):
+        name = rule_collection.rule_name or rule_collection.source or rule_collection.content_hash
+        METRICS.observe('rule_evaluation', seconds[position], count=evaluations[position], rule=name)
+        METRICS.increment('rule_hits', hits[position], rule=name)
+
+    if cache is not None:
+        cache.prune()
+    return matches
 
 def main() -> None:
     parser = argparse.ArgumentParser(
-        description="Process emails using rules from a JSON file.")
-    parser.add_argument("json_file", nargs="?", default="./rules/Happy_Fox.json",
-                        help="Path to the JSON file containing rules (default: ./rules/Happy_Fox.json)")
+        description="Process emails using rules from JSON files.")
+    parser.add_argument("json_files", nargs="*", default=["./rules/Happy_Fox.json"],
+                        help="JSON rule files or directories of them, e.g. ./rules "
+                             "(default: ./rules/Happy_Fox.json)")
+
+    parser.add_argument("--reprocess", action="store_true",
+                        help="Ignore the processed-state ledger and evaluate every email again")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Evaluate in this many processes, each scanning a range of rowids "
+                             "(default: 0, in this process)")
+    parser.add_argument("--bitmaps", action="store_true",
+                        help="Decide rules with the per-predicate bitmaps cached in the database, "
+                             "updating them for emails stored since the last run")
+    parser.add_argument("--create-labels", action="store_true",
+                        help="Create the labels move actions name that do not exist yet, instead of "
+                             "reporting them and skipping those actions")
+    parser.add_argument("--async-connections", type=int, default=0,
+                        help="Send the actions over the asyncio transport with this many keep-alive "
+                             "connections (default: 0, use googleapiclient)")
 
+    add_arguments(parser)
     args = parser.parse_args()
+    if args.async_connections and args.workers:
+        parser.error("--async-connections cannot be combined with --workers")
+    configure_logging(args.log_level)
 
-    # Load rules from the specified JSON file and create rule instances
-    rules = []
-
-    with open(args.json_file, "r") as json_file:
-        rule_data = json.load(json_file)
-        rules.append(RuleCollection(rule_data))
-
-    # Simulate email objects using database rows
-    # Connect to the SQLite database
-    conn = sqlite3.connect('email_database.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM emails")
-    rows = cursor.fetchall()
-
-    for row in rows:
-        email = {
-            "ID": row[0],
-            "From": row[1],
-            "Subject": row[2],
-            "Message": row[3],
-            "Received Date/Time": row[4],
-        }
-
-        # Check the email against each rule
-        for rule_collection in rules:
-            try:
-                rule_collection.evaluate(email)
-            except Exception as e:
-                print(f"Error evaluating email: {e}")
-                print(f"Email: {email}")
+    # Load rules from the specified JSON files and create rule instances
+    rules = load_rule_collections(args.json_files)
+
+    service = None
+    scheduler = RequestScheduler()
+    if args.async_connections:
+        service = GmailServiceAdapter(AsyncGmailClient(max_connections=args.async_connections), EventLoopThread())
+        # The client's quota limiter paces the calls, so the scheduler only retries them
+        scheduler = RequestScheduler(QuotaBudget(units_per_second=None))
 
-    # Close the database connection
-    conn.close()
+    with EmailStore() as store:
+        # Matched actions are collected across all rules and sent in batches;
+        # batches that keep failing are queued and sent first by the next run
+        accumulator = ActionAccumulator(service, scheduler=scheduler, retry_queue=RetryQueue(store.conn))
+        # Move targets are validated once, before any email is evaluated
+        resolve_labels(rules, LabelCatalog(store.conn, scheduler=accumulator.scheduler), create=args.create_labels)
+        if any(rule.field == "Message" for rule_collection in rules for rule in rule_collection.rules) \
+                and store.missing_bodies(limit=1):
+            logger.warning("Some emails were fetched without their body; run fetch.py --rules with these "
+                           "rules to backfill them.")
+        try:
+            with profiled(args.profile):
+                process_emails(store.conn, rules, accumulator, reprocess=args.reprocess, workers=args.workers,
+                               cache=PredicateCache(store.conn) if args.bitmaps else None)
+        finally:
+            if service is not None:
+                service.close()
+    if args.metrics_json:
+        METRICS.write_json(args.metrics_json)
 
 if __name__ == "__main__":
     main()
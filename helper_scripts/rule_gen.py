@@ -69,7 +69,7 @@ def prompt_for_action():
     print("2. Mark as Unread")
     print("3. Move to Label")
     def prompt_for_label_id():
-        return input("Enter the label ID: ")
+        return input("Enter the label name or ID: ")
     action_mapping = {
         "1": {"action_type": "mark", "action_value": "read"},
         "2": {"action_type": "mark", "action_value": "unread"},
@@ -1,5 +1,199 @@
+import asyncio
+import base64
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from gmailOps import Rule, RuleCollection
+import unittest.mock
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+# Make the modules in the repository root importable
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "benchmarks"))
+from accounts import UNKNOWN_BACKLOG, load_accounts, process_account, run_accounts  # noqa: E402
+from actions import ActionAccumulator  # noqa: E402
+from async_gmail import AsyncFetcher, AsyncGmailClient, ConnectionPool, EventLoopThread, QuotaLimiter  # noqa: E402
+from batch_fetch import AdaptiveBackoff, BatchFetcher  # noqa: E402
+from daemon import Daemon, PushSource  # noqa: E402
+from fake_gmail import FakeGmail  # noqa: E402
+from dates import email_timestamp  # noqa: E402
+from fetch import fetch_emails_with_details, fetch_options, parse_email, sync_mailbox  # noqa: E402
+from gmail_service import GmailSession  # noqa: E402
+import gmailops  # noqa: E402
+from gmailops import Rule, RuleCollection, load_rule_collections, process_emails, rowid_shards  # noqa: E402
+from labels import LabelCatalog, resolve_labels  # noqa: E402
+from ledger import recheck_after  # noqa: E402
+from metrics import METRICS, Metrics, MetricsServer  # noqa: E402
+from predicate_cache import PredicateCache, from_rowids, to_rowids  # noqa: E402
+from mime import BodyDecoder, extract_body, html_to_text, to_gmail_payload  # noqa: E402
+from rule_engine import CompiledRuleSet, NeedleMatcher  # noqa: E402
+from rule_sql import compile_rule, compile_rule_collection, select_candidates  # noqa: E402
+from scheduler import QuotaBudget, RequestScheduler, RetryQueue, backoff_delay  # noqa: E402
+from storage import EmailStore, migrate, train_dictionary  # noqa: E402
+from synthetic_mailbox import MailboxSpec, generate_mailbox, generate_rules  # noqa: E402
+
+
+def unpaced_scheduler():
+    return RequestScheduler(QuotaBudget(units_per_second=None), sleep=lambda delay: None)
+
+
+class FakeRequest:
+    def __init__(self, result=None):
+        self.result = result if result is not None else {}
+
+    def execute(self):
+        return self.result
+
+
+class FakeGetRequest(FakeRequest):
+    def __init__(self, store, message_id, format="full", **kwargs):
+        super().__init__()
+        self.store = store
+        self.message_id = message_id
+        self.format = format
+
+    def execute(self):
+        message = self.store.answer(self.message_id)
+        if self.format == "metadata":
+            message = dict(message, payload={"headers": message.get("payload", {}).get("headers", [])})
+        return message
+
+
+class FailingRequest:
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+    def execute(self):
+        raise HttpError(httplib2.Response(dict(self.headers, status=self.status)), b"backendError")
+
+
+class FakeBatch:
+    def __init__(self, callback):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        for request_id, request in self.requests:
+            try:
+                response, exception = request.execute(), None
+            except HttpError as error:
+                response, exception = None, error
+            self.callback(request_id, response, exception)
+
+
+class FakeMessages:
+    def __init__(self):
+        self.batch_modify_calls = []
+        self.store = {}
+        self.throttled = set()
+        self.broken = set()
+        self.modify_failure = None
+
+    def answer(self, message_id):
+        if message_id in self.broken:
+            raise HttpError(httplib2.Response({"status": 500}), b"backendError")
+        if message_id in self.throttled:
+            # Throttle each message once, like a recorded 429 response
+            self.throttled.discard(message_id)
+            raise HttpError(httplib2.Response({"status": 429}), b"rateLimitExceeded")
+        return self.store[message_id]
+
+    def list(self, userId, labelIds=None, q=None, maxResults=100, pageToken=None):
+        ids = sorted(self.store, key=int)
+        start = int(pageToken or 0)
+        page = {"messages": [{"id": message_id} for message_id in ids[start:start + maxResults]]}
+        if start + maxResults < len(ids):
+            page["nextPageToken"] = str(start + maxResults)
+        return FakeRequest(page)
+
+    def get(self, userId, id, **kwargs):
+        return FakeGetRequest(self, id, **kwargs)
+
+    def batchModify(self, userId, body):
+        if self.modify_failure is not None:
+            return self.modify_failure
+        self.batch_modify_calls.append(body)
+        return FakeRequest()
+
+
+class FakeHistory:
+    def __init__(self):
+        self.records = []
+        self.history_id = "100"
+        self.expired = False
+
+    def list(self, userId, startHistoryId, historyTypes=None, pageToken=None, **kwargs):
+        if self.expired:
+            raise HttpError(httplib2.Response({"status": 404}), b"notFound")
+        return FakeRequest({"history": self.records, "historyId": self.history_id})
+
+
+class FakeLabels:
+    def __init__(self):
+        self.labels = [{"id": "INBOX", "name": "INBOX", "type": "system"},
+                       {"id": "UNREAD", "name": "UNREAD", "type": "system"}]
+        self.list_calls = 0
+        self.created = []
+
+    def list(self, userId):
+        self.list_calls += 1
+        return FakeRequest({"labels": [dict(label) for label in self.labels]})
+
+    def create(self, userId, body):
+        label = {"id": f"Label_{len(self.labels)}", "name": body["name"], "type": "user"}
+        self.labels.append(label)
+        self.created.append(body["name"])
+        return FakeRequest(dict(label))
+
+
+class FakeService:
+    def __init__(self):
+        self.messages_resource = FakeMessages()
+        self.history_resource = FakeHistory()
+        self.labels_resource = FakeLabels()
+        self.watch_calls = []
+        self.batches = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self.messages_resource
+
+    def history(self):
+        return self.history_resource
+
+    def labels(self):
+        return self.labels_resource
+
+    def getProfile(self, userId):
+        return FakeRequest({"historyId": self.history_resource.history_id})
+
+    def new_batch_http_request(self, callback=None):
+        self.batches.append(FakeBatch(callback))
+        return self.batches[-1]
+
+    def watch(self, userId, body):
+        self.watch_calls.append(body)
+        return FakeRequest({"historyId": self.history_resource.history_id,
+                            "expiration": str(int((time.time() + 7 * 86400) * 1000))})
+
 
 class TestRuleEvaluation(unittest.TestCase):
     # Since From, Subject, and Message are all strings, we can test them together
@@ -33,6 +227,1316 @@ class TestRuleEvaluation(unittest.TestCase):
         email = {"Received Date/Time": "Thu, 01 Jan 1970 00:00:00 +0000"}
         self.assertTrue(rule.evaluate(email))
 
+    def test_rule_evaluate_second_date_format(self):
+        rule = Rule("Received Date/Time", "greater than", "1 M")
+        email = {"Received Date/Time": "1 Jan 1970 00:00:00 +0000 (UTC)"}
+        self.assertTrue(rule.evaluate(email))
+
+    def test_rule_evaluate_uses_stored_timestamp(self):
+        rule = Rule("Received Date/Time", "less than", "2 D")
+        email = {"Received Date/Time": "not a date", "received_ts": rule.cutoff() + 60}
+        self.assertTrue(rule.evaluate(email))
+
+    def test_rule_evaluate_date_against_given_time(self):
+        # The cutoff follows the `now` of each evaluation instead of the time the rule was built
+        rule = Rule("Received Date/Time", "less than", "2 D")
+        email = {"received_ts": 1000000}
+        self.assertTrue(rule.evaluate(email, now=1000000 + 86400))
+        self.assertFalse(rule.evaluate(email, now=1000000 + 3 * 86400))
+        self.assertEqual(compile_rule(rule, now=1000000 + 3 * 86400), ("(received_ts >= ?)", [1000000 + 86400]))
+
+    def test_rule_evaluate_invalid_date_value(self):
+        rule = Rule("Received Date/Time", "less than", "2 Weeks")
+        self.assertFalse(rule.evaluate({"Received Date/Time": "Thu, 01 Jan 1970 00:00:00 +0000"}))
+
+
+class TestDateParsing(unittest.TestCase):
+    def test_email_timestamp(self):
+        self.assertEqual(email_timestamp("Thu, 01 Jan 1970 00:01:00 +0000"), 60)
+        self.assertEqual(email_timestamp("Thu, 01 Jan 1970 01:00:00 +0100 (CET)"), 0)
+        self.assertEqual(email_timestamp("1970-01-01T00:02:00+0000"), 120)
+        self.assertEqual(email_timestamp("garbage", internal_date="5000"), 5)
+        self.assertIsNone(email_timestamp(None))
+
+
+class TestActionAccumulator(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeService()
+        self.accumulator = ActionAccumulator(self.service)
+
+    def test_mark_and_move_become_one_modification(self):
+        rule_collection = RuleCollection({
+            "rule_type": "any",
+            "rules": [{"field": "From", "predicate": "contains", "value": "example.com"}],
+            "actions": [{"action_type": "mark", "action_value": "unread"},
+                        {"action_type": "move", "action_value": "Label_1"}]})
+        for email_id in ("a", "b"):
+            rule_collection.evaluate({"ID": email_id, "From": "user@example.com"}, self.accumulator)
+        self.assertEqual(self.accumulator.flush(), 1)
+        calls = self.service.messages_resource.batch_modify_calls
+        self.assertEqual(calls, [{"ids": ["a", "b"], "addLabelIds": ["Label_1", "UNREAD"], "removeLabelIds": []}])
+
+    def test_later_change_wins(self):
+        self.accumulator.add("a", add_label_ids=["UNREAD"])
+        self.accumulator.add("a", remove_label_ids=["UNREAD"])
+        self.assertEqual(list(self.accumulator.groups()), [(frozenset(), frozenset(["UNREAD"]))])
+
+    def test_chunks_of_at_most_1000(self):
+        for i in range(2500):
+            self.accumulator.add(str(i), remove_label_ids=["UNREAD"])
+        self.assertEqual(self.accumulator.flush(), 3)
+        sizes = [len(call["ids"]) for call in self.service.messages_resource.batch_modify_calls]
+        self.assertEqual(sizes, [1000, 1000, 500])
+        self.assertEqual(len(self.accumulator), 0)
+
+    def test_unsent_changes_survive_an_unexpected_error(self):
+        accumulator = ActionAccumulator(self.service, chunk_size=2, scheduler=unpaced_scheduler())
+        for message_id in ("1", "2", "3"):
+            accumulator.add(message_id, remove_label_ids=["UNREAD"])
+
+        class DroppedConnection:
+            def execute(self):
+                raise ConnectionResetError()
+
+        batch_modify = self.service.messages_resource.batchModify
+        calls = []
+
+        def fail_second_call(userId, body):
+            calls.append(body)
+            return DroppedConnection() if len(calls) == 2 else batch_modify(userId, body)
+
+        self.service.messages_resource.batchModify = fail_second_call
+        with self.assertRaises(ConnectionResetError):
+            accumulator.flush()
+        self.assertEqual(len(accumulator), 1)
+        accumulator.flush()
+        self.assertEqual([call["ids"] for call in self.service.messages_resource.batch_modify_calls],
+                         [["1", "2"], ["3"]])
+        self.assertEqual(len(accumulator), 0)
+
+
+class TestRequestScheduler(unittest.TestCase):
+    def test_retries_honor_retry_after(self):
+        delays = []
+        scheduler = RequestScheduler(QuotaBudget(units_per_second=None), sleep=delays.append)
+        responses = [FailingRequest(429, {"retry-after": "7"}), FailingRequest(503), FakeRequest({"id": "1"})]
+
+        class Request:
+            def execute(self):
+                return responses.pop(0).execute()
+
+        self.assertEqual(scheduler.execute(Request(), "messages.get"), {"id": "1"})
+        self.assertEqual(delays[0], 7)
+        self.assertLessEqual(delays[1], 1.0)
+        self.assertEqual(scheduler.budget.spent, {"messages.get": 15})
+        self.assertLessEqual(backoff_delay(3, base_delay=0.5), 4.0)
+
+    def test_failed_actions_are_queued_and_sent_next_run(self):
+        service = FakeService()
+        conn = sqlite3.connect(":memory:")
+        migrate(conn)
+        queue = RetryQueue(conn)
+        scheduler = RequestScheduler(QuotaBudget(units_per_second=None), max_retries=2, sleep=lambda delay: None)
+
+        service.messages_resource.modify_failure = FailingRequest(500)
+        accumulator = ActionAccumulator(service, scheduler=scheduler, retry_queue=queue)
+        accumulator.add("1", remove_label_ids=["UNREAD"])
+        self.assertEqual(accumulator.flush(), 0)
+        self.assertEqual(len(queue), 1)
+
+        service.messages_resource.modify_failure = None
+        self.assertEqual(ActionAccumulator(service, scheduler=scheduler, retry_queue=queue).flush(), 1)
+        self.assertEqual(service.messages_resource.batch_modify_calls,
+                         [{"ids": ["1"], "addLabelIds": [], "removeLabelIds": ["UNREAD"]}])
+
+    def test_rejected_actions_are_not_replayed_and_retries_run_out(self):
+        service = FakeService()
+        conn = sqlite3.connect(":memory:")
+        migrate(conn)
+        queue = RetryQueue(conn, max_attempts=3)
+        scheduler = RequestScheduler(QuotaBudget(units_per_second=None), max_retries=0, sleep=lambda delay: None)
+
+        # A 400, such as an unknown label, fails the same way every time
+        service.messages_resource.modify_failure = FailingRequest(400)
+        accumulator = ActionAccumulator(service, scheduler=scheduler, retry_queue=queue)
+        accumulator.add("1", add_label_ids=["dd"])
+        self.assertEqual(accumulator.flush(), 0)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(accumulator.rejected, {"1"})
+
+        service.messages_resource.modify_failure = FailingRequest(503)
+        accumulator.add("2", remove_label_ids=["UNREAD"])
+        accumulator.flush()
+        attempts = []
+        while len(queue):
+            attempts.append(queue.entries("batchModify")[0][2])
+            ActionAccumulator(service, scheduler=scheduler, retry_queue=queue).flush()
+        self.assertEqual(attempts, [0, 1, 2])
+        self.assertEqual(service.messages_resource.batch_modify_calls, [])
+        self.assertEqual(len(queue), 0)
+
+
+class TestGmailSession(unittest.TestCase):
+    def setUp(self):
+        from google.oauth2.credentials import Credentials
+        self.cache_dir = tempfile.mkdtemp()
+        self.session = GmailSession(discovery_cache_dir=self.cache_dir,
+                                    credentials=Credentials(token="token"))
+
+    def test_service_is_built_once_per_thread(self):
+        service = self.session.service()
+        self.assertIs(self.session.service(), service)
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.session.service()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], service)
+
+    def test_discovery_document_is_cached_on_disk(self):
+        self.session.service()
+        # Written through a temporary file that is renamed into place
+        self.assertEqual(os.listdir(self.cache_dir), ["gmail.v1.json"])
+        fresh = GmailSession(discovery_cache_dir=self.cache_dir)
+        self.assertEqual(fresh.discovery_document()["name"], "gmail")
+
+
+class TestBatchFetcher(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeService()
+        for i in range(120):
+            self.service.messages_resource.store[str(i)] = {"id": str(i)}
+        self.fetcher = BatchFetcher(lambda: self.service, batch_size=50, max_workers=3,
+                                    backoff=AdaptiveBackoff(initial_delay=0.001), scheduler=unpaced_scheduler())
+
+    def test_fetches_every_message_in_batches(self):
+        fetched = sorted(int(message["id"]) for message in self.fetcher.fetch(map(str, range(120))))
+        self.assertEqual(fetched, list(range(120)))
+        self.assertEqual(self.fetcher.stats.batches, 3)
+
+    def test_retries_throttled_messages(self):
+        self.service.messages_resource.throttled = {"3", "70"}
+        fetched = list(self.fetcher.fetch(map(str, range(120))))
+        self.assertEqual(len(fetched), 120)
+        self.assertEqual(self.fetcher.stats.retries, 2)
+        self.assertEqual(self.fetcher.stats.failed, 0)
+
+
+class TestMailboxSync(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeService()
+        for i in range(1200):
+            self.service.messages_resource.store[str(i)] = {
+                "id": str(i), "payload": {"headers": [{"name": "Subject", "value": f"Subject {i}"}]}}
+        self.fetcher = BatchFetcher(lambda: self.service, scheduler=unpaced_scheduler())
+        self.db_path = os.path.join(tempfile.mkdtemp(), "emails.db")
+
+    def sync_state(self, key):
+        with EmailStore(self.db_path) as store:
+            return store.get_sync_state(key)
+
+    def test_pages_through_every_message_in_chunks(self):
+        chunks = list(fetch_emails_with_details(chunk_size=500, fetcher=self.fetcher))
+        self.assertEqual([len(chunk) for chunk in chunks], [500, 500, 200])
+
+    def test_sync_stores_each_chunk(self):
+        self.assertEqual(sync_mailbox(chunk_size=300, db_path=self.db_path, fetcher=self.fetcher), 1200)
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0], 1200)
+        conn.close()
+
+    def test_header_only_rules_fetch_metadata_and_backfill_later(self):
+        header_rules = [RuleCollection({"rules": [{"field": "From", "predicate": "contains", "value": "x"}]})]
+        body_rules = [RuleCollection({"rules": [{"field": "Message", "predicate": "contains", "value": "x"}]})]
+        self.assertEqual(fetch_options(header_rules)["format"], "metadata")
+        self.assertEqual(fetch_options(body_rules)["format"], "full")
+
+        for message in self.service.messages_resource.store.values():
+            message["payload"]["body"] = {"data": "Ym9keQ"}
+        metadata_fetcher = BatchFetcher(lambda: self.service, scheduler=unpaced_scheduler(),
+                                        **fetch_options(header_rules))
+        sync_mailbox(db_path=self.db_path, fetcher=metadata_fetcher, full=True)
+        with EmailStore(self.db_path) as store:
+            self.assertEqual(len(store.missing_bodies()), 1200)
+
+        # A sync for rules that need bodies backfills them, and metadata syncs keep them
+        full_fetcher = BatchFetcher(lambda: self.service, scheduler=unpaced_scheduler(), **fetch_options(body_rules))
+        sync_mailbox(db_path=self.db_path, fetcher=full_fetcher)
+        sync_mailbox(db_path=self.db_path, fetcher=metadata_fetcher, full=True)
+        with EmailStore(self.db_path) as store:
+            self.assertEqual(store.missing_bodies(), [])
+            self.assertEqual(store.conn.execute("SELECT DISTINCT message FROM emails").fetchall(), [("body",)])
+
+    def test_incremental_sync_fetches_only_history_changes(self):
+        sync_mailbox(db_path=self.db_path, fetcher=self.fetcher)
+        self.assertEqual(self.sync_state("history_id:INBOX"), "100")
+
+        store = self.service.messages_resource.store
+        store["5000"] = {"id": "5000", "payload": {"headers": []}}
+        self.service.history_resource.history_id = "120"
+        self.service.history_resource.records = [
+            {"messagesAdded": [{"message": {"id": "5000", "labelIds": ["INBOX"]}}]},
+            {"messagesAdded": [{"message": {"id": "6000", "labelIds": ["SPAM"]}}]},
+            {"messagesDeleted": [{"message": {"id": "7"}}]},
+            {"labelsAdded": [{"message": {"id": "8", "labelIds": ["INBOX", "Label_1"]}}]},
+            # Archived: the message leaves the INBOX sync
+            {"labelsRemoved": [{"message": {"id": "9", "labelIds": ["Label_1"]}}]},
+            {"labelsRemoved": [{"message": {"id": "6001", "labelIds": []}}]},
+        ]
+        self.assertEqual(sync_mailbox(db_path=self.db_path, fetcher=self.fetcher), 1)
+        self.assertEqual(self.sync_state("history_id:INBOX"), "120")
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0], 1199)
+        self.assertEqual(conn.execute("SELECT labels FROM emails WHERE id = '8'").fetchone()[0], "INBOX,Label_1")
+        self.assertIsNone(conn.execute("SELECT 1 FROM emails WHERE id = '9'").fetchone())
+        conn.close()
+
+    def test_failed_fetches_are_retried_by_the_next_sync(self):
+        self.service.messages_resource.broken = {"5"}
+        self.fetcher.max_retries = 1
+        self.fetcher.backoff = AdaptiveBackoff(initial_delay=0.001)
+        self.assertEqual(sync_mailbox(db_path=self.db_path, fetcher=self.fetcher), 1199)
+        queued = []
+
+        def still_failing(payload):
+            queued.append(payload)
+            raise HttpError(httplib2.Response({"status": 503}), b"backendError")
+
+        # A retryable failure leaves the entry queued for the next sync
+        with EmailStore(self.db_path) as store:
+            self.assertEqual(RetryQueue(store.conn).drain("fetch", still_failing), 0)
+        self.assertEqual(queued, [["5"]])
+
+        self.service.messages_resource.broken = set()
+        self.assertEqual(sync_mailbox(db_path=self.db_path, fetcher=self.fetcher), 1)
+        with EmailStore(self.db_path) as store:
+            self.assertEqual(len(RetryQueue(store.conn)), 0)
+            self.assertEqual(store.conn.execute("SELECT COUNT(*) FROM emails").fetchone()[0], 1200)
+
+    def test_expired_history_falls_back_to_full_sync(self):
+        sync_mailbox(db_path=self.db_path, fetcher=self.fetcher)
+        self.service.history_resource.expired = True
+        self.assertEqual(sync_mailbox(db_path=self.db_path, fetcher=self.fetcher), 1200)
+
+
+class TestEmailStore(unittest.TestCase):
+    def setUp(self):
+        self.db_path = os.path.join(tempfile.mkdtemp(), "emails.db")
+
+    def test_migrates_legacy_database_in_place(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE emails (id TEXT PRIMARY KEY, from_address TEXT, subject TEXT, "
+                     "message TEXT, received_datetime TEXT)")
+        conn.execute("INSERT INTO emails VALUES ('a', 'x@example.com', 's', 'm', "
+                     "'Thu, 01 Jan 1970 00:01:00 +0000')")
+        conn.commit()
+        conn.close()
+
+        with EmailStore(self.db_path) as store:
+            row = store.conn.execute("SELECT id, received_ts FROM emails").fetchone()
+            indexes = {row[1] for row in store.conn.execute("PRAGMA index_list(emails)")}
+            journal_mode = store.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(row, ("a", 60))
+        self.assertTrue({"idx_emails_from_address", "idx_emails_received_ts"} <= indexes)
+        self.assertEqual(journal_mode, "wal")
+
+    def test_store_keeps_rowid_on_update(self):
+        email = {"id": "a", "from": "x", "subject": "s", "message": "m", "received_datetime": None,
+                 "labels": ["INBOX"], "thread_id": "t", "internal_date": "120000"}
+        with EmailStore(self.db_path) as store:
+            store.store_emails([email])
+            rowid = store.conn.execute("SELECT rowid FROM emails WHERE id = 'a'").fetchone()[0]
+            store.store_emails([dict(email, subject="changed")])
+            row = store.conn.execute("SELECT rowid, subject, received_ts, labels FROM emails").fetchone()
+        self.assertEqual(row, (rowid, "changed", 120, "INBOX"))
+
+    def test_unchanged_emails_keep_their_sequence_number(self):
+        email = {"id": "a", "from": "x", "subject": "s", "message": "m", "received_datetime": None,
+                 "labels": ["INBOX"], "thread_id": "t", "internal_date": "120000"}
+        with EmailStore(self.db_path) as store:
+            def seq():
+                return store.conn.execute("SELECT modified_seq FROM emails WHERE id = 'a'").fetchone()[0]
+
+            store.store_emails([email])
+            stored = seq()
+            # A metadata-only resync or a full refetch of the same email changes nothing
+            store.store_emails([dict(email, message="", body_fetched=False)])
+            store.store_emails([email])
+            self.assertEqual(seq(), stored)
+            self.assertEqual(store.conn.execute("SELECT message FROM emails").fetchone()[0], "m")
+
+            store.store_emails([dict(email, labels=["INBOX", "STARRED"], message="", body_fetched=False)])
+            self.assertGreater(seq(), stored)
+
+
+class TestBodyCompression(unittest.TestCase):
+    def setUp(self):
+        self.emails = [parse_email(message) for message in generate_mailbox(
+            MailboxSpec(messages=120, body_words=(20, 60), senders=10, days=30))]
+        self.rules = [RuleCollection(data, source=f"{i}.json") for i, data in enumerate(generate_rules(8))]
+
+    def evaluate(self, compression):
+        service = FakeService()
+        with EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db")) as store:
+            if compression:
+                store.set_body_compression(compression)
+            store.store_emails(self.emails)
+            plain = store.conn.execute("SELECT count(*) FROM emails WHERE message IS NOT NULL").fetchone()[0]
+            matches = process_emails(store.conn, self.rules, ActionAccumulator(service))
+        return plain, matches, service.messages_resource.batch_modify_calls
+
+    def test_compressed_bodies_give_the_same_rule_results(self):
+        plain_rows, *plain = self.evaluate(None)
+        compressed_rows, *compressed = self.evaluate("zlib")
+        self.assertEqual((plain_rows, compressed_rows), (120, 0))
+        self.assertEqual(compressed, plain)
+
+    def test_bodies_convert_both_ways_and_load_lazily(self):
+        with EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db")) as store:
+            store.store_emails(self.emails)
+            self.assertEqual(store.set_body_compression("zlib"), 120)
+            dictionaries = store.conn.execute("SELECT count(*) FROM body_dictionaries").fetchone()[0]
+            self.assertEqual(dictionaries, 1)
+
+            # A re-fetched body replaces the compressed one
+            store.store_emails([dict(self.emails[0], message="replaced body")])
+            METRICS.reset()
+            rows = {email["ID"]: email for email in select_candidates(store.conn, [RuleCollection(
+                {"rule_type": "all", "rules": [{"field": "Message", "predicate": "contains", "value": "x"}]})])}
+            self.assertFalse(any(row.body_loaded for row in rows.values()))
+            self.assertEqual(rows[self.emails[0]["id"]]["Message"], "replaced body")
+            self.assertEqual(rows[self.emails[1]["id"]]["Message"], self.emails[1]["message"])
+            self.assertEqual(METRICS.summary()["counters"][0]["value"], 2)
+
+            self.assertEqual(store.set_body_compression(None), 120)
+            stored = dict(store.conn.execute("SELECT id, message FROM emails"))
+        self.assertEqual(stored, dict({email["id"]: email["message"] for email in self.emails},
+                                      **{self.emails[0]["id"]: "replaced body"}))
+        self.assertIsNotNone(train_dictionary("zlib", [email["message"] for email in self.emails]))
+        self.assertIsNone(train_dictionary("zlib", ["alpha", "beta"]))
+
+
+class TestRuleSqlCompiler(unittest.TestCase):
+    EMAILS = [
+        ("1", "HappyFox <jobs@happyfox.com>", "Your interview", "Congratulations, you are selected",
+         "Mon, 02 Jan 2023 10:00:00 +0000"),
+        ("2", "friend@example.org", "Lunch?", "Happy Fox party later", "Tue, 03 Jan 2023 10:00:00 +0000"),
+        ("3", "news@example.com", "", "Weekly jobs digest", "Wed, 04 Jan 2023 10:00:00 +0000"),
+        ("4", "Boss@Example.com", "Café menu", None, "Thu, 05 Jan 2023 10:00:00 +0000"),
+    ]
+    RULE_SETS = [
+        ("any", [("From", "contains", "happyfox"), ("Message", "contains", "happy fox")]),
+        ("all", [("Subject", "does not contain", "lunch"), ("Message", "contains", "job")]),
+        ("all", [("From", "equals", "boss@example.com")]),
+        ("any", [("From", "not equals", "boss@example.com"), ("Subject", "contains", "café")]),
+        ("all", [("Subject", "contains", "café"), ("From", "contains", "example")]),
+        ("all", [("Received Date/Time", "greater than", "1 D"), ("Subject", "contains", "you")]),
+        ("any", [("Received Date/Time", "less than", "1 D")]),
+        ("any", []),
+    ]
+
+    def setUp(self):
+        self.store = EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db"))
+        self.store.store_emails([{"id": email_id, "from": sender, "subject": subject, "message": message,
+                                  "received_datetime": received}
+                                 for email_id, sender, subject, message, received in self.EMAILS])
+
+    def tearDown(self):
+        self.store.close()
+
+    def rule_collection(self, rule_type, rules):
+        return RuleCollection({"rule_type": rule_type, "rules": [
+            {"field": field, "predicate": predicate, "value": value} for field, predicate, value in rules]})
+
+    def test_matches_python_evaluation(self):
+        for rule_type, rules in self.RULE_SETS:
+            rule_collection = self.rule_collection(rule_type, rules)
+            expected = {email_id for email_id, sender, subject, message, received in self.EMAILS
+                        if rule_collection.matches({"From": sender, "Subject": subject, "Message": message,
+                                                    "Received Date/Time": received})}
+            candidates = {email["ID"]: email for email in select_candidates(self.store.conn, [rule_collection])}
+            found = {email_id for email_id, email in candidates.items() if rule_collection.matches(email)}
+            self.assertEqual(found, expected, (rule_type, rules))
+            # Exact conditions leave nothing for Python to rule out
+            if compile_rule_collection(rule_collection, use_fts=True).exact:
+                self.assertEqual(set(candidates), expected, (rule_type, rules))
+
+    def test_contains_uses_full_text_index(self):
+        rule_collection = self.rule_collection("any", [("Message", "contains", "Happy Fox"),
+                                                       ("Subject", "contains", "you")])
+        query = compile_rule_collection(rule_collection, use_fts=True)
+        self.assertTrue(query.exact)
+        self.assertEqual(query.where.count("emails_fts MATCH"), 2)
+        self.assertEqual(query.params, ['message : "happy fox"', 'subject : "you"'])
+
+        # The index follows updates and deletes made to the emails table
+        self.store.store_emails([{"id": "3", "from": "news@example.com", "subject": "Thank you",
+                                  "message": "", "received_datetime": None}])
+        self.store.delete_emails(["2"])
+        found = {email["ID"] for email in select_candidates(self.store.conn, [rule_collection])}
+        self.assertEqual(found, {"1", "3"})
+
+    def test_non_ascii_value_falls_back_to_python(self):
+        query = compile_rule_collection(self.rule_collection("all", [("Subject", "contains", "café"),
+                                                                     ("From", "contains", "example")]))
+        self.assertFalse(query.exact)
+        self.assertIn("instr", query.where)
+        self.assertEqual(query.fields, ["ID", "From", "Subject"])
+
+
+class TestCompiledRuleSet(unittest.TestCase):
+    def test_needle_matcher_finds_overlapping_needles(self):
+        matcher = NeedleMatcher(["job", "jobs", "obs", "happy fox", "fox", "x"])
+        self.assertEqual(matcher.find("new jobs at happy fox"), {"job", "jobs", "obs", "happy fox", "fox", "x"})
+        self.assertEqual(matcher.find("no match here"), set())
+
+    def test_matches_each_rule_collection(self):
+        rule_collections = [RuleCollection({"rule_type": rule_type, "rules": [
+            {"field": field, "predicate": predicate, "value": value} for field, predicate, value in rules]})
+            for rule_type, rules in TestRuleSqlCompiler.RULE_SETS]
+        engine = CompiledRuleSet(rule_collections)
+        for email_id, sender, subject, message, received in TestRuleSqlCompiler.EMAILS:
+            email = {"ID": email_id, "From": sender, "Subject": subject, "Message": message,
+                     "Received Date/Time": received}
+            expected = [rule_collection for rule_collection in rule_collections if rule_collection.matches(email)]
+            self.assertEqual(engine.match(email), expected, email_id)
+
+    def test_date_windows_are_decided_like_each_rule(self):
+        rule_collections = [RuleCollection({"rule_type": "any", "rules": [
+            {"field": "Received Date/Time", "predicate": predicate, "value": value}]})
+            for predicate in ("less than", "greater than") for value in ("1 D", "3 D", "2 M", "soon")]
+        engine = CompiledRuleSet(rule_collections)
+        now = 1700000000
+        for age in (0, 3600, 86400, 86400 * 2, 86400 * 3, 86400 * 59, 86400 * 61, None):
+            email = {"ID": str(age), "received_ts": None if age is None else now - age}
+            expected = [rule_collection for rule_collection in rule_collections
+                        if rule_collection.matches(email, now)]
+            self.assertEqual(engine.match(email, now=now), expected, age)
+
+    def test_loads_rule_directories(self):
+        rules_dir = tempfile.mkdtemp()
+        for name, content in (("a.json", '{"rule_type": "any", "rules": []}'),
+                              ("b.json", '{"rule_type": "all", "rules": []}'),
+                              ("broken.json", '{"rules": [,]}')):
+            with open(os.path.join(rules_dir, name), "w") as f:
+                f.write(content)
+        rule_collections = load_rule_collections([rules_dir])
+        self.assertEqual([os.path.basename(rc.source) for rc in rule_collections], ["a.json", "b.json"])
+
+    def test_candidates_cover_every_rule_collection(self):
+        store = EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db"))
+        store.store_emails([{"id": email_id, "from": sender, "subject": subject, "message": message,
+                             "received_datetime": received}
+                            for email_id, sender, subject, message, received in TestRuleSqlCompiler.EMAILS])
+        rule_collections = [RuleCollection({"rule_type": "any", "rules": [
+            {"field": "From", "predicate": "contains", "value": "happyfox"}]}), RuleCollection(
+            {"rule_type": "all", "rules": [{"field": "Subject", "predicate": "equals", "value": "lunch?"}]})]
+        candidates = list(select_candidates(store.conn, rule_collections, batch_size=1))
+        self.assertEqual(sorted(email["ID"] for email in candidates), ["1", "2"])
+        self.assertFalse(candidates[0].body_loaded)
+        self.assertEqual(candidates[0].get("Message"), "Congratulations, you are selected")
+        self.assertTrue(candidates[0].body_loaded)
+        store.close()
+
+    def test_body_is_loaded_only_when_headers_leave_rules_undecided(self):
+        store = EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db"))
+        store.store_emails([{"id": email_id, "from": sender, "subject": subject, "message": message,
+                             "received_datetime": received}
+                            for email_id, sender, subject, message, received in TestRuleSqlCompiler.EMAILS])
+        rule_collection = RuleCollection({"rule_type": "any", "rules": [
+            {"field": "From", "predicate": "contains", "value": "happyfox"},
+            {"field": "Message", "predicate": "contains", "value": "happy fox"}]})
+        engine = CompiledRuleSet([rule_collection])
+        emails = {email["ID"]: email for email in select_candidates(store.conn, [rule_collection])}
+        self.assertEqual(engine.match(emails["1"]), [rule_collection])
+        self.assertFalse(emails["1"].body_loaded)
+        self.assertEqual(engine.match(emails["2"]), [rule_collection])
+        self.assertTrue(emails["2"].body_loaded)
+        store.close()
+
+
+class TestRuleLedger(unittest.TestCase):
+    def setUp(self):
+        self.store = EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db"))
+        self.store.store_emails([{"id": email_id, "from": sender, "subject": subject, "message": message,
+                                  "received_datetime": received}
+                                 for email_id, sender, subject, message, received in TestRuleSqlCompiler.EMAILS])
+        self.service = FakeService()
+        self.rule_data = {"rule_type": "any", "rules": [
+            {"field": "Message", "predicate": "contains", "value": "happy fox"},
+            {"field": "From", "predicate": "contains", "value": "example"}],
+            "actions": [{"action_type": "mark", "action_value": "read"}]}
+
+    def tearDown(self):
+        self.store.close()
+
+    def run_rules(self, rule_data, retry_queue=None, **kwargs):
+        accumulator = ActionAccumulator(self.service, scheduler=unpaced_scheduler(), retry_queue=retry_queue)
+        return process_emails(self.store.conn, [RuleCollection(rule_data)], accumulator, **kwargs)
+
+    def test_unchanged_emails_are_not_processed_again(self):
+        self.assertEqual(self.run_rules(self.rule_data), 3)
+        self.assertEqual(self.run_rules(self.rule_data), 0)
+        self.assertEqual(len(self.service.messages_resource.batch_modify_calls), 1)
+
+        # A changed email is evaluated again, and so is everything after a rule edit
+        self.store.store_emails([{"id": "5", "from": "new@example.com", "subject": "", "message": "",
+                                  "received_datetime": None}])
+        self.assertEqual(self.run_rules(self.rule_data), 1)
+        self.assertEqual(self.run_rules(dict(self.rule_data, rule_type="Any")), 4)
+        self.assertEqual(self.run_rules(self.rule_data, reprocess=True), 4)
+
+    def test_actions_are_sent_and_recorded_chunk_by_chunk(self):
+        committed = []
+
+        def batch_modify(userId, body):
+            committed.append(self.store.conn.execute("SELECT COUNT(*) FROM rule_ledger").fetchone()[0])
+            return FakeRequest()
+
+        self.service.messages_resource.batchModify = batch_modify
+        with unittest.mock.patch("gmailops.LEDGER_CHUNK", 1):
+            self.assertEqual(self.run_rules(self.rule_data), 3)
+        # Each email's actions go out before its result is committed, and before the next email's
+        self.assertEqual(committed, [0, 1, 2])
+        self.assertEqual(self.store.conn.execute("SELECT COUNT(*) FROM rule_ledger").fetchone()[0], 3)
+
+    def test_emails_whose_actions_were_rejected_are_evaluated_again(self):
+        queue = RetryQueue(self.store.conn)
+        self.service.messages_resource.modify_failure = FailingRequest(400)
+        with self.assertLogs("actions", "ERROR"):
+            self.assertEqual(self.run_rules(self.rule_data, retry_queue=queue), 3)
+        self.assertEqual(self.store.conn.execute("SELECT COUNT(*) FROM rule_ledger").fetchone()[0], 0)
+
+        self.service.messages_resource.modify_failure = None
+        self.assertEqual(self.run_rules(self.rule_data, retry_queue=queue), 3)
+        self.assertEqual(len(self.service.messages_resource.batch_modify_calls), 1)
+
+    def test_ledger_rows_are_loaded_once_per_chunk(self):
+        statements = []
+        for edit, cache in enumerate((None, PredicateCache(self.store.conn))):
+            self.run_rules(self.rule_data, cache=cache)
+            # Every email changes, so each is evaluated again
+            self.store.store_emails([{"id": email_id, "from": sender, "subject": f"{subject} ({edit})",
+                                      "message": message, "received_datetime": received}
+                                     for email_id, sender, subject, message, received in TestRuleSqlCompiler.EMAILS])
+            self.store.conn.set_trace_callback(statements.append)
+            self.assertEqual(self.run_rules(self.rule_data, cache=cache), 3)
+            self.store.conn.set_trace_callback(None)
+        reads = [statement for statement in statements if "FROM rule_ledger WHERE message_id" in statement]
+        self.assertEqual(len(reads), 2)
+        self.assertTrue(all("message_id IN (" in statement for statement in reads))
+
+    def test_a_failing_rule_collection_does_not_cost_the_others(self):
+        good = RuleCollection(self.rule_data)
+        bad = RuleCollection({"rule_type": "all", "rules": [
+            {"field": "Received Date/Time", "predicate": "greater than", "value": "1 D"}],
+            "actions": [{"action_type": "mark", "action_value": "unread"}]})
+        bad.rules[0].evaluate = unittest.mock.Mock(side_effect=ValueError("broken"))
+        # The compiled engine fails too, so each collection is evaluated on its own
+        with self.assertLogs("gmailops", "WARNING"), \
+                unittest.mock.patch.object(CompiledRuleSet, "match", side_effect=ValueError("broken")):
+            self.assertEqual(process_emails(self.store.conn, [bad, good], ActionAccumulator(self.service)), 3)
+
+        # Only the good collection's results were recorded; the failing one is tried
+        # again, and now marks every (old) email
+        self.assertEqual(process_emails(self.store.conn, [bad, good], ActionAccumulator(self.service)), 4)
+        self.assertEqual(process_emails(self.store.conn, [bad, good], ActionAccumulator(self.service)), 0)
+
+    def test_date_rules_are_rechecked_when_they_can_flip(self):
+        rule_collection = RuleCollection({"rule_type": "all", "rules": [
+            {"field": "Received Date/Time", "predicate": "greater than", "value": "1 D"}]})
+        email = {"received_ts": 1000}
+        self.assertEqual(recheck_after(rule_collection, email, now=1000), 1000 + 86400)
+        self.assertIsNone(recheck_after(rule_collection, email, now=1000 + 86400))
+
+
+class TestBodyExtraction(unittest.TestCase):
+    def message(self, plain=None, html=None, charset="utf-8"):
+        from email.message import EmailMessage
+        message = EmailMessage()
+        message["From"] = "news@example.com"
+        message["Subject"] = "Newsletter"
+        message["Date"] = "Thu, 01 Jan 1970 00:00:00 +0000"
+        if plain is not None:
+            message.set_content(plain, charset=charset)
+        if html is not None:
+            if plain is None:
+                message.set_content(html, subtype="html", charset=charset)
+            else:
+                message.add_alternative(html, subtype="html", charset=charset)
+        return message
+
+    def test_prefers_plain_text_in_nested_multipart(self):
+        message = self.message(plain="Plain café", html="<p>HTML</p>", charset="latin-1")
+        message.make_mixed()
+        message.add_attachment(b"%PDF", maintype="application", subtype="pdf", filename="a.pdf")
+        self.assertEqual(extract_body(to_gmail_payload(message)).strip(), "Plain café")
+
+    def test_strips_html_only_messages(self):
+        message = self.message(html="<html><style>p {}</style><p>Job &amp; interview</p><br>Soon</html>")
+        self.assertEqual(extract_body(to_gmail_payload(message)), "Job & interview\nSoon")
+        self.assertEqual(html_to_text("<b>a</b> <i>b</i>"), "a b")
+
+    def test_raw_format_and_process_pool(self):
+        import base64
+        raw = base64.urlsafe_b64encode(self.message(plain="Raw body").as_bytes()).decode()
+        details = [{"id": "1", "raw": raw},
+                   {"id": "2", "payload": to_gmail_payload(self.message(html="<p>Hi</p>"))}]
+        with BodyDecoder(parse_email, workers=2) as decoder:
+            parsed = decoder.submit(details).result()
+        self.assertEqual([email["message"].strip() for email in parsed], ["Raw body", "Hi"])
+        self.assertEqual(parsed[0]["subject"], "Newsletter")
+
+
+def publish(address, history_id, token=None, data=None):
+    """Deliver a Gmail notification the way a Pub/Sub push subscription does."""
+    if data is None:
+        data = base64.b64encode(json.dumps({"emailAddress": "me@example.com", "historyId": history_id}).encode())
+    body = json.dumps({"message": {"data": data.decode() if isinstance(data, bytes) else data,
+                                   "messageId": history_id}, "subscription": "projects/p/subscriptions/s"})
+    url = f"http://{address[0]}:{address[1]}/gmail/push" + (f"?token={token}" if token else "")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, body.encode(), method="POST")) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.source = PushSource(port=0, token="secret")
+        self.source.start()
+
+    def tearDown(self):
+        self.source.close()
+
+    def test_push_notifications_are_validated_and_coalesced(self):
+        self.assertEqual(publish(self.source.address, "5", token="wrong"), 403)
+        self.assertEqual(publish(self.source.address, "5", token="secret", data="not base64 json"), 400)
+        for history_id in ("7", "9", "8"):
+            self.assertEqual(publish(self.source.address, history_id, token="secret"), 204)
+        notification = self.source.wait(timeout=1)
+        self.assertEqual((notification["source"], notification["historyId"]), ("push", "9"))
+        self.assertEqual(self.source.wait(timeout=0.01), {"source": "timeout"})
+
+    def test_new_mail_is_processed_after_a_push(self):
+        service = FakeService()
+        service.messages_resource.store["1"] = {"id": "1", "payload": {"headers": [
+            {"name": "From", "value": "old@example.com"}]}}
+        rules_dir = tempfile.mkdtemp()
+        with open(os.path.join(rules_dir, "rules.json"), "w") as f:
+            json.dump({"rule_type": "all", "rules": [{"field": "From", "predicate": "contains", "value": "fox"}],
+                       "actions": [{"action_type": "mark", "action_value": "read"}]}, f)
+        daemon = Daemon([rules_dir], self.source, db_path=os.path.join(tempfile.mkdtemp(), "emails.db"),
+                        service_factory=lambda: service, topic="projects/p/topics/gmail")
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        try:
+            # A push the startup sync already covered is ignored
+            publish(self.source.address, "100", token="secret")
+            service.messages_resource.store["2"] = {"id": "2", "payload": {"headers": [
+                {"name": "From", "value": "happy@fox.com"}]}}
+            service.history_resource.records = [{"messagesAdded": [{"message": {"id": "2", "labelIds": ["INBOX"]}}]}]
+            service.history_resource.history_id = "101"
+            publish(self.source.address, "101", token="secret")
+            deadline = time.time() + 5
+            while not service.messages_resource.batch_modify_calls and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            daemon.stop()
+            thread.join(5)
+        self.assertEqual(service.messages_resource.batch_modify_calls,
+                         [{"ids": ["2"], "addLabelIds": [], "removeLabelIds": ["UNREAD"]}])
+        self.assertEqual(service.watch_calls[0]["topicName"], "projects/p/topics/gmail")
+
+    def test_failed_watch_at_startup_is_retried(self):
+        service = FakeService()
+        service.messages_resource.store["1"] = {"id": "1", "payload": {"headers": [
+            {"name": "From", "value": "happy@fox.com"}]}}
+        # More 5xx answers than the scheduler retries, so the error reaches the daemon
+        failures = [FailingRequest(500) for _ in range(6)]
+        watch = service.watch
+        service.watch = lambda userId, body: failures.pop() if failures else watch(userId, body)
+        rules_dir = tempfile.mkdtemp()
+        with open(os.path.join(rules_dir, "rules.json"), "w") as f:
+            json.dump({"rule_type": "all", "rules": [{"field": "From", "predicate": "contains", "value": "fox"}],
+                       "actions": [{"action_type": "mark", "action_value": "read"}]}, f)
+        daemon = Daemon([rules_dir], self.source, db_path=os.path.join(tempfile.mkdtemp(), "emails.db"),
+                        service_factory=lambda: service, topic="projects/p/topics/gmail")
+        daemon.scheduler = unpaced_scheduler()
+        with unittest.mock.patch("daemon.backoff_delay", return_value=0):
+            thread = threading.Thread(target=daemon.run)
+            thread.start()
+            try:
+                deadline = time.time() + 5
+                while not service.messages_resource.batch_modify_calls and time.time() < deadline:
+                    time.sleep(0.01)
+            finally:
+                daemon.stop()
+                thread.join(5)
+        self.assertEqual(len(service.watch_calls), 1)
+        self.assertEqual(service.messages_resource.batch_modify_calls[0]["ids"], ["1"])
+
+    def test_move_targets_are_resolved_once_per_rule_load(self):
+        service = FakeService()
+        service.labels_resource.labels.append({"id": "Label_7", "name": "Receipts", "type": "user"})
+        rules_dir = tempfile.mkdtemp()
+        rule_file = os.path.join(rules_dir, "rules.json")
+        with open(rule_file, "w") as f:
+            json.dump({"rule_type": "all", "rules": [{"field": "From", "predicate": "contains", "value": "fox"}],
+                       "actions": [{"action_type": "move", "action_value": "receipts"}]}, f)
+        daemon = Daemon([rules_dir], self.source, db_path=os.path.join(tempfile.mkdtemp(), "emails.db"),
+                        service_factory=lambda: service)
+        daemon.open()
+        self.addCleanup(daemon.store.close)
+        with unittest.mock.patch("daemon.resolve_labels", wraps=resolve_labels) as resolve:
+            daemon.run_once()
+            daemon.run_once()
+            self.assertEqual(resolve.call_count, 1)
+            self.assertEqual(daemon.rules[0].label_ids, {"receipts": "Label_7"})
+            os.utime(rule_file, (time.time() + 10, time.time() + 10))
+            daemon.run_once()
+            self.assertEqual(resolve.call_count, 2)
+
+            # A target without a label is checked again every cycle until it has one
+            with open(rule_file, "w") as f:
+                json.dump({"rule_type": "all", "rules": [{"field": "From", "predicate": "contains", "value": "fox"}],
+                           "actions": [{"action_type": "move", "action_value": "Travel"}]}, f)
+            os.utime(rule_file, (time.time() + 20, time.time() + 20))
+            with self.assertLogs("labels", "ERROR"):
+                daemon.run_once()
+                daemon.run_once()
+            self.assertEqual(resolve.call_count, 4)
+            service.labels_resource.labels.append({"id": "Label_9", "name": "Travel", "type": "user"})
+            daemon.run_once()
+            daemon.run_once()
+            self.assertEqual(resolve.call_count, 5)
+            self.assertEqual(daemon.rules[0].label_ids, {"Travel": "Label_9"})
+
+    def test_date_rules_follow_the_clock_across_cycles(self):
+        service = FakeService()
+        started = 1700000000
+        service.messages_resource.store["1"] = {"id": "1", "internalDate": str((started - 86400) * 1000),
+                                                "payload": {"headers": [{"name": "From", "value": "a@example.com"}]}}
+        rules_dir = tempfile.mkdtemp()
+        with open(os.path.join(rules_dir, "rules.json"), "w") as f:
+            json.dump({"rule_type": "all", "rules": [
+                {"field": "Received Date/Time", "predicate": "greater than", "value": "2 D"}],
+                "actions": [{"action_type": "mark", "action_value": "read"}]}, f)
+        daemon = Daemon([rules_dir], self.source, db_path=os.path.join(tempfile.mkdtemp(), "emails.db"),
+                        service_factory=lambda: service)
+        daemon.open()
+        self.addCleanup(daemon.store.close)
+        self.assertEqual(daemon.run_once(now=started), 0)
+        # Two days later the same daemon, with the same loaded rules, sees the email as old enough
+        self.assertEqual(daemon.run_once(now=started + 2 * 86400), 1)
+        self.assertEqual(service.messages_resource.batch_modify_calls,
+                         [{"ids": ["1"], "addLabelIds": [], "removeLabelIds": ["UNREAD"]}])
+
+
+class TestAccounts(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.registry = os.path.join(self.base_dir, "accounts.json")
+        self.write_registry([{"name": "alice"}, {"name": "bob", "rules": ["./rules/Happy_Fox.json"]},
+                             {"name": "carol", "label_ids": []}])
+
+    def write_registry(self, accounts):
+        with open(self.registry, "w") as f:
+            json.dump({"defaults": {"base_dir": self.base_dir, "quota_per_second": 100,
+                                    "rules": ["./rules/Happy_Fox.json"]},
+                       "accounts": accounts}, f)
+
+    def test_registry_gives_every_account_its_own_token_and_database(self):
+        alice, bob, carol = load_accounts(self.registry)
+        self.assertEqual(alice.token_file, os.path.join(self.base_dir, "alice", "token.json"))
+        self.assertNotEqual(alice.db_path, bob.db_path)
+        self.assertEqual((bob.rules, bob.quota_per_second, carol.label_ids), (["./rules/Happy_Fox.json"], 100, []))
+
+        self.write_registry([{"name": "alice"}, {"name": "alice"}])
+        with self.assertRaises(ValueError):
+            load_accounts(self.registry)
+
+    def test_accounts_run_by_backlog_across_processes(self):
+        alice, bob, carol = load_accounts(self.registry)
+        for account, count in ((alice, 1), (bob, 3)):
+            os.makedirs(account.directory)
+            with EmailStore(account.db_path) as store:
+                # Emails no rule can match are never evaluated, so they are not backlog
+                store.store_emails([{"id": str(i), "from": "a@happyfox.com" if i < count else "a@example.com",
+                                     "subject": "", "message": "", "received_datetime": None}
+                                    for i in range(count + 5)])
+        self.assertEqual((alice.backlog(), bob.backlog(), carol.backlog()), (1, 3, UNKNOWN_BACKLOG))
+        with EmailStore(bob.db_path) as store:
+            process_emails(store.conn, load_rule_collections(bob.rules),
+                           ActionAccumulator(FakeService(), scheduler=unpaced_scheduler()))
+        self.assertEqual(bob.backlog(), 0)
+
+        summaries = run_accounts([alice, bob, carol], workers=0, process=lambda account, full: {"account": account.name})
+        order = [summary["account"] for summary in summaries]
+        self.assertEqual(order, ["carol", "alice", "bob"])
+
+        # Without tokens every worker reports its account as failed instead of prompting for a login
+        summaries = list(run_accounts([alice, bob, carol], workers=2, process=process_account))
+        self.assertEqual(sorted(summary["account"] for summary in summaries), ["alice", "bob", "carol"])
+        self.assertTrue(all("authorize" in summary["error"] for summary in summaries))
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    def test_summary_and_prometheus_text(self):
+        metrics = Metrics()
+        metrics.increment("api_errors", method="messages.get", status=429)
+        with metrics.timer("stage", stage="decode"):
+            pass
+        metrics.observe("stage", 2.5, stage="decode")
+        summary = json.loads(json.dumps(metrics.summary()))
+        self.assertEqual(summary["timers"][0]["count"], 2)
+        self.assertEqual(summary["timers"][0]["max_seconds"], 2.5)
+
+        text = metrics.to_prometheus()
+        self.assertIn('gmail_rules_api_errors_total{method="messages.get",status="429"} 1', text)
+        self.assertIn('gmail_rules_stage_seconds_count{stage="decode"} 2', text)
+
+        server = MetricsServer(port=0, metrics=metrics).start()
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.address[1]}/metrics") as response:
+                self.assertEqual(response.read().decode(), text)
+        finally:
+            server.close()
+
+    def test_runs_record_api_calls_and_rule_hits(self):
+        service = FakeService()
+        for i in range(60):
+            service.messages_resource.store[str(i)] = {"id": str(i), "payload": {"headers": [
+                {"name": "From", "value": "jobs@happyfox.com" if i % 3 == 0 else "someone@example.com"}]}}
+        store = EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db"))
+        self.addCleanup(store.close)
+        sync_mailbox(fetcher=BatchFetcher(lambda: service, scheduler=unpaced_scheduler()), store=store)
+        rules = [RuleCollection({"rule_name": "Happy Fox", "rule_type": "all", "rules": [
+                     {"field": "From", "predicate": "contains", "value": "happyfox"}]}),
+                 RuleCollection({"rule_name": "Nobody", "rule_type": "all", "rules": [
+                     {"field": "From", "predicate": "equals", "value": "nobody"}]})]
+        process_emails(store.conn, rules, ActionAccumulator(service))
+
+        def find(kind, name, **labels):
+            return next(entry for entry in METRICS.summary()[kind]
+                        if entry["name"] == name and entry["labels"] == {k: str(v) for k, v in labels.items()})
+
+        self.assertEqual(find("timers", "api_call", method="messages.get")["count"], 60)
+        self.assertEqual(find("timers", "api_call", method="getProfile")["count"], 1)
+        self.assertEqual(find("counters", "emails_stored")["value"], 60)
+        self.assertEqual(find("counters", "rule_hits", rule="Happy Fox")["value"], 20)
+        self.assertEqual(find("counters", "rule_hits", rule="Nobody")["value"], 0)
+        # Only the SQL candidates are evaluated in Python
+        self.assertEqual(find("timers", "rule_evaluation", rule="Nobody")["count"], 20)
+
+
+class TestParallelEvaluation(unittest.TestCase):
+    def setUp(self):
+        self.emails = [parse_email(message) for message in generate_mailbox(
+            MailboxSpec(messages=300, body_words=(5, 30), senders=20, days=60))]
+        self.rules = [RuleCollection(data, source=f"{i}.json") for i, data in enumerate(generate_rules(12))]
+
+    def evaluate(self, workers):
+        # Shards send their actions from their own process, so they are compared through the metrics
+        METRICS.reset()
+        with EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db")) as store:
+            store.store_emails(self.emails)
+            matches = process_emails(store.conn, self.rules, ActionAccumulator(FakeService()), workers=workers)
+            ledger = store.conn.execute("SELECT message_id, rule_hash, matched, actions, evaluated_seq "
+                                        "FROM rule_ledger ORDER BY message_id, rule_hash").fetchall()
+        return matches, METRICS.counters.get(("emails_modified", ())), ledger
+
+    def test_sharded_evaluation_matches_the_serial_path(self):
+        serial = self.evaluate(workers=0)
+        self.assertGreater(serial[0], 0)
+        self.assertGreater(serial[1], 0)
+        self.assertEqual(self.evaluate(workers=2), serial)
+
+    def test_rowid_shards_cover_the_table(self):
+        conn = sqlite3.connect(":memory:")
+        migrate(conn)
+        self.assertEqual(rowid_shards(conn, 4), [])
+        conn.executemany("INSERT INTO emails (id, rowid) VALUES (?, ?)", [(str(i), i) for i in range(3, 13)])
+        self.assertEqual(rowid_shards(conn, 4), [(3, 5), (6, 8), (9, 11), (12, 12)])
+        self.assertEqual(rowid_shards(conn, 20)[-1], (12, 12))
+        self.assertEqual(len(rowid_shards(conn, 20)), 10)
+
+
+class TestPredicateCache(unittest.TestCase):
+    def setUp(self):
+        self.emails = [parse_email(message) for message in generate_mailbox(
+            MailboxSpec(messages=200, body_words=(5, 30), senders=20, days=60))]
+        self.rules = [RuleCollection(data, source=f"{i}.json") for i, data in enumerate(generate_rules(10))]
+        self.rules.append(RuleCollection({"rule_type": "any", "rules": [
+            {"field": "Subject", "predicate": "contains", "value": "Café"},
+            {"field": "From", "predicate": "equals", "value": "SENDER3@mail.example.org"}]}))
+        self.store = EmailStore(os.path.join(tempfile.mkdtemp(), "emails.db"))
+        self.addCleanup(self.store.close)
+        self.store.store_emails(self.emails)
+
+    def expected(self, rule_collection):
+        rowids = dict(self.store.conn.execute("SELECT id, rowid FROM emails"))
+        return {rowids[email["id"]] for email in self.emails if rule_collection.matches(
+            {"From": email["from"], "Subject": email["subject"], "Message": email["message"],
+             "Received Date/Time": email["received_datetime"]})}
+
+    def test_bitmaps_match_the_rules_and_follow_changes(self):
+        # Built with SQL queries here; the few changes below are checked in Python
+        with unittest.mock.patch("predicate_cache.PYTHON_REFRESH_LIMIT", 0):
+            for rule_collection in self.rules:
+                self.assertEqual(set(to_rowids(PredicateCache(self.store.conn).match(rule_collection))),
+                                 self.expected(rule_collection))
+
+        # New, changed and deleted emails are applied incrementally
+        changed = dict(self.emails[5], subject="Café offer", message="happy fox")
+        added = dict(self.emails[6], id="new", subject="job interview")
+        self.store.delete_emails([self.emails[7]["id"]])
+        self.store.store_emails([changed, added])
+        self.emails = [email for email in self.emails if email["id"] != self.emails[7]["id"]]
+        self.emails[5:6] = [changed]
+        self.emails.append(added)
+        METRICS.reset()
+        cache = PredicateCache(self.store.conn)
+        for rule_collection in self.rules:
+            self.assertEqual(set(to_rowids(cache.match(rule_collection))), self.expected(rule_collection))
+        self.assertTrue(METRICS.summary()["counters"])
+
+        # Known predicates are not evaluated again, whichever rule combines them
+        METRICS.reset()
+        combined = RuleCollection({"rule_type": "all", "rules": [
+            {"field": rule.field, "predicate": rule.predicate, "value": rule.value.upper()}
+            for rule in self.rules[0].rules[:1] + self.rules[-1].rules[:1]]})
+        PredicateCache(self.store.conn).match(combined)
+        self.assertEqual(METRICS.summary()["counters"], [])
+
+    def test_bitmap_evaluation_applies_the_same_actions(self):
+        def run(**kwargs):
+            service = FakeService()
+            self.store.conn.execute("DELETE FROM rule_ledger")
+            matches = process_emails(self.store.conn, self.rules, ActionAccumulator(service), **kwargs)
+            return matches, sorted((call["removeLabelIds"], sorted(call["ids"]))
+                                   for call in service.messages_resource.batch_modify_calls)
+
+        serial = run()
+        self.assertGreater(serial[0], 0)
+        self.assertEqual(run(cache=PredicateCache(self.store.conn)), serial)
+        self.assertEqual(run(cache=PredicateCache(self.store.conn))[0], serial[0])
+        self.assertEqual(to_rowids(from_rowids([0, 9, 3, 1000])), [0, 3, 9, 1000])
+
+        # Sequence numbers are never reused after the newest emails are deleted
+        seq = self.store.conn.execute("SELECT max(modified_seq) FROM emails").fetchone()[0]
+        self.store.delete_emails([email["id"] for email in self.emails])
+        self.store.store_emails(self.emails[:1])
+        self.assertEqual(self.store.conn.execute("SELECT modified_seq FROM emails").fetchone()[0], seq + 1)
+
+
+class MockGmailServer(ThreadingHTTPServer):
+    """A local HTTP server answering the Gmail REST calls the async client makes."""
+
+    def __init__(self):
+        self.messages = {}
+        self.throttled = set()
+        self.batch_modify_calls = []
+        self.connections = 0
+        super().__init__(("127.0.0.1", 0), MockGmailHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/gmail/v1/users/"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class MockGmailHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def reply(self, status, body=None, headers=()):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path[len("/gmail/v1/users/me"):]
+        if path == "/profile":
+            return self.reply(200, {"historyId": "100"})
+        if path == "/messages":
+            ids = sorted(self.server.messages, key=int)
+            start = int(parse_qs(url.query).get("pageToken", ["0"])[0])
+            page = {"messages": [{"id": message_id} for message_id in ids[start:start + 100]]}
+            if start + 100 < len(ids):
+                page["nextPageToken"] = str(start + 100)
+            return self.reply(200, page)
+        message_id = path.rsplit("/", 1)[-1]
+        if message_id in self.server.throttled:
+            self.server.throttled.discard(message_id)
+            return self.reply(429, {"error": {"message": "rateLimitExceeded"}}, [("Retry-After", "0")])
+        self.reply(200, self.server.messages[message_id])
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.batch_modify_calls.append(body)
+        self.reply(204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestAsyncGmailClient(unittest.TestCase):
+    def setUp(self):
+        self.server = MockGmailServer()
+        for i in range(300):
+            self.server.messages[str(i)] = {"id": str(i), "labelIds": ["INBOX"], "payload": {"headers": [
+                {"name": "Subject", "value": f"Subject {i}"}]}}
+        self.server.throttled = {"3", "150", "299"}
+        client = AsyncGmailClient(credentials=SimpleNamespace(token="token", valid=True), base_url=self.server.url,
+                                  max_connections=4, limiter=QuotaLimiter(units_per_second=100000))
+        self.fetcher = AsyncFetcher(client, max_concurrency=16, backoff=AdaptiveBackoff(initial_delay=0.001))
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.stop()
+
+    def test_sync_and_actions_run_over_pooled_connections(self):
+        db_path = os.path.join(tempfile.mkdtemp(), "emails.db")
+        self.assertEqual(sync_mailbox(db_path=db_path, fetcher=self.fetcher), 300)
+        self.assertEqual(self.fetcher.stats.retries, 3)
+
+        accumulator = ActionAccumulator(self.fetcher.service)
+        accumulator.add("1", remove_label_ids=["UNREAD"])
+        accumulator.flush()
+        self.assertEqual(self.server.batch_modify_calls,
+                         [{"ids": ["1"], "addLabelIds": [], "removeLabelIds": ["UNREAD"]}])
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_cli_actions_can_go_over_the_async_transport(self):
+        directory = tempfile.mkdtemp()
+        rule_file = os.path.join(directory, "rules.json")
+        with open(rule_file, "w") as f:
+            json.dump({"rule_type": "all", "rules": [{"field": "From", "predicate": "contains", "value": "fox"}],
+                       "actions": [{"action_type": "mark", "action_value": "read"}]}, f)
+        with EmailStore(os.path.join(directory, "email_database.db")) as store:
+            store.store_emails([{"id": "1", "from": "jobs@happyfox.com", "subject": "", "message": "",
+                                 "received_datetime": None}])
+        cwd = os.getcwd()
+        os.chdir(directory)
+        self.addCleanup(os.chdir, cwd)
+
+        def client(max_connections):
+            return AsyncGmailClient(credentials=SimpleNamespace(token="token", valid=True),
+                                    base_url=self.server.url, max_connections=max_connections)
+
+        with unittest.mock.patch("gmailops.AsyncGmailClient", client), \
+                unittest.mock.patch("sys.argv", ["gmailops.py", rule_file, "--async-connections", "2"]):
+            gmailops.main()
+        self.assertEqual(self.server.batch_modify_calls,
+                         [{"ids": ["1"], "addLabelIds": [], "removeLabelIds": ["UNREAD"]}])
+
+    def test_failed_keep_alive_retry_closes_its_connection(self):
+        pool = ConnectionPool(self.server.url)
+        closed = []
+        stale = SimpleNamespace(close=lambda: closed.append("stale"))
+        fresh = SimpleNamespace(close=lambda: closed.append("fresh"))
+        pool._idle.append(stale)
+
+        async def open_connection():
+            return fresh
+
+        async def send(*args):
+            raise ConnectionResetError()
+
+        pool._open, pool._send = open_connection, send
+        with self.assertRaises(ConnectionResetError):
+            asyncio.run(pool.request("GET", "/", {}))
+        self.assertEqual((closed, pool._idle), (["stale", "fresh"], []))
+
+    def test_responses_are_read_whatever_their_framing(self):
+        responses = {
+            b"/chunked": b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                         b"3\r\n{\"a\r\n5\r\n\": 1}\r\n0\r\n\r\n",
+            b"/close": b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n{\"a\": 2}",
+            b"/silent": b"",
+        }
+
+        async def answer(reader, writer):
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                response = responses[request.split()[1]]
+                if not response:
+                    # Accept the request, never answer it
+                    await reader.read()
+                    return
+                writer.write(response)
+                await writer.drain()
+                if b"close" in response:
+                    writer.close()
+                    return
+
+        async def exchange():
+            server = await asyncio.start_server(answer, "127.0.0.1", 0)
+            pool = ConnectionPool(f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}/", timeout=0.2)
+            try:
+                results = [(await pool.request("GET", path, {}))[2] for path in ("/chunked", "/close")]
+                with self.assertRaises(asyncio.TimeoutError):
+                    await pool.request("GET", "/silent", {})
+                return results, len(pool._idle)
+            finally:
+                pool.close()
+                server.close()
+
+        self.assertEqual(asyncio.run(exchange()), ([b'{"a": 1}', b'{"a": 2}'], 0))
+
+    def test_blocking_calls_give_up_after_the_timeout(self):
+        runner = EventLoopThread(timeout=0.1)
+        self.addCleanup(runner.close)
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            runner.run(asyncio.sleep(10))
+        self.assertLess(time.monotonic() - started, 5)
+
+    def test_quota_limiter_spends_units_at_the_configured_rate(self):
+        limiter = QuotaLimiter(units_per_second=1000, burst=50)
+
+        async def spend():
+            await limiter.acquire(50)
+            for _ in range(20):
+                await limiter.acquire(5)
+
+        started = time.monotonic()
+        asyncio.run(spend())
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        self.assertEqual(limiter.spent, 150)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_generated_mailbox_is_reproducible_and_parses(self):
+        spec = MailboxSpec(messages=50, body_words=(5, 10), senders=3, days=7, seed=3)
+        messages = generate_mailbox(spec, now=1700000000)
+        self.assertEqual(messages, generate_mailbox(spec, now=1700000000))
+        self.assertEqual(len({message["id"] for message in messages}), 50)
+
+        emails = [parse_email(message) for message in messages]
+        self.assertTrue(all(5 <= len(email["message"].split()) <= 10 for email in emails))
+        self.assertLessEqual(len({email["from"] for email in emails}), 3)
+        timestamps = [email_timestamp(email["received_datetime"]) for email in emails]
+        self.assertTrue(all(1700000000 - 7 * 86400 <= ts <= 1700000000 for ts in timestamps))
+        rules = [RuleCollection(data) for data in generate_rules(5)]
+        self.assertTrue(all(rule.rules and rule.actions for rule in rules))
+
+    def test_fake_gmail_throttles_and_records_history(self):
+        messages = generate_mailbox(MailboxSpec(messages=120, body_words=(1, 3)))
+        gmail = FakeGmail(messages, throttle_rate=0.2, retry_after=0)
+        fetcher = BatchFetcher(lambda: gmail, scheduler=unpaced_scheduler(), format="metadata",
+                               backoff=AdaptiveBackoff(initial_delay=0.001, max_delay=0.01))
+        fetched = list(fetcher.fetch(gmail.order))
+        self.assertEqual(sorted(message["id"] for message in fetched), gmail.order)
+        self.assertTrue(all("body" not in message["payload"] for message in fetched))
+        self.assertGreater(gmail.throttled, 0)
+
+        gmail.throttle_rate = 0
+        start = unpaced_scheduler().execute(gmail.users().getProfile(userId="me"), "getProfile")["historyId"]
+        gmail.users().messages().batchModify(userId="me", body={"ids": gmail.order[:2], "addLabelIds": ["Label_1"]}).execute()
+        history = gmail.users().history().list(userId="me", startHistoryId=start).execute()["history"]
+        self.assertEqual([record["labelsAdded"][0]["message"]["id"] for record in history], gmail.order[:2])
+        self.assertIn("Label_1", gmail.mailbox[gmail.order[0]]["labelIds"])
+
+
+class TestLabelCatalog(unittest.TestCase):
+    def setUp(self):
+        self.service = FakeService()
+        self.service.labels_resource.labels.append({"id": "Label_7", "name": "Receipts", "type": "user"})
+        self.store = EmailStore(":memory:")
+        self.addCleanup(self.store.close)
+        self.store.store_emails([{"id": str(i), "from": "shop@example.com", "subject": "", "message": "",
+                                  "received_datetime": None, "labels": ["INBOX"]} for i in range(3)])
+        self.catalog = LabelCatalog(self.store.conn, self.service, unpaced_scheduler())
+
+    def test_named_labels_resolve_and_missing_ones_are_created_together(self):
+        rules = [RuleCollection({"rule_type": "all", "rules": [], "actions": [
+            {"action_type": "move", "action_value": target}]}, source=f"{target}.json")
+            for target in ("receipts", "Label_7", "dd", "Later")]
+        # By default unknown targets are load-time errors, and nothing is created
+        with self.assertLogs("labels", "ERROR") as logs:
+            self.assertEqual(resolve_labels(rules, self.catalog), {"dd", "Later"})
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(self.service.labels_resource.created, [])
+
+        self.assertEqual(resolve_labels(rules, self.catalog, create=True), set())
+        self.assertEqual(self.service.labels_resource.created, ["Later", "dd"])
+        # The labels are listed once more before creating, in case they were made in Gmail meanwhile
+        self.assertEqual((self.service.labels_resource.list_calls, len(self.service.batches)), (2, 1))
+
+        accumulator = ActionAccumulator(self.service, scheduler=unpaced_scheduler())
+        process_emails(self.store.conn, rules, accumulator)
+        added = sorted(label for call in self.service.messages_resource.batch_modify_calls
+                       for label in call["addLabelIds"])
+        self.assertEqual(added, ["Label_3", "Label_4", "Label_7"])
+
+        # An unknown target is skipped instead of failing for every email
+        rules = [RuleCollection({"rule_type": "all", "rules": [], "actions": [
+            {"action_type": "move", "action_value": "typo"}]})]
+        with self.assertLogs("labels", "ERROR"):
+            self.assertEqual(resolve_labels(rules, self.catalog), {"typo"})
+        accumulator = ActionAccumulator(self.service, scheduler=unpaced_scheduler())
+        self.assertEqual(process_emails(self.store.conn, rules, accumulator, reprocess=True), 3)
+        self.assertEqual(accumulator.flush(), 0)
+
+    def test_matches_with_a_missing_label_are_moved_once_it_exists(self):
+        rules = [RuleCollection({"rule_type": "all", "rules": [], "actions": [
+            {"action_type": "move", "action_value": "Travel"}]})]
+        with self.assertLogs("labels", "ERROR"):
+            resolve_labels(rules, self.catalog)
+        process_emails(self.store.conn, rules, ActionAccumulator(self.service, scheduler=unpaced_scheduler()))
+        self.assertEqual(self.store.conn.execute("SELECT COUNT(*) FROM rule_ledger").fetchone()[0], 0)
+
+        # A label created in Gmail since is picked up by listing the labels again, without waiting for max_age
+        self.service.labels_resource.labels.append({"id": "Label_9", "name": "Travel", "type": "user"})
+        self.assertEqual(resolve_labels(rules, self.catalog), set())
+        self.assertEqual(self.service.labels_resource.list_calls, 2)
+        process_emails(self.store.conn, rules, ActionAccumulator(self.service, scheduler=unpaced_scheduler()))
+        self.assertEqual(self.service.messages_resource.batch_modify_calls,
+                         [{"ids": ["0", "1", "2"], "addLabelIds": ["Label_9"], "removeLabelIds": []}])
+
+    def test_labels_are_listed_only_when_the_catalog_is_stale(self):
+        now = time.time()
+        self.assertTrue(self.catalog.refresh(now))
+        self.assertEqual(self.catalog.resolve("RECEIPTS"), "Label_7")
+        self.assertFalse(self.catalog.refresh(now))
+
+        # A synced email carrying a label created elsewhere triggers a new listing
+        self.service.labels_resource.labels.append({"id": "Label_9", "name": "Travel", "type": "user"})
+        self.store.store_emails([{"id": "9", "from": "", "subject": "", "message": "",
+                                  "received_datetime": None, "labels": ["Label_9"]}])
+        self.assertTrue(self.catalog.refresh(now))
+        self.assertEqual(self.catalog.resolve("travel"), "Label_9")
+        self.assertFalse(self.catalog.refresh(now))
+        # So does one relabelled by a history sync; relabelling with the same labels changes nothing
+        self.service.labels_resource.labels.append({"id": "Label_10", "name": "Bills", "type": "user"})
+        self.store.update_labels({"1": ["INBOX"]})
+        self.assertFalse(self.catalog.refresh(now))
+        self.store.update_labels({"1": ["INBOX", "Label_10"]})
+        self.assertTrue(self.catalog.refresh(now))
+        self.assertEqual(self.catalog.resolve("bills"), "Label_10")
+        # Renames and deletions only show up in a listing, made once the catalog is old
+        self.assertTrue(self.catalog.refresh(now + self.catalog.max_age))
+        self.assertEqual(self.service.labels_resource.list_calls, 4)
+
 
 if __name__ == '__main__':
     unittest.main()
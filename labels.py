@@ -0,0 +1,201 @@
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from googleapiclient.errors import HttpError
+
+from metrics import METRICS
+from scheduler import RequestScheduler, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# sync_state keys: when the labels were last listed, and the modified_seq up to
+# which stored emails were checked for label IDs the catalog does not know
+LABELS_LISTED_KEY = 'labels_listed_at'
+LABELS_SEQ_KEY = 'labels_seq'
+# Renamed and deleted labels never show up on messages, so the catalog is listed again at least this often
+MAX_AGE = 24 * 60 * 60
+# Gmail recommends keeping batch requests at or below 50 calls
+CREATE_BATCH_SIZE = 50
+
+
+class LabelCatalog:
+    """The mailbox's labels, cached in the `labels` table so rules can name them.
+
+    labels().list is only called when the catalog is empty, older than
+    `max_age`, or when emails stored since the last check (by a history or
+    full sync) carry a label ID it does not know, i.e. a label was created
+    elsewhere. Lookups are served from memory.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, service=None, scheduler: Optional[RequestScheduler] = None,
+                 user_id: str = 'me', max_age: float = MAX_AGE):
+        self.conn = conn
+        self._service = service
+        self.scheduler = scheduler or RequestScheduler()
+        self.user_id = user_id
+        self.max_age = max_age
+        self._names: Dict[str, str] = {}
+        self._ids_by_name: Dict[str, str] = {}
+        self._load()
+
+    @property
+    def service(self):
+        if self._service is None:
+            from gmail_service import get_service
+            self._service = get_service()
+        return self._service
+
+    def _load(self) -> None:
+        rows = self.conn.execute('SELECT id, name FROM labels').fetchall()
+        self._names = dict(rows)
+        # Gmail label names are unique regardless of case
+        self._ids_by_name = {name.casefold(): label_id for label_id, name in rows}
+
+    def _state(self, key: str) -> int:
+        row = self.conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return int(row[0]) if row is not None else 0
+
+    def _set_state(self, key: str, value: int) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _latest_seq(self) -> int:
+        return self.conn.execute('SELECT coalesce(max(modified_seq), 0) FROM emails').fetchone()[0]
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def is_stale(self, now: Optional[float] = None) -> bool:
+        now = time.time() if now is None else now
+        if not self._names or now - self._state(LABELS_LISTED_KEY) >= self.max_age:
+            return True
+        cursor = self.conn.execute("SELECT labels FROM emails WHERE modified_seq > ? AND labels <> ''",
+                                   (self._state(LABELS_SEQ_KEY),))
+        return any(label_id not in self._names for labels, in cursor for label_id in labels.split(','))
+
+    def sync(self, now: Optional[float] = None) -> int:
+        """List the mailbox's labels into the catalog and return how many there are."""
+        response = self.scheduler.execute(self.service.users().labels().list(userId=self.user_id), 'labels.list')
+        labels = response.get('labels', [])
+        with self.conn:
+            self.conn.execute('DELETE FROM labels')
+            self.conn.executemany('INSERT INTO labels (id, name, type) VALUES (?, ?, ?)',
+                                  [(label['id'], label['name'], label.get('type')) for label in labels])
+            self._set_state(LABELS_LISTED_KEY, int(time.time() if now is None else now))
+            self._set_state(LABELS_SEQ_KEY, self._latest_seq())
+        self._load()
+        METRICS.increment('label_catalog_syncs')
+        return len(labels)
+
+    def refresh(self, now: Optional[float] = None) -> bool:
+        """Bring the catalog up to date, listing the labels only when needed; True when they were listed."""
+        if self.is_stale(now):
+            self.sync(now)
+            return True
+        with self.conn:
+            self._set_state(LABELS_SEQ_KEY, self._latest_seq())
+        return False
+
+    def resolve(self, name_or_id: str) -> Optional[str]:
+        """ID of the label with this ID or name, or None when the mailbox has no such label."""
+        if name_or_id in self._names:
+            return name_or_id
+        return self._ids_by_name.get(name_or_id.casefold())
+
+    def _store(self, labels: List[Dict[str, Any]]) -> None:
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO labels (id, name, type) VALUES (?, ?, ?)',
+                                  [(label['id'], label['name'], label.get('type', 'user')) for label in labels])
+        self._load()
+
+    def create(self, names: Iterable[str]) -> Dict[str, str]:
+        """Create the labels with HTTP batch requests and return {name: new label ID}.
+
+        Throttled creations are retried one by one through the scheduler.
+        Names Gmail reports as already existing mean the catalog was out of
+        date, so it is listed again.
+        """
+        names = list(dict.fromkeys(names))
+        created: List[Dict[str, Any]] = []
+        retry: List[str] = []
+        conflicts = False
+        for start in range(0, len(names), CREATE_BATCH_SIZE):
+            chunk = names[start:start + CREATE_BATCH_SIZE]
+
+            def callback(request_id, response, exception):
+                nonlocal conflicts
+                if exception is None:
+                    created.append(response)
+                elif is_retryable(exception):
+                    retry.append(chunk[int(request_id)])
+                elif getattr(getattr(exception, 'resp', None), 'status', None) == 409:
+                    conflicts = True
+                else:
+                    logger.warning("Could not create label %r: %s", chunk[int(request_id)], exception)
+
+            self.scheduler.budget.spend('labels.create', len(chunk))
+            batch = self.service.new_batch_http_request(callback=callback)
+            for index, name in enumerate(chunk):
+                batch.add(self.service.users().labels().create(userId=self.user_id, body=self._label_body(name)),
+                          request_id=str(index))
+            batch.execute()
+
+        for name in retry:
+            try:
+                created.append(self.scheduler.execute(self.service.users().labels().create(
+                    userId=self.user_id, body=self._label_body(name)), 'labels.create'))
+            except HttpError as error:
+                logger.warning("Could not create label %r: %s", name, error)
+        self._store(created)
+        METRICS.increment('labels_created', len(created))
+        if conflicts:
+            self.sync()
+        return {label['name']: label['id'] for label in created}
+
+    @staticmethod
+    def _label_body(name: str) -> Dict[str, Any]:
+        return {'name': name, 'labelListVisibility': 'labelShow', 'messageListVisibility': 'show'}
+
+
+def move_targets(rule_collection) -> List[str]:
+    return [action['action_value'] for action in rule_collection.actions if action.get('action_type') == 'move']
+
+
+def resolve_labels(rule_collections: List[Any], catalog: LabelCatalog, create: bool = False) -> Set[str]:
+    """Point the move actions of the rules at label IDs; call once per load of the rules.
+
+    Move targets may be label IDs or names. Targets the mailbox has no label
+    for are reported as errors here, at load time, and their move actions are
+    skipped instead of failing for every matched email. With `create` they
+    are created instead, all together before any action is dispatched.
+    A target the catalog does not know has the labels listed again first, in
+    case it was just created in Gmail. Returns the targets left without a label.
+    """
+    targets = {target for rule_collection in rule_collections for target in move_targets(rule_collection)}
+    if not targets:
+        return set()
+    try:
+        listed = catalog.refresh()
+        missing = sorted(target for target in targets if catalog.resolve(target) is None)
+        if missing and not listed:
+            catalog.sync()
+            missing = [target for target in missing if catalog.resolve(target) is None]
+        if missing and create:
+            logger.info("Creating labels %s", missing)
+            catalog.create(missing)
+    except HttpError as error:
+        # Without a catalog the targets are sent as written, as label IDs
+        logger.warning("Could not load the label catalog: %s", error)
+        return set()
+
+    unresolved = set()
+    for rule_collection in rule_collections:
+        rule_collection.label_ids = {target: catalog.resolve(target) for target in move_targets(rule_collection)}
+        for target, label_id in rule_collection.label_ids.items():
+            if label_id is None:
+                unresolved.add(target)
+                logger.error("%s moves emails to %r, which is not a label; the action is skipped "
+                             "(create the label, or pass --create-labels).",
+                             rule_collection.source or rule_collection.rule_name, target)
+    return unresolved
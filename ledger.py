@@ -0,0 +1,103 @@
+import time
+from typing import Any, Collection, Dict, Iterable, List, Optional, Tuple
+
+# Message IDs per IN (...) query when ledger rows are loaded ahead of pending()
+LOAD_CHUNK = 500
+
+
+def recheck_after(rule_collection, email: Dict[str, Any], now: int) -> Optional[int]:
+    """When a date rule could flip its result for this email, or None if it never will.
+
+    "less than N D" stops matching and "greater than N D" starts matching once
+    the email is N days old, so results for young emails must be re-evaluated.
+    """
+    received_ts = email.get("received_ts")
+    if received_ts is None:
+        return None
+    flips = [received_ts + rule.window for rule in rule_collection.rules
+             if rule.window is not None and received_ts + rule.window > now]
+    return min(flips) if flips else None
+
+
+class RuleLedger:
+    """Records which (email, rule content) pairs were evaluated and what was applied.
+
+    Pairs are skipped on later runs until the email changes, the rule file's
+    content hash changes, or a date rule's result could have flipped.
+    """
+
+    def __init__(self, conn, rule_collections: List[Any], now: Optional[int] = None):
+        self.conn = conn
+        self.rule_collections = rule_collections
+        self.now = int(now if now is not None else time.time())
+        self._pending: List[Tuple] = []
+        self._loaded: Dict[str, List[Tuple]] = {}
+        # Only results of collections with a date rule can expire
+        self._dated = {id(rule_collection) for rule_collection in rule_collections
+                       if any(rule.window is not None for rule in rule_collection.rules)}
+
+    def skip_condition(self, rule_collection) -> Tuple[str, List[Any]]:
+        """SQL condition on `emails` that is true when the pair was already evaluated."""
+        return ('''EXISTS (SELECT 1 FROM rule_ledger l
+                    WHERE l.message_id = emails.id AND l.rule_hash = ?
+                      AND l.evaluated_seq = emails.modified_seq
+                      AND (l.recheck_after IS NULL OR l.recheck_after > ?))''',
+                [rule_collection.content_hash, self.now])
+
+    def pending(self, email: Dict[str, Any]) -> List[Tuple[Any, bool]]:
+        """Return (rule collection, actions already applied) pairs still to evaluate for the email.
+
+        Actions are reported as already applied when an unchanged email is only
+        being re-checked because of a date rule, so they are not sent twice.
+        """
+        rows = self._loaded.pop(email["ID"], None)
+        if rows is None:
+            rows = self.conn.execute('SELECT rule_hash, matched, evaluated_seq, recheck_after '
+                                     'FROM rule_ledger WHERE message_id = ?', (email["ID"],)).fetchall()
+        done, applied = set(), set()
+        for rule_hash, matched, evaluated_seq, recheck in rows:
+            if evaluated_seq != email.get("modified_seq"):
+                continue
+            if recheck is None or recheck > self.now:
+                done.add(rule_hash)
+            elif matched:
+                applied.add(rule_hash)
+        return [(rule_collection, rule_collection.content_hash in applied)
+                for rule_collection in self.rule_collections
+                if rule_collection.content_hash not in done]
+
+    def load(self, message_ids: Iterable[str]) -> None:
+        """Read the ledger rows of these emails ahead of their pending() calls, one query per chunk."""
+        message_ids = list(message_ids)
+        self._loaded = {message_id: [] for message_id in message_ids}
+        for start in range(0, len(message_ids), LOAD_CHUNK):
+            chunk = message_ids[start:start + LOAD_CHUNK]
+            for message_id, *row in self.conn.execute(
+                    f'SELECT message_id, rule_hash, matched, evaluated_seq, recheck_after FROM rule_ledger '
+                    f'WHERE message_id IN ({", ".join("?" * len(chunk))})', chunk):
+                self._loaded[message_id].append(tuple(row))
+
+    def record(self, email: Dict[str, Any], results: Iterable[Tuple[Any, bool]]) -> None:
+        """Remember the (rule collection, matched) results of one email until the next commit."""
+        message_id, seq = email["ID"], email.get("modified_seq") or 0
+        self._pending.extend(
+            (message_id, rule_collection.content_hash, int(matched), rule_collection.actions_json if matched else None,
+             seq, recheck_after(rule_collection, email, self.now) if id(rule_collection) in self._dated else None,
+             self.now)
+            for rule_collection, matched in results)
+
+    def commit(self, skip: Collection[str] = ()) -> int:
+        """Persist recorded results; call only after their actions were applied.
+
+        Results of the emails in `skip`, whose actions failed, are dropped so
+        the emails are evaluated again by the next run.
+        """
+        records = [record for record in self._pending if record[0] not in skip]
+        with self.conn:
+            self.conn.executemany('''
+                INSERT OR REPLACE INTO rule_ledger
+                    (message_id, rule_hash, matched, actions, evaluated_seq, recheck_after, evaluated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', records)
+        self._pending = []
+        return len(records)
@@ -0,0 +1,213 @@
+import cProfile
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    """Thread-safe counters and timers for one process.
+
+    Timers record how many times a stage ran, its total and its slowest
+    duration; both kinds of metric can carry labels such as the API method.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.timers: Dict[Tuple[str, Labels], list] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, count: int = 1, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, iterable: Iterable, name: str, **labels) -> Iterator:
+        """Yield from `iterable`, recording the total time spent waiting for its items once it ends."""
+        iterator = iter(iterable)
+        waited = 0.0
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                waited += time.perf_counter() - started
+            yield item
+        self.observe(name, waited, **labels)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.started = time.time()
+
+    def snapshot(self) -> Tuple[Dict, Dict]:
+        """Copy of the raw counters and timers, which can be sent to another process and merged there."""
+        with self._lock:
+            return dict(self.counters), {key: list(timer) for key, timer in self.timers.items()}
+
+    def merge(self, snapshot: Tuple[Dict, Dict]) -> None:
+        counters, timers = snapshot
+        with self._lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (count, total, slowest) in timers.items():
+                timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], slowest)
+
+    def summary(self) -> Dict[str, Any]:
+        """Everything recorded so far as a JSON-serialisable run summary."""
+        with self._lock:
+            counters = [dict(name=name, labels=dict(labels), value=value)
+                        for (name, labels), value in sorted(self.counters.items())]
+            timers = [dict(name=name, labels=dict(labels), count=count, seconds=round(total, 6),
+                           max_seconds=round(slowest, 6))
+                      for (name, labels), (count, total, slowest) in sorted(self.timers.items())]
+        return {'started': self.started, 'elapsed_seconds': round(time.time() - self.started, 3),
+                'counters': counters, 'timers': timers}
+
+    def write_json(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_prometheus(self) -> str:
+        """Render the metrics in the Prometheus text exposition format."""
+        def metric_name(name):
+            return 'gmail_rules_' + ''.join(char if char.isalnum() else '_' for char in name)
+
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {metric_name(name)}_total counter')
+            lines.append(f'{metric_name(name)}_total{label_text(labels)} {value}')
+        for (name, labels), (count, total, slowest) in timers:
+            base = metric_name(name) + '_seconds'
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {base} summary')
+            lines.append(f'{base}_count{label_text(labels)} {count}')
+            lines.append(f'{base}_sum{label_text(labels)} {total}')
+            lines.append(f'{base}{label_text(labels, [("quantile", "1")])} {slowest}')
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of the current process; every module records into this one
+METRICS = Metrics()
+
+
+class MetricsServer:
+    """Serves METRICS over HTTP: /metrics in Prometheus text, /metrics.json as the run summary."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9464, metrics: Metrics = METRICS):
+        self.metrics = metrics
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def _handler_class(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.to_prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.summary()).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> 'MetricsServer':
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@contextmanager
+def profiled(path: Optional[str]) -> Iterator[None]:
+    """Run the block under cProfile and save the stats to `path` (no-op when path is None)."""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        logging.getLogger(__name__).info('Profile saved to %s (view with: python -m pstats %s)', path, path)
+
+
+def add_arguments(parser) -> None:
+    """Add the logging, metrics and profiling options shared by the command line scripts."""
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Logging verbosity (default: INFO)")
+    parser.add_argument("--metrics-json", default=None,
+                        help="Write a JSON summary of stage timings, API calls and rule hits to this file")
+    parser.add_argument("--profile", default=None,
+                        help="Profile the run with cProfile and save the stats to this file")
+
+
+def configure_logging(level: str = "INFO") -> None:
+    logging.basicConfig(level=getattr(logging, level), format=LOG_FORMAT)
@@ -0,0 +1,190 @@
+import base64
+import codecs
+import email
+import email.policy
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+from html import unescape
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Higher is better when picking the part that becomes the stored message text
+PART_PREFERENCE = {'text/plain': 2, 'text/html': 1}
+
+
+class _TextExtractor(HTMLParser):
+    # Elements whose content is never visible text
+    SKIP = {'script', 'style', 'head', 'title'}
+    # Elements that start a new line in rendered text
+    BLOCK = {'br', 'p', 'div', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'blockquote'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks: List[str] = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skip_depth += 1
+        elif tag in self.BLOCK:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in self.BLOCK:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.chunks.append(data)
+
+
+def html_to_text(html: str) -> str:
+    parser = _TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        # Badly broken markup: fall back to the raw text with entities decoded
+        return unescape(html)
+    lines = (' '.join(line.split()) for line in ''.join(parser.chunks).splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def _header(part: Dict[str, Any], name: str) -> Optional[str]:
+    for header in part.get('headers', []):
+        if header['name'].lower() == name:
+            return header['value']
+    return None
+
+
+def _charset(part: Dict[str, Any]) -> str:
+    content_type = _header(part, 'content-type') or ''
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'charset' and value:
+            charset = value.strip('"\' ')
+            try:
+                return codecs.lookup(charset).name
+            except LookupError:
+                break
+    return 'utf-8'
+
+
+def decode_part_data(data: str, charset: str = 'utf-8') -> str:
+    raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+    try:
+        return raw.decode(charset)
+    except UnicodeDecodeError:
+        # Mislabelled charsets are common; keep what can be read
+        return raw.decode(charset, errors='replace')
+
+
+def _text_parts(part: Dict[str, Any]) -> Iterable[Tuple[int, Dict[str, Any]]]:
+    # Depth-first walk of the Gmail payload tree, skipping attachments
+    mime_type = part.get('mimeType', '').lower()
+    if mime_type.startswith('multipart/'):
+        for child in part.get('parts', []):
+            yield from _text_parts(child)
+    elif mime_type in PART_PREFERENCE and not part.get('filename'):
+        if part.get('body', {}).get('data'):
+            yield PART_PREFERENCE[mime_type], part
+    elif not mime_type and part.get('body', {}).get('data'):
+        yield PART_PREFERENCE['text/plain'], part
+
+
+def extract_body(payload: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Return the best text of a Gmail API message payload: text/plain, else stripped text/html."""
+    if not payload:
+        return None
+    best = None
+    for preference, part in _text_parts(payload):
+        if best is None or preference > best[0]:
+            best = (preference, part)
+    if best is None:
+        return None
+    preference, part = best
+    text = decode_part_data(part['body']['data'], _charset(part))
+    return text if part.get('mimeType', '').lower() != 'text/html' else html_to_text(text)
+
+
+def parse_raw_message(raw: str) -> Tuple[Dict[str, Optional[str]], Optional[str]]:
+    """Parse a format=raw message into its From/Subject/Date headers and best body text."""
+    message = email.message_from_bytes(
+        base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4)), policy=email.policy.default)
+    headers = {name: (str(message[name]) if message[name] is not None else None)
+               for name in ('From', 'Subject', 'Date')}
+    body_part = message.get_body(preferencelist=('plain', 'html'))
+    if body_part is None:
+        return headers, None
+    try:
+        text = body_part.get_content()
+    except (LookupError, UnicodeDecodeError):
+        text = body_part.get_payload(decode=True).decode('utf-8', errors='replace')
+    if body_part.get_content_type() == 'text/html':
+        text = html_to_text(text)
+    return headers, text
+
+
+def to_gmail_payload(message: email.message.Message) -> Dict[str, Any]:
+    """Convert a stdlib email message into the payload structure the Gmail API returns."""
+    payload = {
+        'mimeType': message.get_content_type(),
+        'filename': message.get_filename() or '',
+        'headers': [{'name': name, 'value': str(value)} for name, value in message.items()],
+    }
+    if message.is_multipart():
+        payload['body'] = {'size': 0}
+        payload['parts'] = [to_gmail_payload(part) for part in message.get_payload()]
+    else:
+        data = message.get_payload(decode=True) or b''
+        payload['body'] = {'size': len(data),
+                           'data': base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')}
+    return payload
+
+
+class BodyDecoder:
+    """Runs a parse function over chunks of fetched messages in a process pool.
+
+    With `workers=0` everything runs on the calling thread. Otherwise a chunk
+    is decoded in the background while the caller keeps fetching the next one.
+    """
+
+    def __init__(self, parse: Callable[[Dict[str, Any]], Dict[str, Any]], workers: int = 0):
+        self.parse = parse
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+
+    def __enter__(self) -> 'BodyDecoder':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def submit(self, chunk: List[Dict[str, Any]]) -> '_Pending':
+        """Start decoding a chunk; call .result() on the returned value for the parsed emails."""
+        if self._executor is None:
+            return _Pending(results=[self.parse(details) for details in chunk])
+        # Spread the chunk over every worker, keeping the original order
+        size = max(1, -(-len(chunk) // self.workers))
+        return _Pending(futures=[self._executor.submit(_parse_all, self.parse, chunk[start:start + size])
+                                 for start in range(0, len(chunk), size)])
+
+
+def _parse_all(parse, details_list):
+    return [parse(details) for details in details_list]
+
+
+class _Pending:
+    def __init__(self, results=None, futures=()):
+        self.results = results
+        self.futures = futures
+
+    def result(self) -> List[Dict[str, Any]]:
+        if self.results is None:
+            self.results = [parsed for future in self.futures for parsed in future.result()]
+        return self.results
@@ -0,0 +1,177 @@
+import operator
+import sqlite3
+import time
+import zlib
+from functools import reduce
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from metrics import METRICS
+from rule_sql import FIELD_COLUMNS, compile_rule, iter_rows
+from storage import BodyStore, bodies_compressed, fts_available
+
+PredicateKey = Tuple[str, str, str]
+
+# Bitmaps of predicates no rule used for this long are dropped
+UNUSED_TTL = 90 * 86400
+# Up to this many new or changed emails are checked in Python instead of one SQL query per predicate
+PYTHON_REFRESH_LIMIT = 1000
+
+
+def from_rowids(rowids: Iterable[int]) -> int:
+    """Bitmap with the bits of the given rowids set; a Python int is an array-backed bitset."""
+    bits = bytearray()
+    for rowid in rowids:
+        byte = rowid >> 3
+        if byte >= len(bits):
+            bits.extend(bytes(byte - len(bits) + 1))
+        bits[byte] |= 1 << (rowid & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def to_rowids(bitmap: int) -> List[int]:
+    # Scanning the binary digits with str.find skips runs of zeros at C speed
+    digits = bin(bitmap)[:1:-1]
+    rowids = []
+    position = digits.find('1')
+    while position != -1:
+        rowids.append(position)
+        position = digits.find('1', position + 1)
+    return rowids
+
+
+def encode(bitmap: int) -> bytes:
+    # Sparse bitmaps are mostly zero bytes, which zlib stores in almost no space
+    return zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'))
+
+
+def decode(data: bytes) -> int:
+    return int.from_bytes(zlib.decompress(data), 'little')
+
+
+class PredicateCache:
+    """Rowid bitmaps of the emails matching each (field, predicate, value), kept in SQLite.
+
+    A bitmap is brought up to date when it is used: emails stored since its
+    last refresh (a higher modified_seq) are evaluated again and deleted
+    rowids are cleared, so only new work is done. Rules sharing a predicate
+    share its bitmap, and a rule collection is the AND ("all") or OR ("any")
+    of its predicates' bitmaps. Date predicates depend on the current time,
+    so their bitmaps are read from the received_ts index on every use.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, now: Optional[int] = None):
+        self.conn = conn
+        self.now = int(now if now is not None else time.time())
+        self._bitmaps: Dict[PredicateKey, int] = {}
+        # Bitmaps refreshed from the same watermarks share the set of rowids to re-evaluate
+        self._stale: Dict[Tuple[int, int], int] = {}
+        self._changed: Dict[int, Optional[List[Tuple[int, Dict[str, Any]]]]] = {}
+        self._use_fts = fts_available(conn)
+        self._bodies_in_sql = not bodies_compressed(conn)
+        self._bodies = BodyStore(conn)
+
+    @staticmethod
+    def key(rule) -> PredicateKey:
+        # Every string predicate compares case-insensitively
+        return rule.field, rule.predicate, rule.value.lower()
+
+    def _watermarks(self) -> Tuple[int, int]:
+        seq = self.conn.execute('SELECT coalesce(max(modified_seq), 0) FROM emails').fetchone()[0]
+        deletion = self.conn.execute(
+            "SELECT coalesce((SELECT seq FROM sqlite_sequence WHERE name = 'predicate_deletions'), 0)").fetchone()[0]
+        return seq, deletion
+
+    def _query(self, where: str, params: List[Any]) -> int:
+        cursor = self.conn.execute(f'SELECT rowid FROM emails WHERE {where} ORDER BY rowid', params)
+        return from_rowids(rowid for rowid, in iter_rows(cursor))
+
+    def _changed_emails(self, after_seq: int) -> Optional[List[Tuple[int, Dict[str, Any]]]]:
+        """(rowid, email) of the emails stored after `after_seq`, or None when there are too many."""
+        if after_seq not in self._changed:
+            self._changed[after_seq] = None
+            cursor = self.conn.execute('SELECT rowid, from_address, subject, received_datetime, received_ts '
+                                       'FROM emails WHERE modified_seq > ? ORDER BY rowid LIMIT ?',
+                                       (after_seq, PYTHON_REFRESH_LIMIT + 1))
+            rows = cursor.fetchall()
+            if len(rows) <= PYTHON_REFRESH_LIMIT:
+                self._changed[after_seq] = [(rowid, {'From': sender, 'Subject': subject, 'Received Date/Time': received,
+                                                     'received_ts': received_ts})
+                                            for rowid, sender, subject, received, received_ts in rows]
+        return self._changed[after_seq]
+
+    def _matching(self, rule, after_seq: int) -> int:
+        """Bitmap of the emails stored after `after_seq` that match the rule."""
+        changed = self._changed_emails(after_seq)
+        if changed is not None:
+            # A few new emails are quicker to check directly than with a query per predicate
+            matching = []
+            for rowid, email in changed:
+                if rule.field == 'Message' and 'Message' not in email:
+                    email['Message'] = self._bodies.load(rowid)
+                if rule.evaluate(email, self.now):
+                    matching.append(rowid)
+            return from_rowids(matching)
+        compiled = compile_rule(rule, self.now, use_fts=self._use_fts, bodies_in_sql=self._bodies_in_sql)
+        if compiled is not None:
+            where, params = compiled
+            return self._query(f'modified_seq > ? AND {where}', [after_seq] + params)
+        # Non-ASCII values and compressed bodies are checked in Python, as the rule engine does
+        column = 'NULL' if rule.field == 'Message' else FIELD_COLUMNS[rule.field]
+        cursor = self.conn.execute(f'SELECT rowid, {column} FROM emails WHERE modified_seq > ? ORDER BY rowid',
+                                   (after_seq,))
+        return from_rowids(rowid for rowid, value in iter_rows(cursor) if rule.evaluate(
+            {rule.field: self._bodies.load(rowid) if rule.field == 'Message' else value}, self.now))
+
+    def _refresh(self, rule, key: PredicateKey) -> int:
+        seq, deletion = self._watermarks()
+        row = self.conn.execute('SELECT bitmap, evaluated_seq, deletion_id FROM predicate_bitmaps '
+                                'WHERE field = ? AND predicate = ? AND value = ?', key).fetchone()
+        if row is not None and row[1:] == (seq, deletion):
+            with self.conn:
+                self.conn.execute('UPDATE predicate_bitmaps SET used_at = ? '
+                                  'WHERE field = ? AND predicate = ? AND value = ?', (self.now,) + key)
+            return decode(row[0])
+        bitmap, evaluated_seq, deletion_id = (decode(row[0]), row[1], row[2]) if row is not None else (0, -1, 0)
+
+        # Emails stored since the last refresh are evaluated again, deleted ones cleared
+        if (evaluated_seq, deletion_id) not in self._stale:
+            self._stale[evaluated_seq, deletion_id] = self._query('modified_seq > ?', [evaluated_seq]) | from_rowids(
+                rowid for rowid, in self.conn.execute(
+                    'SELECT email_rowid FROM predicate_deletions WHERE id > ? ORDER BY email_rowid', (deletion_id,)))
+        bitmap = (bitmap & ~self._stale[evaluated_seq, deletion_id]) | self._matching(rule, evaluated_seq)
+        METRICS.increment('predicate_bitmaps_refreshed')
+        with self.conn:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO predicate_bitmaps
+                    (field, predicate, value, bitmap, evaluated_seq, deletion_id, used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', key + (encode(bitmap), seq, deletion, self.now))
+        return bitmap
+
+    def bitmap(self, rule) -> int:
+        """Rowids of the emails the Rule matches."""
+        key = self.key(rule)
+        if key not in self._bitmaps:
+            if rule.field == 'Received Date/Time':
+                compiled = compile_rule(rule, self.now)
+                self._bitmaps[key] = self._query(*compiled) if compiled is not None else 0
+            else:
+                self._bitmaps[key] = self._refresh(rule, key)
+        return self._bitmaps[key]
+
+    def match(self, rule_collection) -> int:
+        """Rowids of the emails the RuleCollection matches."""
+        bitmaps = [self.bitmap(rule) for rule in rule_collection.rules]
+        if rule_collection.rule_type.lower() == 'all':
+            # Like all([]), a collection without rules matches every email
+            return reduce(operator.and_, bitmaps) if bitmaps else self._query('1', [])
+        return reduce(operator.or_, bitmaps, 0)
+
+    def prune(self) -> None:
+        """Drop bitmaps nobody used for a long time and deletions every bitmap has already applied."""
+        with self.conn:
+            self.conn.execute('DELETE FROM predicate_bitmaps WHERE used_at < ?', (self.now - UNUSED_TTL,))
+            self.conn.execute('''
+                DELETE FROM predicate_deletions WHERE id <= coalesce(
+                    (SELECT min(deletion_id) FROM predicate_bitmaps), (SELECT max(id) FROM predicate_deletions))
+            ''')
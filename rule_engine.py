@@ -0,0 +1,225 @@
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from dates import email_timestamp
+
+STRING_FIELDS = ["From", "Subject", "Message"]
+
+
+class NeedleMatcher:
+    """Finds which of many lowercase substrings occur in a text.
+
+    Each needle is looked up with str's own substring search, which skips
+    ahead on mismatches; over long bodies that is much faster than one regex
+    alternation tried at every position.
+    """
+
+    def __init__(self, needles: Iterable[str]):
+        self.needles = sorted({needle for needle in needles if needle})
+
+    def find(self, text: str) -> set:
+        return {needle for needle in self.needles if needle in text}
+
+
+class FieldPredicates:
+    """The predicates of one string field, decided together as a bitmask over the rule set's predicates.
+
+    Each "contains" / "does not contain" value is a needle of one
+    NeedleMatcher pass, and "equals" / "not equals" values are looked up in
+    dicts keyed by the lowercased text, so deciding every predicate on the
+    field costs one lowercasing, one matcher pass and a few dict lookups
+    whatever their number.
+    """
+
+    def __init__(self):
+        self.always = 0
+        self.contains: Dict[str, int] = {}
+        self.absent: Dict[str, int] = {}
+        self.equals: Dict[str, int] = {}
+        self.differs: Dict[str, int] = {}
+        self.matcher: Optional[NeedleMatcher] = None
+
+    def add(self, bit: int, predicate: str, value: str) -> None:
+        value = value.lower()
+        if predicate == "contains":
+            if value:
+                self.contains[value] = self.contains.get(value, 0) | bit
+            else:
+                # Every non-empty text contains the empty string
+                self.always |= bit
+        elif predicate == "does not contain":
+            if value:
+                self.absent[value] = self.absent.get(value, 0) | bit
+                self.always |= bit
+        elif predicate == "equals":
+            self.equals[value] = self.equals.get(value, 0) | bit
+        elif predicate == "not equals":
+            self.differs[value] = self.differs.get(value, 0) | bit
+            self.always |= bit
+
+    def compile(self) -> None:
+        self.matcher = NeedleMatcher(list(self.contains) + list(self.absent))
+
+    def decide(self, text: str) -> int:
+        # Rule.evaluate never matches an empty field, whatever the predicate
+        if not text:
+            return 0
+        text = text.lower()
+        bits = self.always | self.equals.get(text, 0)
+        bits &= ~self.differs.get(text, 0)
+        for needle in self.matcher.find(text):
+            bits |= self.contains.get(needle, 0)
+            bits &= ~self.absent.get(needle, 0)
+        return bits
+
+
+class DatePredicates:
+    """The "Received Date/Time" predicates, decided together from the email's age.
+
+    "less than N" holds for windows at least as long as the email's age and
+    "greater than N" for shorter ones, so with the windows sorted the bits
+    that hold are one precomputed suffix or prefix, found by bisection.
+    """
+
+    def __init__(self):
+        self._windows: Dict[str, List[Tuple[int, int]]] = {"less than": [], "greater than": []}
+
+    def add(self, bit: int, predicate: str, window: Optional[int]) -> None:
+        # Invalid values and other predicates never match
+        if window is not None and predicate in self._windows:
+            self._windows[predicate].append((window, bit))
+
+    def compile(self) -> None:
+        less = sorted(self._windows["less than"])
+        greater = sorted(self._windows["greater than"])
+        self.less_windows = [window for window, bit in less]
+        self.greater_windows = [window for window, bit in greater]
+        # less_masks[i]: bits of the windows from i on; greater_masks[i]: bits of the first i windows
+        self.less_masks = [0] * (len(less) + 1)
+        for i in range(len(less) - 1, -1, -1):
+            self.less_masks[i] = self.less_masks[i + 1] | less[i][1]
+        self.greater_masks = [0]
+        for window, bit in greater:
+            self.greater_masks.append(self.greater_masks[-1] | bit)
+
+    def decide(self, email: Dict[str, Any], now: Optional[float] = None) -> int:
+        # Rows from the database carry the timestamp normalized at ingest
+        email_ts = email.get("received_ts")
+        if email_ts is None:
+            email_ts = email_timestamp(email.get("Received Date/Time"))
+            if email_ts is None:
+                return 0
+        age = int(now if now is not None else time.time()) - email_ts
+        return (self.less_masks[bisect_left(self.less_windows, age)]
+                | self.greater_masks[bisect_left(self.greater_windows, age)])
+
+
+class CompiledRuleSet:
+    """Evaluates many RuleCollections against an email in one pass.
+
+    Identical (field, predicate, value) triples are evaluated once per email,
+    into one bit each of an int; each string field is read, lowercased and
+    scanned once for all its predicates (see FieldPredicates), and the dates
+    are decided with one bisection (see DatePredicates). A collection
+    is then decided by masking those bits: `all` needs every bit of its mask
+    set, `any` at least one, so adding rules adds no per-email field work.
+    """
+
+    def __init__(self, rule_collections: List[Any]):
+        self.rule_collections = rule_collections
+        self.predicates: List[Tuple[str, str, str]] = []
+        index: Dict[Tuple[str, str, str], int] = {}
+        self.fields_predicates: Dict[str, FieldPredicates] = {}
+        self.dates = DatePredicates()
+        # (is "all", header mask, body mask) of each collection
+        self.masks: List[Tuple[bool, int, int]] = []
+
+        for rule_collection in rule_collections:
+            header_mask = body_mask = 0
+            for rule in rule_collection.rules:
+                key = (rule.field, rule.predicate, rule.value)
+                if key not in index:
+                    index[key] = len(self.predicates)
+                    self.predicates.append(key)
+                    if rule.field in STRING_FIELDS:
+                        self.fields_predicates.setdefault(rule.field, FieldPredicates()).add(
+                            1 << index[key], rule.predicate, rule.value)
+                    elif rule.field == "Received Date/Time":
+                        self.dates.add(1 << index[key], rule.predicate, rule.window)
+                    # Other fields are not supported and never match
+                if rule.field == "Message":
+                    body_mask |= 1 << index[key]
+                else:
+                    header_mask |= 1 << index[key]
+            self.masks.append((rule_collection.rule_type.lower() == "all", header_mask, body_mask))
+        for field_predicates in self.fields_predicates.values():
+            field_predicates.compile()
+        self.dates.compile()
+        self.header_fields = [(field, self.fields_predicates[field]) for field in STRING_FIELDS
+                              if field in self.fields_predicates and field != "Message"]
+        self.body_predicates = self.fields_predicates.get("Message")
+
+        # Time spent deciding each collection, for per-rule metrics; the shared
+        # pass over an email is split evenly between the collections it decided
+        self.collection_seconds = [0.0] * len(rule_collections)
+        self._positions = {id(rule_collection): position for position, rule_collection in enumerate(rule_collections)}
+
+    @property
+    def fields(self) -> List[str]:
+        return sorted({field for field, predicate, value in self.predicates})
+
+    def _header_bits(self, email: Dict[str, Any], now: Optional[float]) -> int:
+        bits = 0
+        for field, field_predicates in self.header_fields:
+            bits |= field_predicates.decide(email.get(field) or "")
+        if self.dates.less_windows or self.dates.greater_windows:
+            bits |= self.dates.decide(email, now)
+        return bits
+
+    def _body_bits(self, email: Dict[str, Any]) -> int:
+        return self.body_predicates.decide(email.get("Message") or "") if self.body_predicates else 0
+
+    def match(self, email: Dict[str, Any], only: Optional[List[Any]] = None,
+              now: Optional[float] = None) -> List[Any]:
+        """Return the rule collections matching the email.
+
+        Header predicates are evaluated first; the Message body is only read
+        when those predicates leave some collection undecided. `only` limits
+        the evaluation to some of the loaded collections, and date rules are
+        decided against `now` (default: the current time).
+        """
+        started = time.perf_counter()
+        if only is None:
+            positions = range(len(self.rule_collections))
+        else:
+            positions = sorted(self._positions[id(rule_collection)] for rule_collection in only)
+        header = self._header_bits(email, now)
+        body = None
+        matched = []
+        masks = self.masks
+        for position in positions:
+            is_all, header_mask, body_mask = masks[position]
+            if is_all:
+                if header & header_mask != header_mask:
+                    continue
+                if body_mask:
+                    if body is None:
+                        body = self._body_bits(email)
+                    if body & body_mask != body_mask:
+                        continue
+            elif not header & header_mask:
+                if not body_mask:
+                    continue
+                if body is None:
+                    body = self._body_bits(email)
+                if not body & body_mask:
+                    continue
+            matched.append(self.rule_collections[position])
+
+        if positions:
+            share = (time.perf_counter() - started) / len(positions)
+            seconds = self.collection_seconds
+            for position in positions:
+                seconds[position] += share
+        return matched
@@ -0,0 +1,208 @@
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from storage import BodyStore, bodies_compressed, fts_available
+
+# Maps rule fields (and the email dict keys built from rows) to columns of the emails table
+FIELD_COLUMNS = {
+    "ID": "id",
+    "From": "from_address",
+    "Subject": "subject",
+    "Message": "message",
+    "Received Date/Time": "received_datetime",
+}
+STRING_FIELDS = ["From", "Subject", "Message"]
+
+
+def select_columns(fields: List[str]) -> Tuple[List[str], str]:
+    """Return the email dict keys and SELECT column list for the given fields.
+
+    Date rules compare the timestamp normalized at ingest, so it is selected
+    alongside the raw header.
+    """
+    keys = list(fields)
+    if "Received Date/Time" in keys:
+        keys.append("received_ts")
+    return keys, ", ".join(FIELD_COLUMNS.get(key, key) for key in keys)
+
+
+class CompiledQuery(NamedTuple):
+    """WHERE clause for a RuleCollection.
+
+    When `exact` is False the clause only narrows down the candidates and every
+    returned row still has to be checked with RuleCollection.matches().
+    """
+    where: str
+    params: List[Any]
+    exact: bool
+    fields: List[str]
+
+
+def fts_phrase(column: str, value: str) -> str:
+    # Column filter plus a quoted phrase, so the value is matched literally
+    return f'{column} : "{value.replace(chr(34), chr(34) * 2)}"'
+
+
+def compile_rule(rule, now: Optional[float] = None, use_fts: bool = False,
+                 bodies_in_sql: bool = True) -> Optional[Tuple[str, List[Any]]]:
+    """Translate one Rule into an SQL condition, or None when only Python can evaluate it.
+
+    With `bodies_in_sql` False (some bodies are stored compressed) Message
+    predicates are always left to Python.
+    """
+    if rule.field in STRING_FIELDS:
+        if rule.field == "Message" and not bodies_in_sql:
+            return None
+        column = FIELD_COLUMNS[rule.field]
+        value = rule.value.lower()
+        # SQLite only case-folds ASCII, so other values must be compared in Python
+        if not value.isascii():
+            return None
+        # The trigram index matches substrings of three or more characters exactly;
+        # shorter values are still checked with instr() on every row.
+        if use_fts and len(value) >= 3 and rule.predicate in ("contains", "does not contain"):
+            operator = "IN" if rule.predicate == "contains" else "NOT IN"
+            return (f"({column} <> '' AND rowid {operator} "
+                    f"(SELECT rowid FROM emails_fts WHERE emails_fts MATCH ?))"), [fts_phrase(column, value)]
+        # Rule.evaluate never matches an empty field, whatever the predicate
+        if rule.predicate == "contains":
+            return f"({column} <> '' AND instr(lower({column}), ?) > 0)", [value]
+        elif rule.predicate == "does not contain":
+            return f"({column} <> '' AND instr(lower({column}), ?) = 0)", [value]
+        elif rule.predicate == "equals":
+            return f"({column} <> '' AND {column} = ? COLLATE NOCASE)", [value]
+        elif rule.predicate == "not equals":
+            return f"({column} <> '' AND {column} <> ? COLLATE NOCASE)", [value]
+        return "0", []
+
+    elif rule.field == "Received Date/Time":
+        cutoff = rule.cutoff(now)
+        if cutoff is None:
+            return None
+
+        if rule.predicate == "less than":
+            return "(received_ts >= ?)", [cutoff]
+        elif rule.predicate == "greater than":
+            return "(received_ts < ?)", [cutoff]
+        return "0", []
+
+    return "0", []
+
+
+def compile_rule_collection(rule_collection, now: Optional[float] = None,
+                            use_fts: bool = False, bodies_in_sql: bool = True) -> CompiledQuery:
+    match_all = rule_collection.rule_type.lower() == "all"
+    conditions, params, python_fields = [], [], set()
+    for rule in rule_collection.rules:
+        compiled = compile_rule(rule, now, use_fts, bodies_in_sql)
+        if compiled is None:
+            python_fields.add(rule.field)
+            continue
+        conditions.append(compiled[0])
+        params.extend(compiled[1])
+
+    exact = not python_fields
+    if match_all:
+        # Unknown predicates only weaken the filter: the rest must still hold
+        where = " AND ".join(conditions) or "1"
+    elif exact:
+        where = " OR ".join(conditions) or "0"
+    else:
+        # Any uncompiled predicate could be the one that matches
+        where, params = "1", []
+
+    fields = ["ID"]
+    if not exact:
+        fields += [field for field in FIELD_COLUMNS if field != "ID" and
+                   any(rule.field == field for rule in rule_collection.rules)]
+    return CompiledQuery(where, params, exact, fields)
+
+
+class EmailRow:
+    """Compact, tuple-backed email record that reads like the email dicts rules expect.
+
+    The Message body is not part of the row; it is read (and decompressed)
+    through the BodyStore the first time it is accessed, so emails decided
+    by header predicates alone never load their body.
+    """
+    __slots__ = ("_index", "_values", "_bodies", "_message")
+
+    _NOT_LOADED = object()
+
+    def __init__(self, index: Dict[str, int], values: Tuple[Any, ...], bodies: Optional[BodyStore] = None):
+        self._index = index
+        self._values = values
+        self._bodies = bodies
+        self._message = self._NOT_LOADED
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "Message" and "Message" not in self._index:
+            if self._message is self._NOT_LOADED:
+                self._message = self._bodies.load(self._values[self._index["rowid"]])
+            return default if self._message is None else self._message
+        position = self._index.get(key)
+        return default if position is None else self._values[position]
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._index and key != "Message":
+            raise KeyError(key)
+        return self.get(key)
+
+    @property
+    def body_loaded(self) -> bool:
+        return "Message" in self._index or self._message is not self._NOT_LOADED
+
+    def __repr__(self) -> str:
+        return f"EmailRow({dict(zip(self._index, self._values))!r})"
+
+
+def iter_rows(cursor, batch_size: int = 1000):
+    # fetchmany keeps at most one batch of rows in memory at a time
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def candidate_condition(conn, rule_collections, now: Optional[float] = None, ledger=None,
+                        rowids: Optional[Tuple[int, int]] = None) -> Tuple[str, List[Any]]:
+    """SQL condition on `emails` for the rows select_candidates() returns, and its parameters."""
+    use_fts = fts_available(conn)
+    bodies_in_sql = not bodies_compressed(conn)
+    conditions, params = [], []
+    for rule_collection in rule_collections:
+        query = compile_rule_collection(rule_collection, now, use_fts, bodies_in_sql)
+        condition = f"({query.where})"
+        params.extend(query.params)
+        if ledger is not None:
+            skip, skip_params = ledger.skip_condition(rule_collection)
+            condition += f" AND NOT {skip}"
+            params.extend(skip_params)
+        conditions.append(f"({condition})")
+    where = " OR ".join(conditions) or "0"
+    if rowids is not None:
+        where = f"rowid BETWEEN ? AND ? AND ({where})"
+        params = list(rowids) + params
+    return where, params
+
+
+def select_candidates(conn, rule_collections, now: Optional[float] = None, batch_size: int = 1000,
+                      ledger=None, rowids: Optional[Tuple[int, int]] = None):
+    """Yield EmailRows that may match at least one of the rule collections.
+
+    Rows carry every header field referenced by any rule, so the caller can
+    decide the matching collections for each email in a single pass; bodies
+    are loaded lazily. With a RuleLedger, pairs it already recorded are
+    filtered out in SQL. `rowids` limits the scan to an inclusive rowid range.
+    """
+    where, params = candidate_condition(conn, rule_collections, now, ledger, rowids)
+    fields = ["ID"] + [field for field in FIELD_COLUMNS if field not in ("ID", "Message") and
+                       any(rule.field == field for rule_collection in rule_collections
+                           for rule in rule_collection.rules)]
+    keys, columns = select_columns(fields)
+    keys += ["modified_seq", "rowid"]
+    index = {key: position for position, key in enumerate(keys)}
+    cursor = conn.execute(f"SELECT {columns}, modified_seq, rowid FROM emails WHERE {where}", params)
+    bodies = BodyStore(conn)
+    for row in iter_rows(cursor, batch_size):
+        yield EmailRow(index, row, bodies)
@@ -0,0 +1,203 @@
+import json
+import logging
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+# Gmail's per-user quota: 250 units per second, with each method costing a fixed number of units
+USER_QUOTA_PER_SECOND = 250
+QUOTA_UNITS = {
+    'messages.get': 5,
+    'messages.list': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'history.list': 2,
+    'getProfile': 1,
+    'labels.list': 1,
+    'labels.create': 5,
+    'watch': 100,
+}
+
+# Runs a queued operation is replayed in before it is given up on
+MAX_QUEUE_ATTEMPTS = 5
+
+
+def is_retryable(error: Exception) -> bool:
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    # Gmail also reports per-user rate limiting as a 403
+    return status == 403 and any(reason in str(error.content) for reason in RATE_LIMIT_REASONS)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait through a Retry-After header, if it did."""
+    resp = getattr(error, 'resp', None)
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base_delay: float = 0.5, max_delay: float = 32.0,
+                  error: Optional[Exception] = None) -> float:
+    """Full-jitter exponential backoff, or the server's Retry-After when it gave one."""
+    requested = retry_after(error) if error is not None else None
+    if requested is not None:
+        return min(requested, max_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+class QuotaBudget:
+    """Thread-safe token bucket of Gmail quota units that also counts what each method spent.
+
+    With `units_per_second=None` spending is only counted, never paced.
+    """
+
+    def __init__(self, units_per_second: Optional[float] = USER_QUOTA_PER_SECOND, burst: Optional[float] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.rate = units_per_second
+        self.capacity = burst if burst is not None else (units_per_second or 0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.sleep = sleep
+        self.spent: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def spend(self, method: str, count: int = 1) -> None:
+        units = QUOTA_UNITS.get(method, 1) * count
+        with self._lock:
+            self.spent[method] = self.spent.get(method, 0) + units
+            while self.rate is not None:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # A request larger than the bucket waits for a full bucket and overdraws it
+                if self.tokens >= min(units, self.capacity):
+                    self.tokens -= units
+                    return
+                self.sleep((min(units, self.capacity) - self.tokens) / self.rate)
+
+    @property
+    def total(self) -> int:
+        return sum(self.spent.values())
+
+
+class RequestScheduler:
+    """Runs Gmail API requests within the quota budget, retrying throttling and server errors.
+
+    Retryable failures (429, 5xx, rate-limit 403s) wait for the Retry-After
+    the server sent or a jittered exponential delay. Other errors, and
+    requests that still fail after `max_retries`, are raised to the caller.
+    """
+
+    def __init__(self, budget: Optional[QuotaBudget] = None, max_retries: int = 5, base_delay: float = 0.5,
+                 max_delay: float = 32.0, sleep: Callable[[float], None] = time.sleep):
+        self.budget = budget or QuotaBudget()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.retries: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def execute(self, request, method: str) -> Any:
+        attempt = 0
+        while True:
+            self.budget.spend(method)
+            started = time.perf_counter()
+            try:
+                return request.execute()
+            except HttpError as error:
+                METRICS.increment('api_errors', method=method, status=error.resp.status)
+                if not is_retryable(error) or attempt >= self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries[method] = self.retries.get(method, 0) + 1
+                METRICS.increment('api_retries', method=method)
+                self.sleep(backoff_delay(attempt, self.base_delay, self.max_delay, error))
+                attempt += 1
+            finally:
+                METRICS.observe('api_call', time.perf_counter() - started, method=method)
+
+
+class RetryQueue:
+    """Operations that failed for good in one run, kept in SQLite so the next run replays them first.
+
+    Each entry is an operation name ("fetch" or "batchModify") and its JSON payload.
+    Only retryable failures belong here. An entry that still fails after
+    `max_attempts` runs, or fails with an error retrying cannot fix, is
+    dropped with a warning so it stops spending quota ahead of new work.
+    """
+
+    def __init__(self, conn, max_attempts: int = MAX_QUEUE_ATTEMPTS):
+        self.conn = conn
+        self.max_attempts = max_attempts
+
+    def push(self, operation: str, payload: Any, error: Optional[Exception] = None, attempts: int = 0) -> None:
+        if attempts >= self.max_attempts:
+            self._drop(operation, payload, error, attempts)
+            return
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO retry_queue (operation, payload, attempts, last_error, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (operation, json.dumps(payload), attempts, str(error) if error is not None else None,
+                 int(time.time())))
+
+    @staticmethod
+    def _drop(operation: str, payload: Any, error: Optional[Exception], attempts: int) -> None:
+        logger.warning("Giving up on queued %s after %d attempts: %s (payload %s)",
+                       operation, attempts, error, json.dumps(payload)[:200])
+        METRICS.increment('retry_queue_dropped', operation=operation)
+
+    def entries(self, operation: str) -> List[Tuple[int, Any, int]]:
+        """(entry ID, payload, attempts so far) of the queued operations, oldest first."""
+        return [(entry_id, json.loads(payload), attempts) for entry_id, payload, attempts in self.conn.execute(
+            'SELECT id, payload, attempts FROM retry_queue WHERE operation = ? ORDER BY id', (operation,))]
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM retry_queue').fetchone()[0]
+
+    def remove(self, entry_ids: List[int]) -> None:
+        with self.conn:
+            self.conn.executemany('DELETE FROM retry_queue WHERE id = ?', [(entry_id,) for entry_id in entry_ids])
+
+    def drain(self, operation: str, handler: Callable[[Any], None]) -> int:
+        """Replay queued operations with `handler`; entries that fail again stay queued until they run out."""
+        replayed = 0
+        for entry_id, payload, attempts in self.entries(operation):
+            try:
+                handler(payload)
+            except HttpError as error:
+                if not is_retryable(error) or attempts + 1 >= self.max_attempts:
+                    self._drop(operation, payload, error, attempts + 1)
+                    self.remove([entry_id])
+                    continue
+                with self.conn:
+                    self.conn.execute('UPDATE retry_queue SET attempts = attempts + 1, last_error = ? WHERE id = ?',
+                                      (str(error), entry_id))
+                continue
+            self.remove([entry_id])
+            replayed += 1
+        return replayed
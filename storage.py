@@ -0,0 +1,542 @@
+import logging
+import sqlite3
+import time
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from dates import email_timestamp
+from metrics import METRICS
+
+try:
+    import zstandard
+except ImportError:  # optional: pip install zstandard
+    zstandard = None
+
+DATABASE = 'email_database.db'
+
+# sync_state key holding the last modified_seq handed out by store_emails
+MODIFIED_SEQ_KEY = 'modified_seq'
+# sync_state key holding the codec new bodies are compressed with; unset keeps them as plain text
+BODY_COMPRESSION_KEY = 'body_compression'
+BODY_CODECS = ['zlib', 'zstd'] if zstandard is not None else ['zlib']
+# A dictionary is trained from the first bodies compressed with a codec, once there are enough of them
+DICTIONARY_MIN_SAMPLES = 50
+DICTIONARY_SAMPLES = 1000
+DICTIONARY_SIZE = {'zlib': 32 * 1024, 'zstd': 64 * 1024}
+
+logger = logging.getLogger(__name__)
+
+# Tuned for bulk ingest: WAL lets gmailops.py read while fetch.py writes, and
+# synchronous=NORMAL is durable enough in WAL mode without a sync per commit.
+PRAGMAS = [
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA busy_timeout = 5000',
+]
+
+EMAIL_COLUMNS = ['id', 'from_address', 'subject', 'message', 'received_datetime',
+                 'received_ts', 'labels', 'thread_id', 'internal_date', 'body_fetched']
+
+
+def connect(db_path: str = DATABASE) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _column_names(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _add_column_if_missing(conn: sqlite3.Connection, table: str, column: str, column_type: str) -> None:
+    if column not in _column_names(conn, table):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+
+def _create_tables(conn: sqlite3.Connection) -> None:
+    # The original layout written by earlier versions of fetch.py
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS emails (
+            id TEXT PRIMARY KEY,
+            from_address TEXT,
+            subject TEXT,
+            message TEXT,
+            received_datetime TEXT
+        )
+    ''')
+
+    # Remember where the last sync stopped, e.g. the mailbox historyId
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def _add_normalized_columns(conn: sqlite3.Connection) -> None:
+    # New columns are appended so positional reads of the first five stay valid
+    _add_column_if_missing(conn, 'emails', 'received_ts', 'INTEGER')
+    _add_column_if_missing(conn, 'emails', 'labels', 'TEXT')
+    _add_column_if_missing(conn, 'emails', 'thread_id', 'TEXT')
+    _add_column_if_missing(conn, 'emails', 'internal_date', 'INTEGER')
+
+    rows = conn.execute(
+        'SELECT rowid, received_datetime FROM emails WHERE received_ts IS NULL').fetchall()
+    conn.executemany('UPDATE emails SET received_ts = ? WHERE rowid = ?',
+                     [(email_timestamp(received_datetime), rowid) for rowid, received_datetime in rows])
+
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_emails_from_address ON emails (from_address)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_emails_received_ts ON emails (received_ts)')
+
+
+FTS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS emails_fts_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        VALUES (new.rowid, new.subject, new.from_address, new.message);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS emails_fts_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        VALUES ('delete', old.rowid, old.subject, old.from_address, old.message);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS emails_fts_update AFTER UPDATE OF subject, from_address, message ON emails BEGIN
+        INSERT INTO emails_fts (emails_fts, rowid, subject, from_address, message)
+        VALUES ('delete', old.rowid, old.subject, old.from_address, old.message);
+        INSERT INTO emails_fts (rowid, subject, from_address, message)
+        VALUES (new.rowid, new.subject, new.from_address, new.message);
+    END
+    ''',
+]
+
+
+def _create_fts_index(conn: sqlite3.Connection) -> None:
+    # A trigram index answers case-insensitive substring searches of three or
+    # more characters exactly, which is what the "contains" rules need.
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(
+                subject, from_address, message,
+                content='emails', content_rowid='rowid', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError as error:
+        # SQLite built without FTS5 or the trigram tokenizer: rules fall back to instr()
+        logger.warning('Full-text index not available: %s', error)
+        return
+
+    # Keep the external-content index in sync with the emails table
+    for trigger in FTS_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute("INSERT INTO emails_fts (emails_fts) VALUES ('rebuild')")
+
+
+def fts_available(conn: sqlite3.Connection) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emails_fts'").fetchone() is not None
+
+
+def bodies_compressed(conn: sqlite3.Connection) -> bool:
+    """Whether some bodies are stored compressed, so SQL cannot search emails.message for them."""
+    try:
+        return conn.execute('SELECT 1 FROM email_bodies LIMIT 1').fetchone() is not None
+    except sqlite3.OperationalError:
+        return False
+
+
+def _create_rule_ledger(conn: sqlite3.Connection) -> None:
+    # Bumped whenever a stored email changes, so rule results recorded for an
+    # older version of the email are known to be stale
+    _add_column_if_missing(conn, 'emails', 'modified_seq', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_emails_modified_seq ON emails (modified_seq)')
+
+    # One row per (email, rule file content) that gmailops.py has evaluated
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rule_ledger (
+            message_id TEXT NOT NULL,
+            rule_hash TEXT NOT NULL,
+            matched INTEGER NOT NULL,
+            actions TEXT,
+            evaluated_seq INTEGER NOT NULL,
+            recheck_after INTEGER,
+            evaluated_at INTEGER NOT NULL,
+            PRIMARY KEY (message_id, rule_hash)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _add_body_fetched_column(conn: sqlite3.Connection) -> None:
+    # 0 for emails fetched with format=metadata whose body still has to be backfilled
+    _add_column_if_missing(conn, 'emails', 'body_fetched', 'INTEGER NOT NULL DEFAULT 1')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_emails_body_missing ON emails (body_fetched) '
+                 'WHERE body_fetched = 0')
+
+
+def _create_retry_queue(conn: sqlite3.Connection) -> None:
+    # API operations that still failed after retrying, replayed at the start of the next run
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS retry_queue (
+            id INTEGER PRIMARY KEY,
+            operation TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+
+def _create_body_tables(conn: sqlite3.Connection) -> None:
+    # Compressed bodies live outside the emails table so scans of the headers stay small;
+    # emails.message is NULL for every email that has a row here
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS email_bodies (
+            email_rowid INTEGER PRIMARY KEY,
+            codec TEXT NOT NULL,
+            dictionary_id INTEGER,
+            body BLOB NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS body_dictionaries (
+            id INTEGER PRIMARY KEY,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS email_bodies_delete AFTER DELETE ON emails BEGIN
+            DELETE FROM email_bodies WHERE email_rowid = old.rowid;
+        END
+    ''')
+
+
+def _create_predicate_bitmaps(conn: sqlite3.Connection) -> None:
+    # Rowid bitmaps of the emails matching each rule predicate, see predicate_cache.py
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS predicate_bitmaps (
+            field TEXT NOT NULL,
+            predicate TEXT NOT NULL,
+            value TEXT NOT NULL,
+            bitmap BLOB NOT NULL,
+            evaluated_seq INTEGER NOT NULL,
+            deletion_id INTEGER NOT NULL,
+            used_at INTEGER NOT NULL,
+            PRIMARY KEY (field, predicate, value)
+        ) WITHOUT ROWID
+    ''')
+    # Deleted rowids, cleared from every bitmap on its next refresh
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS predicate_deletions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email_rowid INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS predicate_deletions_log AFTER DELETE ON emails BEGIN
+            INSERT INTO predicate_deletions (email_rowid) VALUES (old.rowid);
+        END
+    ''')
+
+
+def _create_labels_table(conn: sqlite3.Connection) -> None:
+    # The mailbox's label catalog, see labels.py
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS labels (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            type TEXT
+        )
+    ''')
+
+
+# Each entry upgrades the schema by one version, tracked in PRAGMA user_version
+MIGRATIONS = [
+    _create_tables,
+    _add_normalized_columns,
+    _create_fts_index,
+    _create_rule_ledger,
+    _add_body_fetched_column,
+    _create_retry_queue,
+    _create_body_tables,
+    _create_predicate_bitmaps,
+    _create_labels_table,
+]
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+
+
+def train_dictionary(codec: str, samples: List[str]) -> Optional[bytes]:
+    """Build a compression dictionary from sample bodies, or None when they share too little."""
+    size = DICTIONARY_SIZE[codec]
+    if codec == 'zstd':
+        try:
+            return zstandard.train_dictionary(size, [sample.encode() for sample in samples]).as_bytes()
+        except zstandard.ZstdError:
+            return None
+    # zlib has no trainer, but a preset dictionary of the lines and words most
+    # bodies share (newsletter footers, greetings) gets the same effect
+    lines = Counter(line for sample in samples for line in set(sample.splitlines()) if line.strip())
+    words = Counter(word for sample in samples for word in set(sample.split()))
+    common = [line + '\n' for line, count in lines.most_common() if count > 1] + \
+             [word + ' ' for word, count in words.most_common() if count > 1]
+    data = b''
+    for piece in common:
+        encoded = piece.encode()
+        if len(data) + len(encoded) > size:
+            break
+        # zlib finds matches near the end of the dictionary most cheaply, so the commonest strings go last
+        data = encoded + data
+    return data or None
+
+
+class BodyCodec:
+    """Compresses and decompresses bodies with one codec and optional dictionary."""
+
+    def __init__(self, codec: str, dictionary: Optional[bytes] = None):
+        if codec not in BODY_CODECS:
+            raise ValueError(f'Unsupported body codec {codec!r}; available: {", ".join(BODY_CODECS)}')
+        self.codec = codec
+        self.dictionary = dictionary
+        if codec == 'zstd':
+            dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+            self._compressor = zstandard.ZstdCompressor(level=3, dict_data=dict_data)
+            self._decompressor = zstandard.ZstdDecompressor(dict_data=dict_data)
+
+    def compress(self, text: str) -> bytes:
+        data = text.encode()
+        if self.codec == 'zstd':
+            return self._compressor.compress(data)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS, zdict=self.dictionary) \
+            if self.dictionary else zlib.compressobj(6)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> str:
+        if self.codec == 'zstd':
+            return self._decompressor.decompress(data).decode()
+        decompressor = zlib.decompressobj(zdict=self.dictionary) if self.dictionary else zlib.decompressobj()
+        return (decompressor.decompress(data) + decompressor.flush()).decode()
+
+
+class BodyStore:
+    """Reads and writes the compressed bodies of one connection, caching the codecs it needs."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self._codecs: Dict[Tuple[str, Optional[int]], BodyCodec] = {}
+
+    def codec(self, codec: str, dictionary_id: Optional[int]) -> BodyCodec:
+        key = (codec, dictionary_id)
+        if key not in self._codecs:
+            dictionary = None
+            if dictionary_id is not None:
+                dictionary = self.conn.execute('SELECT data FROM body_dictionaries WHERE id = ?',
+                                               (dictionary_id,)).fetchone()[0]
+            self._codecs[key] = BodyCodec(codec, dictionary)
+        return self._codecs[key]
+
+    def load(self, rowid: int) -> Optional[str]:
+        """Body of the email with this rowid, decompressed if it is stored compressed."""
+        row = self.conn.execute('''
+            SELECT e.message, b.codec, b.dictionary_id, b.body
+            FROM emails e LEFT JOIN email_bodies b ON b.email_rowid = e.rowid WHERE e.rowid = ?
+        ''', (rowid,)).fetchone()
+        if row is None:
+            return None
+        message, codec, dictionary_id, body = row
+        if body is None:
+            return message
+        METRICS.increment('bodies_decompressed')
+        return self.codec(codec, dictionary_id).decompress(body)
+
+    def _dictionary_id(self, codec: str, samples: List[str]) -> Optional[int]:
+        row = self.conn.execute('SELECT max(id) FROM body_dictionaries WHERE codec = ?', (codec,)).fetchone()
+        if row[0] is not None or len(samples) < DICTIONARY_MIN_SAMPLES:
+            return row[0]
+        dictionary = train_dictionary(codec, samples[:DICTIONARY_SAMPLES])
+        if dictionary is None:
+            return None
+        return self.conn.execute('INSERT INTO body_dictionaries (codec, data, created_at) VALUES (?, ?, ?)',
+                                 (codec, dictionary, int(time.time()))).lastrowid
+
+    def write(self, codec: str, bodies: List[Tuple[int, str]]) -> None:
+        """Store (rowid, text) bodies compressed; the caller commits."""
+        dictionary_id = self._dictionary_id(codec, [text for rowid, text in bodies])
+        body_codec = self.codec(codec, dictionary_id)
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO email_bodies (email_rowid, codec, dictionary_id, body) VALUES (?, ?, ?, ?)',
+            [(rowid, codec, dictionary_id, body_codec.compress(text)) for rowid, text in bodies])
+
+
+class EmailStore:
+    """Single connection to the email database used for a whole sync run."""
+
+    def __init__(self, db_path: str = DATABASE):
+        self.db_path = db_path
+        self.conn = connect(db_path)
+        migrate(self.conn)
+        self.bodies = BodyStore(self.conn)
+        self.body_compression = self.get_sync_state(BODY_COMPRESSION_KEY)
+
+    def __enter__(self) -> 'EmailStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def store_emails(self, emails_with_details: List[Dict[str, Any]]) -> int:
+        rows = [(email_info['id'], email_info['from'], email_info['subject'], email_info['message'],
+                 email_info['received_datetime'],
+                 email_timestamp(email_info['received_datetime'], email_info.get('internal_date')),
+                 ','.join(email_info.get('labels') or []), email_info.get('thread_id'),
+                 email_info.get('internal_date'), int(email_info.get('body_fetched', True)))
+                for email_info in emails_with_details]
+        # Upsert instead of INSERT OR REPLACE so existing rows keep their rowid.
+        # A metadata-only fetch must not wipe a body that was stored earlier.
+        metadata = [column for column in EMAIL_COLUMNS[1:] if column not in ('message', 'body_fetched')]
+        updates = ', '.join(f'{column} = excluded.{column}' for column in metadata)
+        updates += (', message = CASE WHEN excluded.body_fetched THEN excluded.message ELSE emails.message END'
+                    ', body_fetched = max(emails.body_fetched, excluded.body_fetched)'
+                    ', modified_seq = excluded.modified_seq')
+        # Rows that would not change are left alone, so a resync does not bump
+        # modified_seq and make the ledger evaluate unchanged emails again
+        changed = ' OR '.join([f'emails.{column} IS NOT excluded.{column}' for column in metadata] + [
+            'excluded.body_fetched > emails.body_fetched',
+            '(excluded.body_fetched AND emails.message IS NOT excluded.message)'])
+        # Compressed bodies go to email_bodies once the rows exist; the hot table keeps NULL
+        fetched = {row[0]: row[3] for row in rows if row[-1]}
+        if self.body_compression:
+            rows = [row[:3] + (None if row[-1] and row[3] else row[3],) + row[4:] for row in rows]
+        with METRICS.timer('stage', stage='db_write'), self.conn:
+            seq = self._next_seq()
+            self.conn.executemany(f'''
+                INSERT INTO emails ({', '.join(EMAIL_COLUMNS)}, modified_seq)
+                VALUES ({', '.join('?' * len(EMAIL_COLUMNS))}, {seq})
+                ON CONFLICT(id) DO UPDATE SET {updates} WHERE {changed}
+            ''', rows)
+            if fetched and (self.body_compression or bodies_compressed(self.conn)):
+                self._write_bodies(fetched)
+        METRICS.increment('emails_stored', len(rows))
+        return len(rows)
+
+    def _next_seq(self) -> int:
+        """Take the modified_seq for the rows written by the current transaction."""
+        # The sequence never goes back, even after the newest emails were deleted,
+        # so a stored sequence number always identifies one version of an email
+        seq = self.conn.execute('''
+            SELECT max(coalesce((SELECT max(modified_seq) FROM emails), 0),
+                       coalesce((SELECT CAST(value AS INTEGER) FROM sync_state WHERE key = ?), 0)) + 1
+        ''', (MODIFIED_SEQ_KEY,)).fetchone()[0]
+        self.conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)',
+                          (MODIFIED_SEQ_KEY, str(seq)))
+        return seq
+
+    def _rowids(self, email_ids: List[str]) -> Dict[str, int]:
+        rowids = {}
+        for start in range(0, len(email_ids), 500):
+            chunk = email_ids[start:start + 500]
+            rowids.update(self.conn.execute(
+                f'SELECT id, rowid FROM emails WHERE id IN ({", ".join("?" * len(chunk))})', chunk))
+        return rowids
+
+    def _write_bodies(self, bodies_by_id: Dict[str, Optional[str]]) -> None:
+        rowids = self._rowids(list(bodies_by_id))
+        # Replaced bodies must not leave an older compressed copy behind
+        self.conn.executemany('DELETE FROM email_bodies WHERE email_rowid = ?',
+                              [(rowid,) for rowid in rowids.values()])
+        if self.body_compression:
+            self.bodies.write(self.body_compression, [(rowids[email_id], text)
+                                                      for email_id, text in bodies_by_id.items() if text])
+
+    def set_body_compression(self, codec: Optional[str], batch_size: int = 1000) -> int:
+        """Store bodies compressed with `codec` from now on (None for plain text) and convert stored ones.
+
+        Returns the number of bodies converted.
+        """
+        if codec is not None and codec not in BODY_CODECS:
+            raise ValueError(f'Unsupported body codec {codec!r}; available: {", ".join(BODY_CODECS)}')
+        with self.conn:
+            if codec is None:
+                self.conn.execute('DELETE FROM sync_state WHERE key = ?', (BODY_COMPRESSION_KEY,))
+            else:
+                self.conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)',
+                                  (BODY_COMPRESSION_KEY, codec))
+        self.body_compression = codec
+
+        converted = 0
+        while True:
+            if codec is None:
+                batch = self.conn.execute('SELECT email_rowid FROM email_bodies LIMIT ?', (batch_size,)).fetchall()
+            else:
+                batch = self.conn.execute("SELECT rowid FROM emails WHERE message IS NOT NULL AND message <> '' "
+                                          "LIMIT ?", (batch_size,)).fetchall()
+            if not batch:
+                return converted
+            with self.conn:
+                bodies = [(rowid, self.bodies.load(rowid)) for rowid, in batch]
+                if codec is None:
+                    self.conn.executemany('UPDATE emails SET message = ? WHERE rowid = ?',
+                                          [(text, rowid) for rowid, text in bodies])
+                    self.conn.executemany('DELETE FROM email_bodies WHERE email_rowid = ?',
+                                          [(rowid,) for rowid, text in bodies])
+                else:
+                    self.bodies.write(codec, bodies)
+                    self.conn.executemany('UPDATE emails SET message = NULL WHERE rowid = ?',
+                                          [(rowid,) for rowid, text in bodies])
+            converted += len(bodies)
+
+    def update_labels(self, labels_by_id: Dict[str, List[str]]) -> Set[str]:
+        """Update stored labels in place and return the IDs that are not stored yet.
+
+        Emails whose labels change get a new modified_seq, like any other
+        change, so rules and the label catalog look at them again.
+        """
+        with self.conn:
+            seq = self._next_seq()
+            missing = set()
+            for email_id, label_ids in labels_by_id.items():
+                labels = ','.join(label_ids)
+                cursor = self.conn.execute(
+                    'UPDATE emails SET labels = ?, modified_seq = CASE WHEN labels IS ? THEN modified_seq ELSE ? END '
+                    'WHERE id = ?', (labels, labels, seq, email_id))
+                if cursor.rowcount == 0:
+                    missing.add(email_id)
+        return missing
+
+    def missing_bodies(self, limit: Optional[int] = None) -> List[str]:
+        """IDs of stored emails whose body was not fetched yet."""
+        query = 'SELECT id FROM emails WHERE body_fetched = 0'
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
+        return [row[0] for row in self.conn.execute(query)]
+
+    def delete_emails(self, email_ids: Iterable[str]) -> None:
+        with self.conn:
+            self.conn.executemany('DELETE FROM emails WHERE id = ?', [(email_id,) for email_id in email_ids])
+
+    def get_sync_state(self, key: str) -> Optional[str]:
+        row = self.conn.execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_sync_state(self, key: str, value: Any) -> None:
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, str(value)))